@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+Memory and speed of buffering postings in the Indexer, the old dict of
+lists against qlist.Accumulator:
+
+    python bench_accumulator.py
+'''
+import array
+import collections
+import random
+import time
+
+from ziutek import qlist
+
+DOCS = 20000
+WORDS_PER_DOC = 50
+VOCABULARY = 50000
+BLOCK_SIZE = 16384
+
+def rss():
+    # Linux only, resident pages.
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * 4096
+
+def documents():
+    rnd = random.Random(1)
+    vocabulary = ['word%i' % i for i in xrange(VOCABULARY)]
+    docs = []
+    for docid in xrange(1000000, 1000000 + DOCS):
+        # Log-uniform ranks, that is Zipf's law with s=1.
+        words = [vocabulary[int(VOCABULARY ** rnd.random()) - 1]
+                 for _ in xrange(WORDS_PER_DOC)]
+        docs.append((docid, ' '.join(words)))
+    return docs
+
+def dict_of_lists(docs):
+    hitlists = collections.defaultdict(list)
+    for docid, text in docs:
+        chunk_no = docid // BLOCK_SIZE
+        for word in text.split():
+            hitlists[(word, chunk_no)].append(docid)
+    return hitlists
+
+def accumulator(docs):
+    acc = qlist.Accumulator()
+    new_keys = []
+    for docid, text in docs:
+        new_keys.extend(acc.add(docid, text.split(), docid // BLOCK_SIZE))
+    return acc
+
+def pre_tokenized(docs):
+    vocabulary = {}
+    docids = array.array('L')
+    offsets = array.array('L', [0])
+    term_ids = array.array('I')
+    for docid, text in docs:
+        docids.append(docid)
+        term_ids.extend(vocabulary.setdefault(word, len(vocabulary))
+                        for word in text.split())
+        offsets.append(len(term_ids))
+    words = sorted(vocabulary, key=vocabulary.get)
+    return docids, offsets, term_ids, words
+
+def accumulator_batch((docids, offsets, term_ids, words)):
+    acc = qlist.Accumulator()
+    # Batches of 1000 documents.
+    for i in xrange(0, len(docids), 1000):
+        start, end = offsets[i], offsets[min(i + 1000, len(docids))]
+        batch_offsets = array.array('L', (o - start for o in
+                                          offsets[i:i + 1001]))
+        acc.add_batch(docids[i:i + 1000], batch_offsets,
+                      term_ids[start:end], words, BLOCK_SIZE)
+    return acc
+
+def flush_dict_of_lists(hitlists):
+    for key in hitlists.keys():
+        qlist.pack(hitlists.pop(key))
+
+def flush_accumulator(acc, keys):
+    for key in keys:
+        acc.pop(key)
+
+def run(label, fill, flush, prepare=lambda docs: docs):
+    docs = prepare(documents())
+    before = rss()
+    t0 = time.time()
+    hitlists = fill(docs)
+    t1 = time.time()
+    used = rss() - before
+    tuples = DOCS * WORDS_PER_DOC
+    print "%-16s %7.1f bytes/tuple  put %8.0f ktuples/s" % (
+        label, float(used) / tuples, tuples / (t1 - t0) / 1000.0),
+    t0 = time.time()
+    flush(hitlists)
+    print " flush %6.0f ms" % ((time.time() - t0) * 1000.0,)
+
+def main():
+    run('dict of lists', dict_of_lists, flush_dict_of_lists)
+    keys = dict_of_lists(documents()).keys()
+    run('Accumulator', accumulator, lambda acc: flush_accumulator(acc, keys))
+    run('add_batch', accumulator_batch,
+        lambda acc: flush_accumulator(acc, keys), pre_tokenized)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+Memory and speed of the expirator, a PeekQueue of (deadline, key) with
+a set of keys against the timer wheel:
+
+    python bench_expirator.py
+'''
+import gc
+import time
+
+from ziutek import expirator
+from ziutek import peekqueue
+
+KEYS = 1000000
+DELAY = 600
+# Keys pushed per second of the fake clock.
+RATE = 5000
+
+def rss():
+    # Linux only, resident pages.
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * 4096
+
+class PeekQueueExpirator:
+    ''' The expirator before the timer wheel, with the runner's loop. '''
+    def __init__(self, delay, callback, get_time):
+        self.delay = delay
+        self.get_time = get_time
+        self.queue = peekqueue.PeekQueue()
+        self.keys  = set()
+
+    def push(self, key):
+        self.keys.add(key)
+        self.queue.push( (self.get_time() + self.delay, key) )
+
+    def pop(self):
+        _, key = self.queue.pop(default=(None, None))
+        if key is None:
+            return None
+        self.keys.remove(key)
+        return key
+
+    def pop_many(self, n):
+        return [self.pop() for _ in xrange(n)]
+
+    def expire(self, t):
+        keys = []
+        while True:
+            to, _ = self.queue.peek(default=(None, None))
+            if to is None or to > t:
+                break
+            keys.append( self.pop() )
+        return keys
+
+class Clock(object):
+    def __init__(self):
+        self.t = 1e9
+
+    def __call__(self):
+        return self.t
+
+def run(label, make):
+    clock = Clock()
+    keys = [('word%i' % i, i % 64) for i in xrange(KEYS)]
+    gc.collect()
+    before = rss()
+    ex = make(clock)
+    t0 = time.time()
+    for i, key in enumerate(keys):
+        if not i % RATE:
+            clock.t += 1
+        ex.push(key)
+    push = time.time() - t0
+    used = rss() - before
+    # A tick's worth of keys at a time, like the runner does.
+    t0 = time.time()
+    expired = 0
+    ticks = 0
+    while expired < KEYS // 2:
+        clock.t += 1
+        expired += len(ex.expire(clock.t))
+        ticks += 1
+    expire = time.time() - t0
+    t0 = time.time()
+    for _ in xrange(10):
+        ex.pop_many(KEYS // 40)
+    pop = time.time() - t0
+    print "%-10s %5.1f bytes/key  push %5.0f kkeys/s  expire %5.0f kkeys/s" \
+          "  (%.2f ms/tick)  pop_many %5.0f kkeys/s" % (
+        label, float(used) / KEYS, KEYS / push / 1000.0,
+        expired / expire / 1000.0, expire / ticks * 1000.0,
+        KEYS / 4 / pop / 1000.0)
+
+def main():
+    run('PeekQueue', lambda clock: PeekQueueExpirator(DELAY, None, clock))
+    run('wheel', lambda clock: expirator._Expirator(DELAY, None, clock, 1.0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+'''
+put_multi latency while expired hitlists are flushed to a slow server,
+packing under the Indexer lock against the Flusher thread:
+
+    python bench_indexer.py
+'''
+import logging
+import random
+import time
+
+from ziutek import rtftse
+
+SECONDS = 10
+CALLS_PER_SECOND = 100
+DOCS_PER_CALL = 20
+WORDS_PER_DOC = 50
+VOCABULARY = 50000
+SERVER_DELAY = 0.05
+
+class SlowClient(object):
+    ''' Stands in for QListClient, every batch takes SERVER_DELAY. '''
+    def clone(self):
+        return self
+
+    def qlist_update_multi(self, add_map, del_map):
+        time.sleep(SERVER_DELAY)
+        return True
+
+    def qlist_touch_multi(self, keys):
+        return True
+
+def locked_flush_keys(self, keys):
+    # Hitlists._flush_keys before the Flusher: everything under the lock.
+    dd = {}
+    counter = 0
+    for key in keys:
+        dd[ key ], n = self.hitlists.pop(key, self.fmt)
+        counter += n
+    self.tuples_inmem -= counter
+    if dd:
+        self.flusher.sender.push( (self.send_cmd, dd) )
+    return counter
+
+def run(label):
+    rnd = random.Random(1)
+    vocabulary = ['word%i' % i for i in xrange(VOCABULARY)]
+    idx = rtftse.Indexer(SlowClient(), flush_delay=1, max_tuples=200000,
+                         block_size=4096)
+    docid = 0
+    start = time.time()
+    for call in xrange(SECONDS * CALLS_PER_SECOND):
+        # Paced like live traffic, the server keeps up on average.
+        delay = start + float(call) / CALLS_PER_SECOND - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        docs = []
+        for _ in xrange(DOCS_PER_CALL):
+            docs.append((docid, [vocabulary[int(VOCABULARY ** rnd.random()) - 1]
+                                 for _ in xrange(WORDS_PER_DOC)]))
+            docid += 1
+        idx.put_multi(docs)
+    print "%-12s put_multi %s" % (label, idx.put_latency)
+    idx.close()
+
+def main():
+    logging.getLogger('ziutek').setLevel(logging.WARNING)
+    run('flusher')
+    rtftse.Hitlists._flush_keys = locked_flush_keys
+    run('under lock')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+'''
+Compare the qlist formats:
+
+    python bench_qlist.py
+'''
+import random
+import timeit
+
+from ziutek import qlist
+
+FORMATS = [
+    ('plain', qlist.FMT_PLAIN),
+    ('blocks', qlist.FMT_BLOCKS),
+    ('svb', qlist.FMT_SVB),
+]
+
+def random_list(size, maxval):
+    return sorted(random.sample(xrange(maxval), size))
+
+def bench(label, fun, number):
+    t = min(timeit.repeat(fun, number=number, repeat=3)) / number
+    print "%-40s %10.1f us" % (label, t * 1000000.0)
+
+def main():
+    random.seed(1)
+    universe = 4*1024*1024
+    common = random_list(1000000, universe)
+    medium = random_list(10000, universe)
+    rare = random_list(10, universe)
+
+    for name, fmt in FORMATS:
+        q_common = qlist.pack(common, fmt=fmt)
+        q_medium = qlist.pack(medium, fmt=fmt)
+        q_rare = qlist.pack(rare, fmt=fmt)
+        out = qlist.unpack(q_common)
+        q_quarters = [qlist.pack(common[i::4], fmt=fmt) for i in range(4)]
+        print "%s: 1M items packed into %i bytes" % (name, len(q_common))
+
+        bench("%s pack 1M" % name,
+              lambda: qlist.pack(common, fmt=fmt), 3)
+        bench("%s unpack 1M" % name,
+              lambda: qlist.unpack(q_common), 3)
+        bench("%s unpack 1M reversed" % name,
+              lambda: qlist.unpack(q_common, reverse=True), 3)
+        bench("%s unpack_into 1M" % name,
+              lambda: qlist.unpack_into(q_common, out), 3)
+        bench("%s and rare x common" % name,
+              lambda: qlist.do_and(q_rare, q_common), 100)
+        bench("%s and medium x common" % name,
+              lambda: qlist.do_and(q_medium, q_common), 20)
+        bench("%s andnot rare - common" % name,
+              lambda: qlist.do_andnot(q_rare, q_common), 100)
+        bench("%s or medium | common" % name,
+              lambda: qlist.do_or(q_medium, q_common), 3)
+        bench("%s or_many 4 x 250k" % name,
+              lambda: qlist.do_or_many(q_quarters), 3)
+        print
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,503 @@
+'''
+Non-blocking client for the qlist plugin, for frontends serving many
+queries from a single thread. Requests are pipelined over a few
+connections and every call returns a Future at once.
+
+Futures can be chained with the `coroutine` decorator: a coroutine
+yields futures (or lists of them) and gets their results back, it
+returns its own result by raising Return.
+
+>>> @coroutine
+... def add(a, b):
+...     x, y = yield [a, b]
+...     raise Return(x + y)
+>>> a, b = Future(), Future()
+>>> s = add(a, b)
+>>> a.set_result(1)
+>>> s.done()
+False
+>>> b.set_result(2)
+>>> s.result()
+3
+>>> @coroutine
+... def fail(a):
+...     yield a
+...     raise ValueError('boom')
+>>> fail(a).result()
+Traceback (most recent call last):
+    ...
+ValueError: boom
+
+AsyncQListClient doesn't load the plugin into the server, a QListClient
+does that on its first qlist call.
+'''
+import collections
+import errno
+import functools
+import select
+import socket
+import struct
+import sys
+import types
+
+from . import qlist
+from .protocol import OP_QLIST_QUERY, OP_QLIST_MULTI, MULTI_ADD, \
+    MULTI_DEL, QUERY_REVERSE, QUERY_COUNT, multi_values, query_extras, \
+    multi_failure
+
+MAGIC_REQUEST=0x80
+MAGIC_RESPONSE=0x81
+
+OP_GET=0x00
+
+STATUS_NO_ERROR=0x0000
+STATUS_KEY_ENOENT=0x0001
+
+HEADER=struct.Struct('!BBHBBHIIQ')
+
+RECV_SIZE=256*1024
+
+
+class ServerError(Exception):
+    def __init__(self, status, key=None):
+        Exception.__init__(self, 'status 0x%04x, key %r' % (status, key))
+        self.status = status
+        self.key = key
+
+
+class Future(object):
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError('Future is not done yet')
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            raise RuntimeError('Future is not done yet')
+        return self._exc_info[1] if self._exc_info else None
+
+    def add_done_callback(self, fn):
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exc):
+        self.set_exc_info((type(exc), exc, None))
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._set_done()
+
+    def _set_done(self):
+        assert not self._done
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, None
+        for fn in callbacks:
+            fn(self)
+
+
+def completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def gather(futures):
+    '''
+    Future of the list of results, fails with the first failure.
+
+    >>> gather([completed(1), completed(2)]).result()
+    [1, 2]
+    >>> gather([]).result()
+    []
+    '''
+    futures = list(futures)
+    future = Future()
+    results = [None] * len(futures)
+    pending = [len(futures)]
+    def _done(i, f):
+        if future.done():
+            return
+        if f.exception() is not None:
+            future.set_exc_info(f._exc_info)
+            return
+        results[i] = f.result()
+        pending[0] -= 1
+        if not pending[0]:
+            future.set_result(results)
+    for i, f in enumerate(futures):
+        f.add_done_callback(functools.partial(_done, i))
+    if not futures:
+        future.set_result(results)
+    return future
+
+
+class Return(Exception):
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+
+def coroutine(fun):
+    @functools.wraps(fun)
+    def wrapper(*args, **kwargs):
+        future = Future()
+        try:
+            gen = fun(*args, **kwargs)
+        except Return, e:
+            future.set_result(e.value)
+            return future
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+            return future
+        if not isinstance(gen, types.GeneratorType):
+            future.set_result(gen)
+            return future
+        _step(gen, future, None)
+        return future
+    return wrapper
+
+def _step(gen, future, previous):
+    # Loops while the yielded futures are already done, so long chains
+    # of cached results don't recurse.
+    while True:
+        try:
+            if previous is None:
+                yielded = gen.next()
+            elif previous.exception() is not None:
+                yielded = gen.throw(*previous._exc_info)
+            else:
+                yielded = gen.send(previous.result())
+        except StopIteration:
+            future.set_result(None)
+            return
+        except Return, e:
+            future.set_result(e.value)
+            return
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+            return
+        if isinstance(yielded, list):
+            yielded = gather(yielded)
+        if not yielded.done():
+            yielded.add_done_callback(lambda f: _step(gen, future, f))
+            return
+        previous = yielded
+
+
+def _pack_request(opcode, key, extras, value, opaque):
+    return ''.join((HEADER.pack(MAGIC_REQUEST, opcode, len(key), len(extras),
+                                0, 0, len(key) + len(extras) + len(value),
+                                opaque, 0),
+                    extras, key, value))
+
+
+class _Connection(object):
+    '''
+    Requests are answered in order, every one with a single response.
+    '''
+    def __init__(self, server_addr):
+        host, _, port = server_addr.rpartition(':')
+        self.sock = socket.create_connection((host, int(port)))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        self._out = collections.deque()
+        self._chunks = []
+        self._avail = 0
+        self._need = HEADER.size
+        # [future, expected responses, responses]
+        self._ops = collections.deque()
+        self._sent_opaque = 0
+        self._recv_opaque = 0
+
+    def request(self, reqs):
+        '''
+        reqs are (opcode, key, extras, value), the future gets the list
+        of (status, cas, extras, key, value) responses.
+        '''
+        future = Future()
+        if self.sock is None:
+            future.set_exception(socket.error(errno.EPIPE, 'connection closed'))
+            return future
+        n = 0
+        for opcode, key, extras, value in reqs:
+            self._sent_opaque = (self._sent_opaque + 1) & 0xFFFFFFFF
+            self._out.append(_pack_request(opcode, key, extras, value,
+                                           self._sent_opaque))
+            n += 1
+        if n:
+            self._ops.append([future, n, []])
+        else:
+            future.set_result([])
+        return future
+
+    def pending(self):
+        return len(self._ops)
+
+    def wants_write(self):
+        return bool(self._out)
+
+    def handle_write(self):
+        data = ''.join(self._out)
+        self._out.clear()
+        try:
+            sent = self.sock.send(data)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._fail(sys.exc_info())
+                return
+            sent = 0
+        if sent < len(data):
+            self._out.appendleft(data[sent:])
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._fail(sys.exc_info())
+            return
+        if not data:
+            self._fail((socket.error, socket.error(errno.ECONNRESET,
+                                                   'connection closed'), None))
+            return
+        self._chunks.append(data)
+        self._avail += len(data)
+        if self._avail >= self._need:
+            # Joined only once a whole response is there.
+            self._parse(''.join(self._chunks))
+
+    def _parse(self, buf):
+        pos = 0
+        while True:
+            if len(buf) - pos < HEADER.size:
+                need = HEADER.size
+                break
+            magic, opcode, key_sz, extras_sz, _, status, body_sz, opaque, cas = \
+                                                    HEADER.unpack_from(buf, pos)
+            if len(buf) - pos < HEADER.size + body_sz:
+                need = HEADER.size + body_sz
+                break
+            self._recv_opaque = (self._recv_opaque + 1) & 0xFFFFFFFF
+            if magic != MAGIC_RESPONSE or opaque != self._recv_opaque \
+                                                        or not self._ops:
+                self._fail((IOError, IOError('protocol error'), None))
+                return
+            extras_pos = pos + HEADER.size
+            key_pos = extras_pos + extras_sz
+            value_pos = key_pos + key_sz
+            pos = extras_pos + body_sz
+            op = self._ops[0]
+            op[2].append((status, cas, buf[extras_pos:key_pos],
+                          buf[key_pos:value_pos], buf[value_pos:pos]))
+            if len(op[2]) == op[1]:
+                self._ops.popleft()
+                op[0].set_result(op[2])
+                if self.sock is None:
+                    # Closed by a callback.
+                    return
+        rest = buf[pos:]
+        self._chunks = [rest] if rest else []
+        self._avail = len(rest)
+        self._need = need
+
+    def _fail(self, exc_info):
+        ops, self._ops = self._ops, collections.deque()
+        self.close()
+        for future, _, _ in ops:
+            future.set_exc_info(exc_info)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self._out.clear()
+
+
+class AsyncQListClient(object):
+    '''
+    Reads are spread over `connections` connections. Writes all go
+    through the first one, so they are applied in the order they were
+    made, but a read may pass a write made before it.
+
+    Nothing is sent until the client is polled: call poll() from the
+    event loop when its sockets() are ready, or run_until() to wait for
+    a single future.
+    '''
+    def __init__(self, server_addr, connections=2):
+        self.server_addr = server_addr
+        self._conns = [_Connection(server_addr)
+                                    for _ in xrange(max(1, connections))]
+
+    def _request(self, conn, reqs, parse):
+        future = Future()
+        def _done(f):
+            if f.exception() is not None:
+                future.set_exc_info(f._exc_info)
+                return
+            try:
+                future.set_result(parse(f.result()))
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+        conn.request(reqs).add_done_callback(_done)
+        return future
+
+    def get_multi(self, keys, default=None):
+        '''
+        Future of the list of values, keys are split between the
+        connections.
+        '''
+        keys = list(keys)
+        step = max(1, -(-len(keys) // len(self._conns)))
+        conns = sorted(self._conns, key=lambda c: c.pending())
+        def _parse(slice_keys):
+            def _values(responses):
+                values = []
+                for key, (status, _, _, _, value) in zip(slice_keys, responses):
+                    if status == STATUS_KEY_ENOENT:
+                        value = default
+                    elif status != STATUS_NO_ERROR:
+                        raise ServerError(status, key)
+                    values.append(value)
+                return values
+            return _values
+        futures = []
+        for i, pos in enumerate(xrange(0, len(keys), step)):
+            slice_keys = keys[pos:pos+step]
+            futures.append(self._request(conns[i],
+                            [(OP_GET, key, '', '') for key in slice_keys],
+                            _parse(slice_keys)))
+        return self._chain(gather(futures),
+                           lambda parts: [v for part in parts for v in part])
+
+    def qlist_get_many(self, keys):
+        '''
+        Future of a dict, missing keys map to empty qlists.
+        '''
+        keys = list(keys)
+        return self._chain(self.get_multi(keys, default=qlist.pack([])),
+                           lambda values: dict(zip(keys, values)))
+
+    def qlist_update_multi(self, add_map, del_map):
+        '''
+        Same as QListClient.qlist_update_multi, the future gets True.
+        '''
+        entries = [(MULTI_ADD, key, value) for key, value in add_map.iteritems()]
+        entries.extend((MULTI_DEL, key, value) for key, value in del_map.iteritems())
+        firsts = []
+        reqs = []
+        for first, value in multi_values(entries):
+            firsts.append(first)
+            reqs.append((OP_QLIST_MULTI, '', '', value))
+        def _parse(responses):
+            for i, (status, _, extras, _, value) in enumerate(responses):
+                if status != STATUS_NO_ERROR:
+                    raise ServerError(status, entries[firsts[i]][1])
+                failure = multi_failure(extras, value)
+                if failure:
+                    index, status = failure
+                    raise ServerError(status, entries[firsts[i] + index][1])
+            return True
+        return self._request(self._conns[0], reqs, _parse)
+
+    def qlist_add_multi(self, key_map):
+        return self.qlist_update_multi(key_map, {})
+
+    def qlist_del_multi(self, key_map):
+        return self.qlist_update_multi({}, key_map)
+
+    def _qlist_query(self, namespace, rpn, chunk_from, chunk_to, limit, flags):
+        def _parse(responses):
+            [(status, _, extras, _, value)] = responses
+            if status != STATUS_NO_ERROR:
+                raise ServerError(status, namespace)
+            chunks_total, chunks_searched, items = struct.unpack('!III', extras)
+            return (value, chunks_total, chunks_searched, items)
+        conn = min(self._conns, key=lambda c: c.pending())
+        return self._request(conn, [(OP_QLIST_QUERY, namespace + ':',
+                            query_extras(chunk_from, chunk_to, limit, flags),
+                            '\n'.join(rpn))], _parse)
+
+    def qlist_query(self, namespace, rpn, chunk_from=0, chunk_to=2**64-1,
+                                                    limit=0, reverse=False):
+        '''
+        Future of (qbuf, chunks_total, chunks_searched), see
+        QListClient.qlist_query.
+        '''
+        flags = QUERY_REVERSE if reverse else 0
+        return self._chain(self._qlist_query(namespace, rpn, chunk_from,
+                                             chunk_to, limit, flags),
+                           lambda r: r[:3])
+
+    def qlist_query_count(self, namespace, rpn, chunk_from=0, chunk_to=2**64-1):
+        return self._chain(self._qlist_query(namespace, rpn, chunk_from,
+                                             chunk_to, 0, QUERY_COUNT),
+                           lambda r: r[3])
+
+    def _chain(self, future, fun):
+        chained = Future()
+        def _done(f):
+            if f.exception() is not None:
+                chained.set_exc_info(f._exc_info)
+            else:
+                chained.set_result(fun(f.result()))
+        future.add_done_callback(_done)
+        return chained
+
+    def sockets(self):
+        return [c.sock for c in self._conns if c.sock is not None]
+
+    def pending(self):
+        return sum(c.pending() for c in self._conns)
+
+    def poll(self, timeout=None):
+        '''
+        Sends what is queued and handles the responses that arrive within
+        timeout. Returns the number of requests still waiting for a
+        response.
+        '''
+        for conn in self._conns:
+            # Most writes go through without waiting for select.
+            if conn.wants_write():
+                conn.handle_write()
+        rlist = [c.sock for c in self._conns if c.pending()]
+        wlist = [c.sock for c in self._conns if c.wants_write()]
+        if rlist or wlist:
+            readable, writable, _ = select.select(rlist, wlist, [], timeout)
+            for conn in self._conns:
+                if conn.sock in writable:
+                    conn.handle_write()
+                if conn.sock is not None and conn.sock in readable:
+                    conn.handle_read()
+        return self.pending()
+
+    def run_until(self, future, timeout=None):
+        '''
+        Polls until the future is done, returns its result.
+        '''
+        while not future.done():
+            if not self.poll(timeout) and not future.done() \
+                            and not any(c.wants_write() for c in self._conns):
+                raise RuntimeError('Future is not waiting for the server')
+        return future.result()
+
+    def close(self):
+        for conn in self._conns:
+            conn.close()
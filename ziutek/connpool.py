@@ -0,0 +1,234 @@
+'''
+Bounded pool of client connections shared by threads. A connection is
+taken for a single call and put back right after, so concurrent
+Searchers don't serialize on one socket and nobody has to clone().
+
+A connection that failed with a socket error is dropped and replaced on
+the next checkout. Connections idle for longer than `check_interval`
+are pinged before they are handed out.
+
+>>> class Client:
+...     def __init__(self):
+...         self.broken = False
+...     def get(self, key):
+...         if self.broken:
+...             raise IOError('connection reset')
+...         return key.upper()
+...     def ping(self):
+...         return True
+...     def close(self):
+...         pass
+>>> pool = ConnectionPool(Client, size=2)
+>>> mc = PooledClient(pool)
+>>> mc.get('ala')
+'ALA'
+>>> with pool.connection() as conn:
+...     conn.broken = True
+...     pool.stats()['in_use']
+1
+
+A broken connection is replaced and the call retried once.
+
+>>> mc.get('ma')
+'MA'
+>>> s = pool.stats()
+>>> s['created'], s['reconnects'], s['in_use'], s['idle']
+(2, 1, 0, 1)
+>>> pool.close()
+'''
+from __future__ import with_statement # 2.5 only
+
+import contextlib
+import os
+import threading
+import time
+import types
+
+# Errors that leave a connection in an unknown state, socket.error is
+# an IOError.
+CONNECTION_ERRORS = (IOError, EOFError)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    def __init__(self, factory, size=8, check_interval=30.0, timeout=None):
+        self.factory = factory
+        self.size = size
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self._cond = threading.Condition(threading.Lock())
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # (connection, last used), most recently used last.
+        self._idle = []
+        self._in_use = 0
+        self._created = 0
+        self._reconnects = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._checks = 0
+
+    def get(self):
+        '''
+        Takes an idle connection or makes a new one, waits while `size`
+        connections are in use.
+        '''
+        return self._get()[0]
+
+    def _get(self):
+        with self._cond:
+            if self._pid != os.getpid():
+                # Forked, the sockets belong to the parent.
+                self._reset()
+            if not self._idle and self._in_use >= self.size:
+                self._waits += 1
+                start = time.time()
+                deadline = start + self.timeout if self.timeout is not None else None
+                while not self._idle and self._in_use >= self.size:
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        self._wait_time += time.time() - start
+                        raise PoolTimeout("all %i connections in use" % (self.size,))
+                    self._cond.wait(remaining)
+                self._wait_time += time.time() - start
+            self._in_use += 1
+            conn = last_used = None
+            if self._idle:
+                conn, last_used = self._idle.pop()
+        fresh = False
+        try:
+            if conn is not None and time.time() - last_used > self.check_interval:
+                conn = self._check(conn)
+            if conn is None:
+                conn = self.factory()
+                fresh = True
+                with self._cond:
+                    self._created += 1
+        except:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return (conn, fresh)
+
+    def _check(self, conn):
+        with self._cond:
+            self._checks += 1
+        try:
+            conn.ping()
+        except CONNECTION_ERRORS:
+            self._drop(conn)
+            return None
+        return conn
+
+    def _drop(self, conn):
+        try:
+            conn.close()
+        except CONNECTION_ERRORS:
+            pass
+        with self._cond:
+            self._reconnects += 1
+
+    def put(self, conn, broken=False):
+        if broken:
+            self._drop(conn)
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if not broken:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            self.put(conn, broken=True)
+            raise
+        except:
+            self.put(conn)
+            raise
+        self.put(conn)
+
+    def call(self, name, *args, **kwargs):
+        '''
+        Calls the method on a pooled connection. When a reused connection
+        turns out to be broken the call is repeated once on a new one,
+        all the client calls are idempotent.
+        '''
+        # The retry needs the arguments again.
+        args = [list(arg) if isinstance(arg, types.GeneratorType) else arg
+                                                                for arg in args]
+        for attempt in (0, 1):
+            conn, fresh = self._get()
+            try:
+                result = getattr(conn, name)(*args, **kwargs)
+            except CONNECTION_ERRORS:
+                self.put(conn, broken=True)
+                if attempt or fresh:
+                    raise
+                continue
+            except:
+                self.put(conn)
+                raise
+            self.put(conn)
+            return result
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waits': self._waits,
+                'wait_time': self._wait_time,
+                'reconnects': self._reconnects,
+                'checks': self._checks,
+            }
+
+    def clone(self):
+        return ConnectionPool(self.factory, size=self.size,
+                              check_interval=self.check_interval,
+                              timeout=self.timeout)
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+class PooledClient(object):
+    '''
+    Looks like a single client, every method call runs on a connection
+    from the pool. Safe to share between threads, and after a fork the
+    child starts with a pool of its own.
+    '''
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def _call(*args, **kwargs):
+            return self.pool.call(name, *args, **kwargs)
+        _call.__name__ = name
+        return _call
+
+    def clone(self):
+        return PooledClient(self.pool.clone())
+
+    def stats(self):
+        return self.pool.stats()
+
+    def close(self):
+        self.pool.close()
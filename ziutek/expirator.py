@@ -6,55 +6,226 @@
 >>> ex.push('c')
 >>> ex.pop()
 'a'
->>> ex.pop_all()
-['c', 'b']
->>> ex.push('a')
+>>> sorted(ex.pop_all())
+['b', 'c']
+>>> with er.lock:
+...     ex.push('a')
 >>> er.sleep(0.3)
 >>> ex.pop() is None
 True
 >>> er.close()
+
+Keys are due `delay` after they were pushed, rounded up to a tick, and
+expire() takes the keys due by then. A key pushed again is due later, a
+cancelled one never. Expirators are used under the runner's lock.
+
+>>> ex = _Expirator(10, None, lambda: 1000.0, granularity=1.0)
+>>> for key in 'abcd':
+...     ex.push(key)
+>>> ex.cancel('b'), ex.cancel('x'), len(ex)
+(True, False, 3)
+>>> ex.expire(1009.9), ex.expire(1010.0)
+([], ['a', 'c', 'd'])
+>>> ex.push('e')
+>>> ex.pop_many(5), ex.expire(2000.0)
+(['e'], [])
 '''
 from __future__ import with_statement # 2.5 only
 
+import math
 import os
 import time
 import thread
 import threading
-from . import peekqueue
 
 import logging
 log = logging.getLogger(__name__)
 
+# Slots per wheel and wheels. With an eighth of a second long tick the
+# wheels cover 64**4 ticks, 24 days, keys due later wait in an overflow
+# list.
+WHEEL_BITS=6
+WHEEL_LEVELS=4
+WHEEL_SIZE=1 << WHEEL_BITS
+WHEEL_MASK=WHEEL_SIZE - 1
+# Wheel ticks per runner granularity. Deadlines are rounded up to a tick,
+# so keys go on the first run after their time, an eighth later at most.
+TICKS_PER_RUN=8
+
 
 class _Expirator:
-    def __init__(self, delay, callback, get_time):
+    '''
+    Hierarchical timer wheel, time is counted in ticks of `granularity`.
+    Wheel 0 has a slot per tick of the current 64 tick epoch, wheel 1 a
+    slot per 64 ticks of the current 64**2 tick epoch and so on. When an
+    epoch starts the slot of the wheel above is spread over the ones
+    below. A slot is a list of keys, taken as a whole when its tick
+    comes; the tick a key is due is kept in one dict. Cancelled and
+    pushed again keys leave a stale entry behind, it's dropped when its
+    slot comes up. Once more entries went stale than there are live
+    keys the slots are built anew from the dict, so a key pushed over
+    and over again doesn't pile up entries.
+    '''
+    def __init__(self, delay, callback, get_time, granularity):
         self.delay = delay
         self.callback = callback
         self.get_time = get_time
-        self.queue = peekqueue.PeekQueue()
-        self.keys  = set()
+        self.granularity = granularity
+        self._reset(self._tick(get_time()))
+
+    def _reset(self, now):
+        # The next tick to expire.
+        self._now = now
+        self._due = {}
+        self._wheels = [[[] for _ in xrange(WHEEL_SIZE)]
+                        for _ in xrange(WHEEL_LEVELS)]
+        self._overflow = []
+        # Entries gone stale since the slots were built, some of them may
+        # have been dropped already.
+        self._stale = 0
+        # (time, next tick, tick due, slot) of the last push, keys pushed
+        # at the same time go to the same slot.
+        self._last = (None, None, None, None)
+
+    def _went_stale(self):
+        self._stale += 1
+        if self._stale <= len(self._due) + WHEEL_SIZE:
+            return
+        due = self._due
+        self._reset(self._now)
+        for key, d in sorted(due.iteritems(), key=lambda (key, d): d):
+            self._slot(d).append(key)
+        self._due = due
+
+    def _tick(self, t):
+        return int(math.floor(t / self.granularity))
+
+    def _slot(self, due):
+        now = self._now
+        for level in xrange(WHEEL_LEVELS):
+            shift = level * WHEEL_BITS
+            if (due >> shift >> WHEEL_BITS) == (now >> shift >> WHEEL_BITS):
+                return self._wheels[level][(due >> shift) & WHEEL_MASK]
+        return self._overflow
+
+    def _replace(self, keys, start, end):
+        due = self._due
+        for key in keys:
+            d = due.get(key)
+            if d is not None and start <= d and (end is None or d < end):
+                self._slot(d).append(key)
+
+    def _cascade(self):
+        # The epochs starting now, from the longest one.
+        now = self._now
+        if not now & ((1 << WHEEL_LEVELS * WHEEL_BITS) - 1):
+            keys, self._overflow = self._overflow, []
+            self._replace(keys, now, None)
+        for level in xrange(WHEEL_LEVELS - 1, 0, -1):
+            shift = level * WHEEL_BITS
+            if now & ((1 << shift) - 1):
+                continue
+            wheel = self._wheels[level]
+            i = (now >> shift) & WHEEL_MASK
+            keys, wheel[i] = wheel[i], []
+            self._replace(keys, now, now + (1 << shift))
+
+    def _slots(self):
+        '''
+        (first tick, end tick, slot) of the slots in the order they are
+        due, the overflow last.
+        '''
+        now = self._now
+        for level in xrange(WHEEL_LEVELS):
+            shift = level * WHEEL_BITS
+            base = now >> shift >> WHEEL_BITS << WHEEL_BITS
+            # Wheel 0 starts with the current tick, the current slots of
+            # the others have been spread already.
+            first = (now >> shift) & WHEEL_MASK
+            if level:
+                first += 1
+            for i in xrange(first, WHEEL_SIZE):
+                yield ((base | i) << shift, (base | i) + 1 << shift,
+                       self._wheels[level][i])
+        yield (now, None, self._overflow)
 
     def push(self, key):
-        #assert key is not None and key not in self.keys
-        self.keys.add(key)
-        self.queue.push( (self.get_time() + self.delay, key) )
+        t = self.get_time()
+        last_t, last_now, due, slot = self._last
+        if last_t != t or last_now != self._now:
+            due = max(int(math.ceil((t + self.delay) / self.granularity)),
+                      self._now)
+            slot = self._slot(due)
+            self._last = (t, self._now, due, slot)
+        pushed = key in self._due
+        self._due[key] = due
+        slot.append(key)
+        if pushed:
+            self._went_stale()
+
+    def cancel(self, key):
+        if self._due.pop(key, None) is None:
+            return False
+        self._went_stale()
+        return True
+
+    def expire(self, t):
+        '''
+        Removes and returns the keys due at t or before.
+        '''
+        end = self._tick(t)
+        due = self._due
+        wheel = self._wheels[0]
+        keys = []
+        while self._now <= end:
+            now = self._now
+            slot = wheel[now & WHEEL_MASK]
+            if slot:
+                wheel[now & WHEEL_MASK] = []
+                for key in slot:
+                    if due.get(key) == now:
+                        del due[key]
+                        keys.append(key)
+            self._now = now + 1
+            if self._now & WHEEL_MASK and not any(wheel[self._now & WHEEL_MASK:]):
+                # Nothing else due in this epoch.
+                self._now = min(end + 1, (self._now | WHEEL_MASK) + 1)
+            if not self._now & WHEEL_MASK:
+                self._cascade()
+        return keys
+
+    def pop_many(self, n):
+        '''
+        Removes and returns up to n keys due first, ahead of time.
+        '''
+        keys = []
+        due = self._due
+        for start, end, slot in self._slots():
+            if len(keys) >= n or not due:
+                break
+            taken = 0
+            for key in slot:
+                if len(keys) >= n:
+                    break
+                taken += 1
+                d = due.get(key)
+                if d is not None and start <= d and (end is None or d < end):
+                    del due[key]
+                    keys.append(key)
+            del slot[:taken]
+        return keys
 
     def pop(self):
-        _, key = self.queue.pop(default=(None, None))
-        if key is None:
-            return None
-        self.keys.remove(key)
-        return key
+        keys = self.pop_many(1)
+        return keys[0] if keys else None
 
     def pop_all(self):
-        keys = list(self.keys)
-        self.queue = peekqueue.PeekQueue()
-        self.keys  = set()
+        keys = list(self._due)
+        self._reset(self._now)
         return keys
 
-    def _peek_timeout(self):
-        timeout, _ = self.queue.peek(default=(None, None))
-        return timeout
+    def __len__(self):
+        return len(self._due)
 
 
 class ExpiratorRunner:
@@ -69,7 +240,8 @@ class ExpiratorRunner:
         thread.start_new_thread(self._run,())
 
     def Expirator(self, delay, callback):
-        expirator = _Expirator(delay, callback, self.get_time)
+        expirator = _Expirator(delay, callback, self.get_time,
+                               float(self._granularity) / TICKS_PER_RUN)
         self._expirators.append( expirator )
         return expirator
 
@@ -81,12 +253,7 @@ class ExpiratorRunner:
             self._t[0] = t
             with self.lock:
                 for expirator in self._expirators:
-                    keys = []
-                    while True:
-                        to = expirator._peek_timeout() 
-                        if to is None or to > t:
-                            break
-                        keys.append( expirator.pop() )
+                    keys = expirator.expire(t)
                     if keys and expirator.callback:
                         try:
                             expirator.callback(keys)
@@ -0,0 +1,76 @@
+'''
+Latency histogram with power of two buckets, cheap enough to record
+every call. Bucket i holds the times in [2**(i-1), 2**i) microseconds,
+percentiles are the upper bounds of their buckets.
+
+>>> h = LatencyHistogram()
+>>> for ms in [0.3, 0.4, 0.5, 1.0, 1.5, 2.0, 9.0, 40.0]:
+...     h.add(ms / 1000.0)
+>>> h.count, h.max
+(8, 0.04)
+>>> h.percentile(50), h.percentile(99)
+(0.001024, 0.065536)
+>>> h.buckets()
+[(0.000512, 3), (0.001024, 1), (0.002048, 2), (0.016384, 1), (0.065536, 1)]
+>>> print h
+n=8 p50=1.0ms p90=65.5ms p99=65.5ms max=40.0ms
+>>> h.reset()
+>>> h.count, h.percentile(50)
+(0, 0.0)
+'''
+from __future__ import with_statement # 2.5 only
+
+import threading
+
+BUCKETS=40
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * BUCKETS
+            self.count = 0
+            self.max = 0.0
+
+    def add(self, seconds):
+        us = int(seconds * 1000000.0)
+        i = min(us.bit_length(), BUCKETS - 1) if us > 0 else 0
+        with self._lock:
+            self._counts[i] += 1
+            self.count += 1
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, p):
+        '''
+        Upper bound in seconds of the bucket the p-th percentile is in.
+        '''
+        with self._lock:
+            rank = self.count * p / 100.0
+            seen = 0
+            for i, n in enumerate(self._counts):
+                seen += n
+                if n and seen >= rank:
+                    return (1 << i) / 1000000.0
+        return 0.0
+
+    def buckets(self):
+        '''
+        [(upper bound in seconds, count)] of the buckets used.
+        '''
+        with self._lock:
+            return [((1 << i) / 1000000.0, n)
+                    for i, n in enumerate(self._counts) if n]
+
+    def __str__(self):
+        return 'n=%i p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms' % (
+            self.count,
+            self.percentile(50) * 1000.0,
+            self.percentile(90) * 1000.0,
+            self.percentile(99) * 1000.0,
+            self.max * 1000.0,
+        )
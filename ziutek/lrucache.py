@@ -1,3 +1,5 @@
+import mmap
+import struct
 
 
 class LRUCache:
@@ -68,3 +70,144 @@ class LRUCache:
         '''
         return [self.l[(self.p+p) % self.maxsize] for p in range(self.maxsize)]
 
+
+
+class LRUDict:
+    '''
+    Mapping that evicts least recently used items once the total size of
+    the values grows over maxbytes.
+
+    >>> d = LRUDict(maxbytes=10)
+    >>> d.put('a', 'xxxx')
+    >>> d.put('b', 'yyyy')
+    >>> d.get('a')
+    'xxxx'
+    >>> d.put('c', 'zzzz')
+    >>> d.get('b') is None
+    True
+    >>> d.keys()
+    ['a', 'c']
+    >>> d.put('d', 'x' * 11)
+    >>> d.get('d') is None
+    True
+    >>> d.put('a', 'xx', size=8)
+    >>> d.keys(), d.size
+    (['a'], 8)
+    >>> d.hits, d.misses
+    (1, 2)
+    '''
+    def __init__(self, maxbytes):
+        assert maxbytes > 0
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.d = {}
+        # circular list of [prev, next, key, value, size], root is a sentinel
+        self.root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def _unlink(self, node):
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _link_last(self, node):
+        root = self.root
+        last = root[0]
+        node[0], node[1] = last, root
+        last[1] = root[0] = node
+
+    def get(self, key, default=None):
+        node = self.d.get(key)
+        if node is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._unlink(node)
+        self._link_last(node)
+        return node[3]
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = len(value)
+        self.pop(key)
+        if size > self.maxbytes:
+            return
+        node = [None, None, key, value, size]
+        self._link_last(node)
+        self.d[key] = node
+        self.size += size
+        while self.size > self.maxbytes:
+            self.pop(self.root[1][2])
+
+    def pop(self, key, default=None):
+        node = self.d.pop(key, None)
+        if node is None:
+            return default
+        self._unlink(node)
+        self.size -= node[4]
+        return node[3]
+
+    def keys(self):
+        keys = []
+        node = self.root[1]
+        while node is not self.root:
+            keys.append(node[2])
+            node = node[1]
+        return keys
+
+    def __len__(self):
+        return len(self.d)
+
+
+
+class SharedKeySet:
+    '''
+    Lossy set of keys kept in an anonymous mmap, so processes forked
+    after it was created share it. Keys are stored as 64 bit hash
+    fingerprints in two way buckets, a new key pushes out the older
+    entry of its bucket. A key that was never added is only reported
+    present on a full fingerprint collision. Concurrent writers can at
+    worst lose or tear an entry, which reads as a miss.
+
+    >>> s = SharedKeySet(buckets=4)
+    >>> s.add('a')
+    >>> 'a' in s, 'b' in s
+    (True, False)
+    >>> for k in 'bcdefghijklmnop':
+    ...     s.add(k)
+    >>> 'p' in s, sum(k in s for k in 'abcdefghijklmnop') <= 8
+    (True, True)
+
+    >>> import os
+    >>> pid = os.fork()
+    >>> if pid == 0:
+    ...     s.add('from child')
+    ...     os._exit(0)
+    >>> os.waitpid(pid, 0)[1], 'from child' in s
+    (0, True)
+    '''
+    _bucket = struct.Struct('=QQ')
+
+    def __init__(self, buckets):
+        assert buckets > 0
+        self.buckets = buckets
+        self._shm = mmap.mmap(-1, buckets * self._bucket.size)
+
+    def _locate(self, key):
+        # 0 marks an empty entry. Hashes of similar strings differ in
+        # few bits, they are spread over the buckets by a multiplication.
+        fp = (hash(key) & 0xFFFFFFFFFFFFFFFF) or 1
+        mixed = (fp * 0x9E3779B97F4A7C15 & 0xFFFFFFFFFFFFFFFF) >> 32
+        return fp, (mixed % self.buckets) * self._bucket.size
+
+    def add(self, key):
+        fp, pos = self._locate(key)
+        a, b = self._bucket.unpack_from(self._shm, pos)
+        if fp != a and fp != b:
+            self._bucket.pack_into(self._shm, pos, fp, a)
+
+    def __contains__(self, key):
+        fp, pos = self._locate(key)
+        return fp in self._bucket.unpack_from(self._shm, pos)
@@ -6,17 +6,29 @@
 
 #define OP_QLIST_ADD 0xF0
 #define OP_QLIST_DEL 0xF1
+#define OP_QLIST_QUERY 0xF2
+#define OP_QLIST_MULTI 0xF3
 
 #define FLAG_QLIST (0x04)
-#define EMPTY_QLIST_SIZE 10
+#define EMPTY_QLIST_SIZE 14
+#define QLIST_FMT_TAILED 0x10
 
 /* qlist.c */
 int qlist_or(uint8_t *qpc_start, int qpc_sz, uint8_t *qpa, uint8_t *qpb);
 int qlist_and(uint8_t *qpc_start, int qpc_sz, uint8_t *qpa, uint8_t *qpb);
 int qlist_andnot(uint8_t *qpc_start, int qpc_sz, uint8_t *qpa, uint8_t *qpb);
+int qlist_and_many(uint8_t *qpc_start, int qpc_sz, int format,
+		   uint8_t **qps, int qps_n, uint8_t **nots, int nots_n,
+		   int limit, int reverse);
+int qlist_or_many(uint8_t *qpc_start, int qpc_sz, int format,
+		  uint8_t **qps, int qps_n, int limit, int reverse);
+int qlist_append(uint8_t *qpa, int qpa_len, int qpa_sz, uint8_t *qpb);
 
-int qlist_pack(uint8_t *qbuf_start, int qbuf_sz, uint64_t *items, int items_sz);
+int qlist_format(uint8_t *qbuf);
+int qlist_pack(uint8_t *qbuf_start, int qbuf_sz, uint64_t *items, int items_sz, int format);
 int qlist_unpack(uint64_t *items_start, int items_sz,  uint8_t *qbuf);
+int qlist_count(uint8_t *qbuf);
+int qlist_is_empty(uint8_t *qbuf);
 
 
 extern uint64_t unique_number;
@@ -25,57 +37,110 @@ uint8_t buf_a[MAX_VALUE_SIZE];
 uint8_t buf_b[MAX_VALUE_SIZE];
 
 /*
-   Request:
-      MUST NOT have extras.
-      MUST have key.
-      MUST have value.
-   Ignore CAS.
+	Adds the items of qlb to the list under the key. Lists are stored
+	with the tailed header. Docids usually grow, when all the new ones
+	are above the stored list they are appended without decoding it,
+	otherwise both lists are merged. Returns a MEMCACHE_STATUS.
 */
-ST_RES *cmd_qlist_add(ST_REQ *req, ST_RES *res) {
-	if(req->extras_sz || !req->key_sz || !req->value_sz) {
-		return(set_error_code(res, MEMCACHE_STATUS_INVALID_ARGUMENTS));
-	}
+static int qlist_add_key(char *key, int key_sz, uint8_t *qlb, uint64_t *cas) {
 	MC_METADATA md;
 	memset(&md, 0, sizeof(md));
 
 	uint8_t *qla = buf_a;
 	int qla_sz = sizeof(buf_a);
-	uint8_t *qlb = (uint8_t *)req->value;
 	uint8_t *qlc = buf_b;
 	int qlc_sz = sizeof(buf_b);
 	
-	int r = storage_get(&md, (char*)qla, qla_sz, req->key, req->key_sz);
+	int r = storage_get(&md, (char*)qla, qla_sz, key, key_sz);
 	if(r < 0){
-		r = qlist_pack(qla, qla_sz, NULL, 0);
-		if(r < 0) {
-			set_error_code(res, MEMCACHE_STATUS_ITEM_NOT_STORED);
-			goto exit;
-		}
+		/* New lists are created in the format of the incoming one. */
+		int format = qlist_format(qlb);
+		if(format < 0)
+			return(MEMCACHE_STATUS_INVALID_ARGUMENTS);
+		r = qlist_pack(qla, qla_sz, NULL, 0, format | QLIST_FMT_TAILED);
+		if(r < 0)
+			return(MEMCACHE_STATUS_ITEM_NOT_STORED);
 		md.flags = FLAG_QLIST;
 		md.cas = ++unique_number || ++unique_number;
 	}
 
-	if( (md.flags & FLAG_QLIST) == 0) {
-		set_error_code(res, MEMCACHE_STATUS_ITEM_NOT_STORED);
-		goto exit;
-	}
+	if( (md.flags & FLAG_QLIST) == 0)
+		return(MEMCACHE_STATUS_ITEM_NOT_STORED);
 	
-	r = qlist_or(qlc, qlc_sz, qla, qlb);
-	if(r < 0) {
-		set_error_code(res, MEMCACHE_STATUS_ITEM_NOT_STORED);
-		goto exit;
+	r = qlist_append(qla, r, qla_sz, qlb);
+	if(r == -3) {
+		uint8_t *qps[] = {qla, qlb};
+		r = qlist_or_many(qlc, qlc_sz, qlist_format(qla) | QLIST_FMT_TAILED,
+				  qps, 2, 0, 0);
+		qla = qlc;
 	}
+	if(r < 0)
+		return(MEMCACHE_STATUS_ITEM_NOT_STORED);
 	
 	md.cas = (md.cas+1) || (md.cas+2);
-	r = storage_set(&md, (char*)qlc, r, req->key, req->key_sz);
+	r = storage_set(&md, (char*)qla, r, key, key_sz);
+	if(r < 0)
+		return(MEMCACHE_STATUS_ITEM_NOT_STORED);
+	*cas = md.cas;
+	return(MEMCACHE_STATUS_OK);
+}
+
+/*
+	Removes the items of qlb from the list under the key, an emptied
+	list is deleted. Returns a MEMCACHE_STATUS.
+*/
+static int qlist_del_key(char *key, int key_sz, uint8_t *qlb, uint64_t *cas) {
+	MC_METADATA md;
+	memset(&md, 0, sizeof(md));
+
+	uint8_t *qla = buf_a;
+	int qla_sz = sizeof(buf_a);
+	uint8_t *qlc = buf_b;
+	int qlc_sz = sizeof(buf_b);
+
+	int r = storage_get(&md, (char*)qla, qla_sz, key, key_sz);
 	if(r < 0) {
-		set_error_code(res, MEMCACHE_STATUS_ITEM_NOT_STORED);
-		goto exit;
+		*cas = 0;
+		return(MEMCACHE_STATUS_OK);
 	}
+		
+	if( (md.flags & FLAG_QLIST) == 0)
+		return(MEMCACHE_STATUS_ITEM_NOT_STORED);
+	
+	uint8_t *qps[] = {qla};
+	r = qlist_and_many(qlc, qlc_sz, qlist_format(qla) | QLIST_FMT_TAILED,
+			   qps, 1, &qlb, 1, 0, 0);
+	if(r < 0)
+		return(MEMCACHE_STATUS_ITEM_NOT_STORED);
+	
+	if(qlist_is_empty(qlc)) {
+		storage_delete(key, key_sz);
+	}else{
+		md.cas = (md.cas+1) || (md.cas+2);
+		r = storage_set(&md, (char*)qlc, r, key, key_sz);
+		if(r < 0)
+			return(MEMCACHE_STATUS_ITEM_NOT_STORED);
+	}
+	*cas = md.cas;
+	return(MEMCACHE_STATUS_OK);
+}
 
+/*
+   Request:
+      MUST NOT have extras.
+      MUST have key.
+      MUST have value.
+   Ignore CAS.
+*/
+ST_RES *cmd_qlist_add(ST_REQ *req, ST_RES *res) {
+	if(req->extras_sz || !req->key_sz || !req->value_sz)
+		return(set_error_code(res, MEMCACHE_STATUS_INVALID_ARGUMENTS));
+	uint64_t cas = 0;
+	int status = qlist_add_key(req->key, req->key_sz, (uint8_t *)req->value, &cas);
+	if(status != MEMCACHE_STATUS_OK)
+		return(set_error_code(res, status));
 	res->status = MEMCACHE_STATUS_OK;
-	res->cas = md.cas;
-exit:
+	res->cas = cas;
 	return(res);
 }
 
@@ -89,49 +154,388 @@ exit:
 ST_RES *cmd_qlist_del(ST_REQ *req, ST_RES *res) {
 	if(req->extras_sz || !req->key_sz || !req->value_sz)
 		return(set_error_code(res, MEMCACHE_STATUS_INVALID_ARGUMENTS));
-	
-	MC_METADATA md;
-	memset(&md, 0, sizeof(md));
+	uint64_t cas = 0;
+	int status = qlist_del_key(req->key, req->key_sz, (uint8_t *)req->value, &cas);
+	if(status != MEMCACHE_STATUS_OK)
+		return(set_error_code(res, status));
+	res->status = MEMCACHE_STATUS_OK;
+	res->cas = cas;
+	return(res);
+}
 
-	uint8_t *qla = buf_a;
-	int qla_sz = sizeof(buf_a);
-	uint8_t *qlb = (uint8_t *)req->value;
-	uint8_t *qlc = buf_b;
-	int qlc_sz = sizeof(buf_b);
+#define MULTI_ENTRY_HDR 6
+#define MULTI_MAX_ERRORS 1024
 
-	int r = storage_get(&md, (char*)qla, qla_sz, req->key, req->key_sz);
-	if(r < 0)
-		goto exit_ok;
-		
-	if( (md.flags & FLAG_QLIST) == 0) {
+static uint8_t multi_extras[4];
+static uint8_t multi_errors[MULTI_MAX_ERRORS * 6];
+
+/*
+   Request:
+      MUST NOT have extras.
+      MUST have value: entries [op:1] [key_sz:1] [value_sz:4] [key] [value]
+         (network order, op 0 is add, 1 is del), applied in order.
+   Response:
+      extras: failed:4, the number of entries that failed.
+      value: [index:4] [status:2] of the first MULTI_MAX_ERRORS failed
+         entries.
+
+   One request instead of a quiet add or del per key. A malformed entry
+   fails the whole request, the entries before it are already applied.
+*/
+ST_RES *cmd_qlist_multi(ST_REQ *req, ST_RES *res) {
+	if(req->extras_sz || !req->value_sz)
+		return(set_error_code(res, MEMCACHE_STATUS_INVALID_ARGUMENTS));
+
+	uint8_t *p = (uint8_t *)req->value;
+	uint8_t *end = p + req->value_sz;
+	uint32_t index = 0;
+	uint32_t failed = 0;
+	int i;
+	while(p < end) {
+		if(end - p < MULTI_ENTRY_HDR)
+			return(set_error_code(res, MEMCACHE_STATUS_INVALID_ARGUMENTS));
+		int op = p[0];
+		int key_sz = p[1];
+		uint32_t value_sz = 0;
+		for(i = 0; i < 4; i++)
+			value_sz = (value_sz << 8) | p[2+i];
+		p += MULTI_ENTRY_HDR;
+		if(op > 1 || !key_sz || !value_sz || end - p < key_sz ||
+		   (uint32_t)(end - p - key_sz) < value_sz)
+			return(set_error_code(res, MEMCACHE_STATUS_INVALID_ARGUMENTS));
+		char *key = (char *)p;
+		uint8_t *qlb = p + key_sz;
+		p += key_sz + value_sz;
+
+		uint64_t cas;
+		int status;
+		if(op == 0)
+			status = qlist_add_key(key, key_sz, qlb, &cas);
+		else
+			status = qlist_del_key(key, key_sz, qlb, &cas);
+		if(status != MEMCACHE_STATUS_OK) {
+			if(failed < MULTI_MAX_ERRORS) {
+				uint8_t *e = &multi_errors[failed * 6];
+				for(i = 0; i < 4; i++)
+					e[i] = (index >> (24 - 8*i)) & 0xFF;
+				e[4] = (status >> 8) & 0xFF;
+				e[5] = status & 0xFF;
+			}
+			failed++;
+		}
+		index++;
+	}
+
+	for(i = 0; i < 4; i++)
+		multi_extras[i] = (failed >> (24 - 8*i)) & 0xFF;
+	res->extras = (char *)multi_extras;
+	res->extras_sz = sizeof(multi_extras);
+	res->value = (char *)multi_errors;
+	res->value_sz = (failed < MULTI_MAX_ERRORS ? failed : MULTI_MAX_ERRORS) * 6;
+	res->status = MEMCACHE_STATUS_OK;
+	return(res);
+}
+
+#define QUERY_MAX_DEPTH 32
+#define QUERY_MAX_TOKENS 256
+#define QUERY_EXTRAS_SIZE 24
+
+enum {
+	QUERY_TERM,
+	QUERY_AND,
+	QUERY_OR,
+	QUERY_ANDNOT,
+};
+
+struct query_token {
+	int op;
+	char *term;
+	int term_sz;
+};
+
+/* Operand stack, the last buffer is a spare one for results. */
+static uint8_t *query_stack[QUERY_MAX_DEPTH + 1];
+static int query_stack_sz[QUERY_MAX_DEPTH + 1];
+static uint8_t query_extras[12];
+
+static int query_buffers_init(void) {
+	int i;
+	for(i = 0; i < QUERY_MAX_DEPTH + 1; i++) {
+		if(query_stack[i] == NULL)
+			query_stack[i] = malloc(MAX_VALUE_SIZE);
+		if(query_stack[i] == NULL)
+			return(-1);
+	}
+	return(0);
+}
+
+static int query_op(char *s, int sz) {
+	if(sz == 3 && 0 == memcmp(s, "AND", 3))
+		return(QUERY_AND);
+	if(sz == 2 && 0 == memcmp(s, "OR", 2))
+		return(QUERY_OR);
+	if(sz == 6 && 0 == memcmp(s, "ANDNOT", 6))
+		return(QUERY_ANDNOT);
+	return(QUERY_TERM);
+}
+
+/*
+	Query is a newline separated RPN, same as parsetorpn produces.
+	-1: malformed query
+*/
+static int query_parse(struct query_token *tokens, char *value, int value_sz) {
+	int tokens_n = 0;
+	int depth = 0;
+	char *end = value + value_sz;
+	while(value < end) {
+		char *nl = memchr(value, '\n', end - value);
+		if(nl == NULL)
+			nl = end;
+		if(nl == value || tokens_n == QUERY_MAX_TOKENS)
+			return(-1);
+		struct query_token *t = &tokens[tokens_n++];
+		t->op = query_op(value, nl - value);
+		t->term = value;
+		t->term_sz = nl - value;
+		if(t->op == QUERY_TERM) {
+			if(++depth > QUERY_MAX_DEPTH)
+				return(-1);
+		} else {
+			if(--depth < 1)
+				return(-1);
+		}
+		value = nl + 1;
+	}
+	if(depth != 1)
+		return(-1);
+	return(tokens_n);
+}
+
+/*
+	Evaluates the query on a single chunk, result ends in query_stack[0].
+	Meta chunks can't exclude anything, ANDNOT keeps its left operand.
+	With count set the result is only counted, the last operation
+	doesn't encode anything and query_stack[0] is undefined. With limit
+	set the last operation stops after the first limit items, the last
+	ones with reverse.
+	-1: result too big
+*/
+static int query_execute(struct query_token *tokens, int tokens_n,
+			 char *prefix, int prefix_sz, char *chunk, int meta,
+			 int *count, int limit, int reverse) {
+	int sp = 0;
+	int i;
+	for(i = 0; i < tokens_n; i++) {
+		struct query_token *t = &tokens[i];
+		if(t->op == QUERY_TERM) {
+			char key[256];
+			int key_sz = snprintf(key, sizeof(key), "%.*s%.*s:%s",
+					prefix_sz, prefix, t->term_sz, t->term, chunk);
+			MC_METADATA md;
+			memset(&md, 0, sizeof(md));
+			int r = -1;
+			/* Too long keys are never stored, see Sender. */
+			if(key_sz < (int)sizeof(key))
+				r = storage_get(&md, (char*)query_stack[sp], MAX_VALUE_SIZE, key, key_sz);
+			if(r < 0 || (md.flags & FLAG_QLIST) == 0)
+				r = qlist_pack(query_stack[sp], MAX_VALUE_SIZE, NULL, 0, 0);
+			query_stack_sz[sp++] = r;
+			continue;
+		}
+
+		uint8_t *qla = query_stack[sp-2];
+		uint8_t *qlb = query_stack[sp-1];
+		uint8_t *qlc = query_stack[QUERY_MAX_DEPTH];
+		int counting = count && i == tokens_n - 1;
+		int limited = limit > 0 && !count && i == tokens_n - 1;
+		if(counting)
+			qlc = NULL;
+		uint8_t *qps[] = {qla, qlb};
+		int r;
+		switch(t->op) {
+		case QUERY_AND:
+			if(limited)
+				r = qlist_and_many(qlc, MAX_VALUE_SIZE, qlist_format(qla),
+						   qps, 2, NULL, 0, limit, reverse);
+			else
+				r = qlist_and(qlc, MAX_VALUE_SIZE, qla, qlb);
+			break;
+		case QUERY_OR:
+			if(limited)
+				r = qlist_or_many(qlc, MAX_VALUE_SIZE, qlist_format(qla),
+						  qps, 2, limit, reverse);
+			else
+				r = qlist_or(qlc, MAX_VALUE_SIZE, qla, qlb);
+			break;
+		default: /* QUERY_ANDNOT */
+			if(meta) {
+				sp--;
+				continue;
+			}
+			if(limited)
+				r = qlist_and_many(qlc, MAX_VALUE_SIZE, qlist_format(qla),
+						   qps, 1, &qps[1], 1, limit, reverse);
+			else
+				r = qlist_andnot(qlc, MAX_VALUE_SIZE, qla, qlb);
+			break;
+		}
+		if(r < 0)
+			return(-1);
+		if(counting) {
+			*count = r;
+			return(0);
+		}
+		query_stack[sp-2] = qlc;
+		query_stack_sz[sp-2] = r;
+		query_stack[QUERY_MAX_DEPTH] = qla;
+		sp--;
+	}
+	if(tokens_n == 1 && limit > 0 && !count) {
+		/* A single term, the top node is the term itself. */
+		uint8_t *qlc = query_stack[QUERY_MAX_DEPTH];
+		int r = qlist_or_many(qlc, MAX_VALUE_SIZE, qlist_format(query_stack[0]),
+				      query_stack, 1, limit, reverse);
+		if(r < 0)
+			return(-1);
+		query_stack[QUERY_MAX_DEPTH] = query_stack[0];
+		query_stack[0] = qlc;
+		query_stack_sz[0] = r;
+	}
+	if(count)
+		*count = qlist_count(query_stack[0]);
+	return(query_stack_sz[0]);
+}
+
+/*
+   Request:
+      MUST have extras: chunk_from:8 chunk_to:8 limit:4 flags:4
+         (network order, limit 0 means no limit, flags bit 0 is reverse,
+         bit 1 is count only).
+      MUST have key: the key prefix, that is "namespace:".
+      MUST have value: the query, newline separated RPN.
+   Response:
+      extras: chunks_total:4 chunks_searched:4 items:4
+      value: qlist with docids from the searched chunks, empty when
+         only counting.
+
+   Like Searcher.query, the meta query selects chunks and they are
+   searched one by one. Each chunk is evaluated up to the items still
+   missing, so the top operation stops as soon as the limit is reached.
+   Counting ignores the limit, every chunk is searched and items is
+   exact.
+*/
+ST_RES *cmd_qlist_query(ST_REQ *req, ST_RES *res) {
+	if(req->extras_sz != QUERY_EXTRAS_SIZE || !req->key_sz || !req->value_sz)
+		return(set_error_code(res, MEMCACHE_STATUS_INVALID_ARGUMENTS));
+
+	uint8_t *ex = (uint8_t *)req->extras;
+	uint64_t chunk_from = 0;
+	uint64_t chunk_to = 0;
+	uint32_t limit = 0;
+	uint32_t flags = 0;
+	int i;
+	for(i = 0; i < 8; i++) {
+		chunk_from = (chunk_from << 8) | ex[i];
+		chunk_to = (chunk_to << 8) | ex[8+i];
+	}
+	for(i = 0; i < 4; i++) {
+		limit = (limit << 8) | ex[16+i];
+		flags = (flags << 8) | ex[20+i];
+	}
+	int reverse = flags & 1;
+	int count_only = flags & 2;
+
+	struct query_token tokens[QUERY_MAX_TOKENS];
+	int tokens_n = query_parse(tokens, req->value, req->value_sz);
+	if(tokens_n < 0)
+		return(set_error_code(res, MEMCACHE_STATUS_INVALID_ARGUMENTS));
+	if(query_buffers_init() < 0)
+		return(set_error_code(res, MEMCACHE_STATUS_ITEM_NOT_STORED));
+
+	uint64_t *chunks = NULL;
+	int r = query_execute(tokens, tokens_n, req->key, req->key_sz, "meta", 1,
+			      NULL, 0, 0);
+	if(r < 0) {
 		set_error_code(res, MEMCACHE_STATUS_ITEM_NOT_STORED);
 		goto exit;
 	}
-	
-	r = qlist_andnot(qlc, qlc_sz, qla, qlb);
-	
-	if(r == EMPTY_QLIST_SIZE) {
-		storage_delete(req->key, req->key_sz);
-	}else{
-		md.cas = (md.cas+1) || (md.cas+2);
-		r = storage_set(&md, (char*)qlc, r, req->key, req->key_sz);
+	/* Every item takes at least one byte. */
+	chunks = malloc(sizeof(uint64_t) * r);
+	if(chunks == NULL) {
+		set_error_code(res, MEMCACHE_STATUS_ITEM_NOT_STORED);
+		goto exit;
+	}
+	int chunks_n = qlist_unpack(chunks, r, query_stack[0]);
+	int chunks_total = 0;
+	for(i = 0; i < chunks_n; i++) {
+		if(chunks[i] >= chunk_from && chunks[i] <= chunk_to)
+			chunks[chunks_total++] = chunks[i];
+	}
+
+	uint8_t *acc = buf_a;
+	uint8_t *tmp = buf_b;
+	int acc_sz = qlist_pack(acc, sizeof(buf_a), NULL, 0, 0);
+	int chunks_searched = 0;
+	uint32_t found = 0;
+	for(i = 0; i < chunks_total; i++) {
+		char chunk[32];
+		uint64_t chunk_no = chunks[reverse ? chunks_total - 1 - i : i];
+		snprintf(chunk, sizeof(chunk), "%llu", (unsigned long long)chunk_no);
+		int items = 0;
+		r = query_execute(tokens, tokens_n, req->key, req->key_sz, chunk, 0,
+				  count_only ? &items : NULL,
+				  limit ? limit - found : 0, reverse);
 		if(r < 0) {
 			set_error_code(res, MEMCACHE_STATUS_ITEM_NOT_STORED);
 			goto exit;
 		}
+		chunks_searched++;
+		if(count_only) {
+			found += items;
+			continue;
+		}
+		if(qlist_is_empty(query_stack[0]))
+			continue;
+		/* Chunks don't overlap, OR just concatenates them. */
+		if(acc_sz == EMPTY_QLIST_SIZE) {
+			memcpy(acc, query_stack[0], r);
+			acc_sz = r;
+		} else {
+			acc_sz = qlist_or(tmp, sizeof(buf_b), acc, query_stack[0]);
+			if(acc_sz < 0) {
+				set_error_code(res, MEMCACHE_STATUS_ITEM_NOT_STORED);
+				goto exit;
+			}
+			uint8_t *swap = acc;
+			acc = tmp;
+			tmp = swap;
+		}
+		found += qlist_count(query_stack[0]);
+		if(limit && found >= limit)
+			break;
 	}
 
-exit_ok:
+	for(i = 0; i < 4; i++) {
+		query_extras[i] = (chunks_total >> (24 - 8*i)) & 0xFF;
+		query_extras[4+i] = (chunks_searched >> (24 - 8*i)) & 0xFF;
+		query_extras[8+i] = (found >> (24 - 8*i)) & 0xFF;
+	}
+	res->extras = (char *)query_extras;
+	res->extras_sz = sizeof(query_extras);
+	res->value = (char *)acc;
+	res->value_sz = acc_sz;
 	res->status = MEMCACHE_STATUS_OK;
-	res->cas = md.cas;
 exit:
+	free(chunks);
 	return(res);
 }
 
 
 struct commands_pointers commands_pointers[] = {
 	[OP_QLIST_ADD]	{&cmd_qlist_add, CMD_FLAG_PREFETCH},
-	[OP_QLIST_DEL]	{&cmd_qlist_del, CMD_FLAG_PREFETCH}
+	[OP_QLIST_DEL]	{&cmd_qlist_del, CMD_FLAG_PREFETCH},
+	[OP_QLIST_QUERY]	{&cmd_qlist_query, 0},
+	[OP_QLIST_MULTI]	{&cmd_qlist_multi, 0}
 };
 
 int main(int argc, char **argv) {
@@ -0,0 +1,61 @@
+'''
+Opcodes and payloads of the qlist plugin, shared by the blocking
+QListClient and the non-blocking AsyncQListClient.
+
+>>> vs = list(multi_values([(MULTI_ADD, 'k', 'ab'), (MULTI_DEL, 'kk', 'c')], 12))
+>>> [(i, v.encode('hex')) for i, v in vs]
+[(0, '0001000000026b6162'), (1, '0102000000016b6b63')]
+'''
+import struct
+
+OP_QLIST_ADD=0xF0
+OP_QLIST_DEL=0xF1
+OP_QLIST_QUERY=0xF2
+OP_QLIST_MULTI=0xF3
+
+FLAG_QLIST=0x04
+
+# OP_QLIST_QUERY flags
+QUERY_REVERSE=0x01
+QUERY_COUNT=0x02
+
+# OP_QLIST_MULTI entry ops
+MULTI_ADD=0
+MULTI_DEL=1
+# Values of OP_QLIST_MULTI requests are split at this size.
+MULTI_MAX_BYTES=512*1024
+
+def multi_values(entries, max_bytes=MULTI_MAX_BYTES):
+    '''
+    Packs (op, key, qbuf) entries into OP_QLIST_MULTI values, yields
+    (index of the first entry, value). An entry bigger than max_bytes
+    goes alone.
+    '''
+    parts = []
+    size = 0
+    first = 0
+    for i, (op, key, value) in enumerate(entries):
+        entry = struct.pack('!BBI', op, len(key), len(value)) + key + value
+        if parts and size + len(entry) > max_bytes:
+            yield (first, ''.join(parts))
+            parts, size, first = [], 0, i
+        parts.append(entry)
+        size += len(entry)
+    if parts:
+        yield (first, ''.join(parts))
+
+def query_extras(chunk_from, chunk_to, limit, flags):
+    return struct.pack('!QQII', chunk_from, chunk_to, limit, flags)
+
+def multi_failure(extras, value):
+    '''
+    None if every entry of an OP_QLIST_MULTI request succeeded, otherwise
+    (index, status) of the first failed one.
+
+    >>> multi_failure('\\0\\0\\0\\0', ''), multi_failure('\\0\\0\\0\\2', '\\0\\0\\0\\3\\0\\5')
+    (None, (3, 5))
+    '''
+    failed, = struct.unpack('!I', extras)
+    if not failed:
+        return None
+    return struct.unpack('!IH', value[:6])
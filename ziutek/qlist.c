@@ -3,6 +3,7 @@ Included both from backdend and python. Beware on dependencies.
 */
 #include <stdlib.h>
 #include <stdint.h>
+#include <string.h>
 
 #ifndef likely
 #define likely(x)	__builtin_expect(!!(x), 1)
@@ -17,6 +18,162 @@ Included both from backdend and python. Beware on dependencies.
 #endif
 
 #define QLIST_MAGIC 0xDEADBEEFDEADBAAFLL
+#define QLIST_MAGIC_BLOCKS 0xDEADBEEFDEADBAB1LL
+#define QLIST_MAGIC_SVB 0xDEADBEEFDEADBAB3LL
+
+#define QLIST_FMT_PLAIN 0
+#define QLIST_FMT_BLOCKS 1
+#define QLIST_FMT_SVB 2
+
+/*
+Counted header: the magic is QLIST_MAGIC_COUNTED plus the format and it
+is followed by the number of items, 4 bytes big endian, so the size of
+a list is known without touching the body. Every list is written with
+it, lists with the old magics above are still read.
+*/
+#define QLIST_MAGIC_COUNTED 0xDEADBEEFDEADBAC0LL
+#define QLIST_HDR_COUNTED 13
+
+/*
+Tailed header: the counted header with QLIST_MAGIC_TAILED plus the format
+as the magic, followed by the last item (8 bytes) and the tail offset
+(4 bytes), both big endian. The tail is where an append continues: the
+stop byte in the plain format, the header of the last block (0 if there
+are no blocks) in the blocks formats. Writers emit it when the format
+is or-ed with QLIST_FMT_TAILED, qlist_append extends such lists in
+place.
+*/
+#define QLIST_MAGIC_TAILED 0xDEADBEEFDEADBAD0LL
+#define QLIST_HDR_TAILED 25
+#define QLIST_FMT_TAILED 0x10
+
+/*
+Blocks format: after the magic there is a sequence of blocks, each
+starting with a fixed size header:
+	[n_items:1] [body_sz:2] [last_item:8]
+followed by body_sz bytes of deltas. The first delta in a block is
+relative to the last item of the previous block. A header with n_items
+equal to zero terminates the list (it's the same stop byte as in the
+plain format). Readers can jump over blocks that end below the item
+they're looking for without decoding a single delta.
+*/
+#define QLIST_BLOCK_HDR 11
+#define QLIST_BLOCK_ITEMS 128
+
+/*
+Stream VByte format: the same blocks and headers as above, but the body
+is Stream VByte coded - (n_items+3)/4 control bytes, two bits per delta
+telling its length (1-4 bytes), followed by the little endian delta
+bytes. Lengths of four deltas are known from a single control byte, so
+they can be decoded with one SSSE3 shuffle, no branch per item.
+A delta that doesn't fit into 32 bits gets a block of its own with
+n_items equal to one and an empty body, the item is in the header.
+*/
+#define QLIST_SVB_CTRL ((QLIST_BLOCK_ITEMS + 3) / 4)
+
+static uint8_t qlist_svb_lengths[256];
+static uint8_t qlist_svb_shuffle[256][16];
+static int qlist_svb_have_ssse3;
+
+static void __attribute__((constructor)) qlist_svb_init(void) {
+	int c, i, j;
+	for(c = 0; c < 256; c++) {
+		int pos = 0;
+		for(i = 0; i < 4; i++) {
+			int len = ((c >> (i * 2)) & 3) + 1;
+			for(j = 0; j < 4; j++)
+				qlist_svb_shuffle[c][i*4 + j] = j < len ? pos + j : 0xFF;
+			pos += len;
+		}
+		qlist_svb_lengths[c] = pos;
+	}
+#if defined(__x86_64__) && defined(__GNUC__)
+	__builtin_cpu_init();
+	qlist_svb_have_ssse3 = __builtin_cpu_supports("ssse3");
+#endif
+}
+
+static inline int qlist_svb_code(uint32_t delta) {
+	return (delta > 0xFF) + (delta > 0xFFFF) + (delta > 0xFFFFFF);
+}
+
+/*
+	Up to three bytes past the delta are overwritten, the writer has the
+	slack. Returns the length code.
+*/
+static inline int qlist_svb_put_delta(uint8_t *data, uint32_t v) {
+#if __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__
+	memcpy(data, &v, 4);
+#else
+	data[0] = (v >> 0) & 0xFF;
+	data[1] = (v >> 8) & 0xFF;
+	data[2] = (v >> 16) & 0xFF;
+	data[3] = (v >> 24) & 0xFF;
+#endif
+	return(qlist_svb_code(v));
+}
+
+#if defined(__x86_64__) && defined(__GNUC__)
+#include <tmmintrin.h>
+
+/*
+	Four deltas per step, the prefix sum is done in 64 bit lanes. Every
+	load reads 16 bytes, so the last groups that are too close to the
+	end of the body go through the scalar path. Returns the number of
+	items decoded, *data and *base are moved past them.
+*/
+static int __attribute__((target("ssse3")))
+qlist_svb_decode_ssse3(uint64_t *out, int n, uint8_t *ctrl, uint8_t **data_ptr,
+		       uint8_t *end, uint64_t *base_ptr) {
+	uint8_t *data = *data_ptr;
+	__m128i base = _mm_set1_epi64x(*base_ptr);
+	__m128i zero = _mm_setzero_si128();
+	int i;
+	for(i = 0; i + 4 <= n && data + 16 <= end; i += 4) {
+		uint8_t c = ctrl[i >> 2];
+		__m128i v = _mm_loadu_si128((__m128i *)data);
+		v = _mm_shuffle_epi8(v, _mm_loadu_si128((__m128i *)qlist_svb_shuffle[c]));
+		data += qlist_svb_lengths[c];
+		__m128i lo = _mm_unpacklo_epi32(v, zero);	/* d0 d1 */
+		__m128i hi = _mm_unpackhi_epi32(v, zero);	/* d2 d3 */
+		lo = _mm_add_epi64(lo, _mm_slli_si128(lo, 8));	/* d0 d0+d1 */
+		hi = _mm_add_epi64(hi, _mm_slli_si128(hi, 8));
+		lo = _mm_add_epi64(lo, base);
+		base = _mm_shuffle_epi32(lo, _MM_SHUFFLE(3, 2, 3, 2));
+		hi = _mm_add_epi64(hi, base);
+		base = _mm_shuffle_epi32(hi, _MM_SHUFFLE(3, 2, 3, 2));
+		_mm_storeu_si128((__m128i *)&out[i], lo);
+		_mm_storeu_si128((__m128i *)&out[i + 2], hi);
+	}
+	*data_ptr = data;
+	*base_ptr = _mm_cvtsi128_si64(base);
+	return(i);
+}
+#endif
+
+/*
+	Decodes the body of a block with n items, base is the last item of
+	the previous block. Returns the last item.
+*/
+static uint64_t qlist_svb_decode(uint64_t *out, uint64_t base, int n, uint8_t *body, uint8_t *end) {
+	uint8_t *data = body + (n + 3) / 4;
+	int i = 0;
+#if defined(__x86_64__) && defined(__GNUC__)
+	if(likely(qlist_svb_have_ssse3))
+		i = qlist_svb_decode_ssse3(out, n, body, &data, end, &base);
+#endif
+	for(; i < n; i++) {
+		int code = (body[i >> 2] >> ((i & 3) * 2)) & 3;
+		uint32_t v = data[0];
+		if(code > 0) v |= (uint32_t)data[1] << 8;
+		if(code > 1) v |= (uint32_t)data[2] << 16;
+		if(code > 2) v |= (uint32_t)data[3] << 24;
+		data += code + 1;
+		base += v;
+		out[i] = base;
+	}
+	return(base);
+}
 
 
 static inline int qlist_put_delta(uint8_t *buf, uint64_t delta) {
@@ -51,44 +208,6 @@ static inline int qlist_put_stop(uint8_t *buf) {
 	return(1);
 }
 
-/*
-	-1: qbuf_sz too small
-	-2: not sorted
-*/
-int qlist_pack(uint8_t *qbuf_start, int qbuf_sz, uint64_t *items_start, int items_sz) {
-	/* We might have 9 bytes overcommit, assume the bufffer is smaller. */
-	qbuf_sz -= 9;
-	if(qbuf_sz < 0)
-		return(-1);
-
-	uint8_t *qbuf = qbuf_start;
-	uint8_t *qbuf_end = qbuf + qbuf_sz;
-	uint64_t *items = items_start;
-	uint64_t *items_end = items + items_sz;
-
-	qbuf += qlist_put_delta(qbuf, QLIST_MAGIC);
-	if(unlikely(qbuf >= qbuf_end))
-		return(-1);
-
-	uint64_t last_item = 0;
-	uint64_t delta;
-	while(items < items_end) {
-		if(unlikely(*items < last_item)) /* unsorted? */
-			return(-2);
-		delta = *items - last_item;
-		last_item = *items;
-		items++;
-		if(unlikely(0 == delta && (items-1) != items_start))
-			continue;
-		qbuf += qlist_put_delta(qbuf, delta);
-		if(unlikely(qbuf >= qbuf_end))
-			return(-1);
-	}
-	qbuf += qlist_put_stop(qbuf);
-	
-	return(qbuf - qbuf_start);
-}
-
 static inline int qlist_get_delta(uint8_t **qbuf, uint64_t *delta_ptr) {
 	uint8_t *buf = *qbuf;
 	
@@ -146,94 +265,791 @@ static inline int qlist_get_item(uint8_t **qbuf, uint64_t *last_item_ptr) {
 		(d);					\
 	})
 
+/*
+static inline int qlist_put_item(uint8_t *qbuf, uint64_t *last_item, uint64_t item) {
+	uint64_t delta = item - *last_item;
+	*last_item = item;
+	return(qlist_put_delta(qbuf, delta));
+}
+*/
+#define qlist_put_item(qbuf, last_item, item) 		\
+	({						\
+		uint64_t delta = item - *last_item;	\
+		*last_item = item;			\
+		(qlist_put_delta(qbuf, delta));		\
+	})
+
+/*
+	Sequential reader, hides the differences between formats.
+*/
+struct qlist_reader {
+	uint8_t *qbuf;		/* next byte to decode */
+	uint64_t item;		/* current item */
+	int format;
+	int count;		/* from the header, -1 if it's not there */
+	/* QLIST_FMT_BLOCKS and QLIST_FMT_SVB */
+	int block_left;		/* items in the block not yet decoded */
+	uint64_t block_last;	/* last item in the block */
+	uint8_t *block_end;	/* first byte after the block */
+	/* QLIST_FMT_SVB */
+	uint64_t *svb_end;	/* after the decoded items, NULL if not decoded */
+	uint64_t svb_items[QLIST_BLOCK_ITEMS];
+};
+
+static inline uint64_t qlist_get_u64(uint8_t *buf) {
+	return	((uint64_t)buf[0] << 56) | ((uint64_t)buf[1] << 48) |
+		((uint64_t)buf[2] << 40) | ((uint64_t)buf[3] << 32) |
+		((uint64_t)buf[4] << 24) | ((uint64_t)buf[5] << 16) |
+		((uint64_t)buf[6] << 8)  | ((uint64_t)buf[7] << 0);
+}
+
+static inline void qlist_put_u64(uint8_t *buf, uint64_t v) {
+	buf[0] = (v >> 56) & 0xFF;
+	buf[1] = (v >> 48) & 0xFF;
+	buf[2] = (v >> 40) & 0xFF;
+	buf[3] = (v >> 32) & 0xFF;
+	buf[4] = (v >> 24) & 0xFF;
+	buf[5] = (v >> 16) & 0xFF;
+	buf[6] = (v >> 8) & 0xFF;
+	buf[7] = (v >> 0) & 0xFF;
+}
+
+static inline uint32_t qlist_get_u32(uint8_t *buf) {
+	return	((uint32_t)buf[0] << 24) | ((uint32_t)buf[1] << 16) |
+		((uint32_t)buf[2] << 8)  | ((uint32_t)buf[3] << 0);
+}
+
+static inline void qlist_put_u32(uint8_t *buf, uint32_t v) {
+	buf[0] = (v >> 24) & 0xFF;
+	buf[1] = (v >> 16) & 0xFF;
+	buf[2] = (v >> 8) & 0xFF;
+	buf[3] = (v >> 0) & 0xFF;
+}
+
+/*
+	Returns the header size, *count is set to the number of items or to
+	-1 if the header doesn't have it.
+	-1: no format recognized
+*/
+static inline int qlist_header(uint8_t *qbuf, int *format, int *count) {
+	uint64_t magic = 0;
+	qlist_get_delta(&qbuf, &magic);
+	*count = -1;
+	switch(magic) {
+	case QLIST_MAGIC:
+		*format = QLIST_FMT_PLAIN;
+		return(9);
+	case QLIST_MAGIC_BLOCKS:
+		*format = QLIST_FMT_BLOCKS;
+		return(9);
+	case QLIST_MAGIC_SVB:
+		*format = QLIST_FMT_SVB;
+		return(9);
+	case QLIST_MAGIC_COUNTED + QLIST_FMT_PLAIN:
+	case QLIST_MAGIC_COUNTED + QLIST_FMT_BLOCKS:
+	case QLIST_MAGIC_COUNTED + QLIST_FMT_SVB:
+		*format = magic - QLIST_MAGIC_COUNTED;
+		*count = qlist_get_u32(qbuf);
+		return(QLIST_HDR_COUNTED);
+	case QLIST_MAGIC_TAILED + QLIST_FMT_PLAIN:
+	case QLIST_MAGIC_TAILED + QLIST_FMT_BLOCKS:
+	case QLIST_MAGIC_TAILED + QLIST_FMT_SVB:
+		*format = magic - QLIST_MAGIC_TAILED;
+		*count = qlist_get_u32(qbuf);
+		return(QLIST_HDR_TAILED);
+	}
+	return(-1);
+}
+
+/*
+	-1: no format recognized
+*/
+int qlist_format(uint8_t *qbuf) {
+	int format, count;
+	if(qlist_header(qbuf, &format, &count) < 0)
+		return(-1);
+	return(format);
+}
+
+/*
+	-2: bad magic
+*/
+static inline int qlist_reader_init(struct qlist_reader *r, uint8_t *qbuf) {
+	int hdr_sz = qlist_header(qbuf, &r->format, &r->count);
+	if(unlikely(hdr_sz < 0))
+		return(-2);
+	r->qbuf = qbuf + hdr_sz;
+	r->item = 0;
+	r->block_left = 0;
+	r->block_last = 0;
+	r->block_end = NULL;
+	r->svb_end = NULL;
+	return(0);
+}
+
+static inline int qlist_reader_block(struct qlist_reader *r) {
+	uint8_t *buf = r->qbuf;
+	if(unlikely(buf[0] == 0))
+		return(-1); /* stop, don't move */
+	r->block_left = buf[0];
+	r->block_last = qlist_get_u64(&buf[3]);
+	r->qbuf = buf + QLIST_BLOCK_HDR;
+	r->block_end = r->qbuf + (buf[1] | (buf[2] << 8));
+	r->svb_end = NULL;
+	return(0);
+}
+
+/*
+	The whole block is decoded on the first item, not when the header
+	is read, blocks skipped by seek are never decoded.
+*/
+static inline void qlist_reader_next_svb(struct qlist_reader *r) {
+	if(unlikely(r->svb_end == NULL)) {
+		if(unlikely(r->qbuf == r->block_end)) {
+			/* Header only block, delta was too big. */
+			r->item = r->block_last;
+			return;
+		}
+		qlist_svb_decode(r->svb_items, r->item, r->block_left + 1,
+				 r->qbuf, r->block_end);
+		r->qbuf = r->block_end;
+		r->svb_end = &r->svb_items[r->block_left + 1];
+	}
+	/* block_left is the only counter, it's already decremented */
+	r->item = r->svb_end[-r->block_left - 1];
+}
+
+/*
+	-1: no more items
+*/
+static inline int qlist_reader_next(struct qlist_reader *r) {
+	uint64_t delta = 0;
+	if(r->format != QLIST_FMT_PLAIN) {
+		if(r->block_left == 0 && -1 == qlist_reader_block(r))
+			return(-1);
+		r->block_left--;
+		if(r->format == QLIST_FMT_SVB) {
+			qlist_reader_next_svb(r);
+			return(0);
+		}
+	}
+	if(unlikely(-1 == qlist_get_delta(&r->qbuf, &delta)))
+		return(-1);
+	r->item += delta;
+	return(0);
+}
+
+/*
+	Move forward to the first item that is >= target. The current item
+	counts, so calling it with a smaller target is a noop.
+	-1: no more items
+*/
+static inline int qlist_reader_seek(struct qlist_reader *r, uint64_t target) {
+	if(r->item >= target)
+		return(0);
+	if(r->format != QLIST_FMT_PLAIN) {
+		while(r->block_left == 0 || r->block_last < target) {
+			if(r->block_left) {
+				r->item = r->block_last;
+				r->qbuf = r->block_end;
+				r->block_left = 0;
+			}
+			if(-1 == qlist_reader_block(r))
+				return(-1);
+		}
+	}
+	if(r->format == QLIST_FMT_SVB) {
+		/* The target is in this block, scan the decoded items. */
+		qlist_reader_next(r);
+		if(r->item < target) {
+			uint64_t *p = r->svb_end - r->block_left;
+			while(*p < target)
+				p++;
+			r->block_left = r->svb_end - p - 1;
+			r->item = *p;
+		}
+		return(0);
+	}
+	while(r->item < target) {
+		if(-1 == qlist_reader_next(r))
+			return(-1);
+	}
+	return(0);
+}
+
+/*
+	Sequential writer, always emits the format it was initialised with.
+	Without a buffer (qbuf_start NULL) it only counts the items.
+*/
+struct qlist_writer {
+	uint8_t *start;
+	uint8_t *qbuf;
+	uint8_t *end;		/* crossing that means the buffer is too small */
+	uint64_t last;
+	int format;
+	int count;
+	int tailed;
+	/* QLIST_FMT_BLOCKS and QLIST_FMT_SVB */
+	uint8_t *block;		/* header of the open block or NULL */
+	int block_items;
+	uint8_t *last_block;	/* header of the last closed block or NULL */
+	/* QLIST_FMT_SVB */
+	uint8_t *svb_data;	/* next data byte, after the room for all control bytes */
+};
+
+static inline void qlist_writer_close_block(struct qlist_writer *w) {
+	uint8_t *hdr = w->block;
+	if(w->format == QLIST_FMT_SVB) {
+		/* Only a short last block has fewer control bytes than reserved. */
+		uint8_t *ctrl = hdr + QLIST_BLOCK_HDR;
+		int ctrl_sz = (w->block_items + 3) / 4;
+		int data_sz = w->svb_data - (ctrl + QLIST_SVB_CTRL);
+		if(ctrl_sz < QLIST_SVB_CTRL)
+			memmove(ctrl + ctrl_sz, ctrl + QLIST_SVB_CTRL, data_sz);
+		w->qbuf = ctrl + ctrl_sz + data_sz;
+	}
+	int body_sz = w->qbuf - (hdr + QLIST_BLOCK_HDR);
+	hdr[0] = w->block_items;
+	hdr[1] = (body_sz >> 0) & 0xFF;
+	hdr[2] = (body_sz >> 8) & 0xFF;
+	qlist_put_u64(&hdr[3], w->last);
+	w->last_block = hdr;
+	w->block = NULL;
+}
+
+/*
+	-1: qbuf_sz too small
+*/
+static inline int qlist_writer_init(struct qlist_writer *w, uint8_t *qbuf_start, int qbuf_sz, int format) {
+	w->start = qbuf_start;
+	w->qbuf = qbuf_start;
+	w->end = qbuf_start;
+	w->last = 0;
+	w->tailed = format & QLIST_FMT_TAILED;
+	w->format = format & ~QLIST_FMT_TAILED;
+	w->count = 0;
+	w->block = NULL;
+	w->block_items = 0;
+	w->last_block = NULL;
+	w->svb_data = NULL;
+	format = w->format;
+	if(qbuf_start == NULL)
+		return(0);
+	/* We might have 9 bytes overcommit (plus block header), assume the bufffer is smaller. */
+	qbuf_sz -= 9 + QLIST_BLOCK_HDR;
+	/* Stream VByte blocks are written at once, keep room for a whole one. */
+	if(format == QLIST_FMT_SVB)
+		qbuf_sz -= QLIST_SVB_CTRL + 4 * QLIST_BLOCK_ITEMS;
+	if(qbuf_sz < 0)
+		return(-1);
+	w->end = qbuf_start + qbuf_sz;
+
+	/* The rest of the header is filled in by qlist_writer_finish. */
+	if(w->tailed) {
+		w->qbuf += qlist_put_delta(w->qbuf, QLIST_MAGIC_TAILED + format);
+		w->qbuf += 4 + 8 + 4;
+	} else {
+		w->qbuf += qlist_put_delta(w->qbuf, QLIST_MAGIC_COUNTED + format);
+		w->qbuf += 4;
+	}
+	if(unlikely(w->qbuf >= w->end))
+		return(-1);
+	return(0);
+}
+
+/*
+	-1: qbuf_sz too small
+*/
+static inline int qlist_writer_put_svb(struct qlist_writer *w, uint64_t item) {
+	uint64_t delta = item - w->last;
+	if(unlikely(delta > UINT32_MAX)) {
+		if(w->block)
+			qlist_writer_close_block(w);
+		uint8_t *hdr = w->qbuf;
+		hdr[0] = 1;
+		hdr[1] = hdr[2] = 0;
+		qlist_put_u64(&hdr[3], item);
+		w->qbuf += QLIST_BLOCK_HDR;
+		w->last = item;
+		w->last_block = hdr;
+		if(unlikely(w->qbuf >= w->end))
+			return(-1);
+		return(0);
+	}
+	if(w->block == NULL) {
+		if(unlikely(w->qbuf >= w->end))
+			return(-1);
+		w->block = w->qbuf;
+		w->block_items = 0;
+		w->qbuf += QLIST_BLOCK_HDR;
+		memset(w->qbuf, 0, QLIST_SVB_CTRL);
+		w->svb_data = w->qbuf + QLIST_SVB_CTRL;
+	}
+	int i = w->block_items++;
+	int code = qlist_svb_put_delta(w->svb_data, delta);
+	w->qbuf[i >> 2] |= code << ((i & 3) * 2);
+	w->svb_data += code + 1;
+	w->last = item;
+	if(w->block_items == QLIST_BLOCK_ITEMS)
+		qlist_writer_close_block(w);
+	return(0);
+}
+
+/*
+	-1: qbuf_sz too small
+*/
+static inline int qlist_writer_put(struct qlist_writer *w, uint64_t item) {
+	w->count++;
+	if(unlikely(w->start == NULL)) {
+		w->last = item;
+		return(0);
+	}
+	if(w->format == QLIST_FMT_SVB)
+		return(qlist_writer_put_svb(w, item));
+	if(w->format == QLIST_FMT_BLOCKS) {
+		if(w->block == NULL) {
+			w->block = w->qbuf;
+			w->block_items = 0;
+			w->qbuf += QLIST_BLOCK_HDR;
+		}
+		w->block_items++;
+	}
+	w->qbuf += qlist_put_item(w->qbuf, &w->last, item);
+	if(w->block && w->block_items == QLIST_BLOCK_ITEMS)
+		qlist_writer_close_block(w);
+	if(unlikely(w->qbuf >= w->end))
+		return(-1);
+	return(0);
+}
+
+/*
+	Returns the size of the qbuf, the number of items without a buffer.
+*/
+static inline int qlist_writer_finish(struct qlist_writer *w) {
+	if(w->start == NULL)
+		return(w->count);
+	if(w->block)
+		qlist_writer_close_block(w);
+	if(w->tailed) {
+		uint8_t *tail = w->qbuf;
+		if(w->format != QLIST_FMT_PLAIN)
+			tail = w->last_block ? w->last_block : w->start;
+		qlist_put_u64(w->start + 13, w->last);
+		qlist_put_u32(w->start + 21, tail - w->start);
+	}
+	w->qbuf += qlist_put_stop(w->qbuf);
+	qlist_put_u32(w->start + 9, w->count);
+	return(w->qbuf - w->start);
+}
+
+/* itemsize is a constant in every caller, the checks are compiled out. */
+static inline uint64_t qlist_item_get(void *items, int i, int itemsize) {
+	if(itemsize == 4)
+		return(((uint32_t *)items)[i]);
+	return(((uint64_t *)items)[i]);
+}
+
+static inline void qlist_item_set(void *items, int i, int itemsize, uint64_t item) {
+	if(itemsize == 4)
+		((uint32_t *)items)[i] = item;
+	else
+		((uint64_t *)items)[i] = item;
+}
+
+static inline int qlist_pack_items(uint8_t *qbuf_start, int qbuf_sz, void *items, int items_sz, int itemsize, int format) {
+	struct qlist_writer w;
+	if(qlist_writer_init(&w, qbuf_start, qbuf_sz, format))
+		return(-1);
+
+	int i;
+	for(i = 0; i < items_sz; i++) {
+		uint64_t item = qlist_item_get(items, i, itemsize);
+		if(unlikely(item < w.last)) /* unsorted? */
+			return(-2);
+		if(unlikely(item == w.last && i != 0))
+			continue;
+		if(unlikely(qlist_writer_put(&w, item)))
+			return(-1);
+	}
+	return(qlist_writer_finish(&w));
+}
+
+/*
+	-1: qbuf_sz too small
+	-2: not sorted
+*/
+int qlist_pack(uint8_t *qbuf_start, int qbuf_sz, uint64_t *items, int items_sz, int format) {
+	return(qlist_pack_items(qbuf_start, qbuf_sz, items, items_sz, 8, format));
+}
+
+/*
+	Same as qlist_pack, for 32 bit items.
+	-1: qbuf_sz too small
+	-2: not sorted
+*/
+int qlist_pack32(uint8_t *qbuf_start, int qbuf_sz, uint32_t *items, int items_sz, int format) {
+	return(qlist_pack_items(qbuf_start, qbuf_sz, items, items_sz, 4, format));
+}
+
 /*
 	-1: items_sz too small
 	-2: bad magic
 */
 int qlist_unpack(uint64_t *items_start, int items_sz,  uint8_t *qbuf) {
-	uint64_t magic = 0;
-	qlist_get_delta(&qbuf, &magic);
-	if(magic != QLIST_MAGIC)
+	struct qlist_reader r;
+	if(qlist_reader_init(&r, qbuf))
 		return(-2);
-	
-	uint64_t last_item = 0;
+
 	uint64_t *items = items_start;
 	uint64_t *items_end = items + items_sz;
+	if(r.format == QLIST_FMT_SVB) {
+		/* Whole blocks straight into the output. */
+		while(-1 != qlist_reader_block(&r)) {
+			if(unlikely(items + r.block_left > items_end))
+				return(-1);
+			if(unlikely(r.qbuf == r.block_end))
+				r.item = *items = r.block_last;
+			else
+				r.item = qlist_svb_decode(items, r.item, r.block_left,
+							  r.qbuf, r.block_end);
+			items += r.block_left;
+			r.qbuf = r.block_end;
+		}
+		return(items - items_start);
+	}
 	while( 1 ) {
+		if(unlikely(-1 == qlist_reader_next(&r)))
+			break;
 		if(unlikely(items >= items_end))
 			return(-1);
-		if(unlikely(-1 == qlist_get_item(&qbuf, &last_item)))
-			break;
-		*items = last_item;
+		*items = r.item;
 		items++;
 	}
 	return(items - items_start);
 }
 
+static inline int qlist_unpack_items(void *items, int items_sz, int itemsize, int reverse, uint8_t *qbuf) {
+	struct qlist_reader r;
+	if(qlist_reader_init(&r, qbuf))
+		return(-2);
+
+	int i = 0;
+	while(-1 != qlist_reader_next(&r)) {
+		if(unlikely(i >= items_sz))
+			return(-1);
+		qlist_item_set(items, reverse ? items_sz - 1 - i : i, itemsize, r.item);
+		i++;
+	}
+	return(i);
+}
+
 /*
-static inline int qlist_put_item(uint8_t *qbuf, uint64_t *last_item, uint64_t item) {
-	uint64_t delta = item - *last_item;
-	*last_item = item;
-	return(qlist_put_delta(qbuf, delta));
+	Items are stored 4 or 8 bytes wide (truncated to 32 bits in the
+	former case). With reverse set they go in descending order and
+	items_sz must be exactly the number of items, see qlist_count.
+	-1: items_sz too small
+	-2: bad magic
+	-3: itemsize not 4 or 8
+*/
+int qlist_unpack_to(void *items, int items_sz, int itemsize, int reverse, uint8_t *qbuf) {
+	if(itemsize == 8 && !reverse)
+		return(qlist_unpack(items, items_sz, qbuf));
+	if(itemsize == 8)
+		return(qlist_unpack_items(items, items_sz, 8, 1, qbuf));
+	if(itemsize != 4)
+		return(-3);
+	if(reverse)
+		return(qlist_unpack_items(items, items_sz, 4, 1, qbuf));
+	return(qlist_unpack_items(items, items_sz, 4, 0, qbuf));
 }
+
+/*
+	Number of items, straight from the header. Lists without the count
+	in the header are scanned, blocks formats read only block headers.
+	-2: bad magic
 */
-#define qlist_put_item(qbuf, last_item, item) 		\
-	({						\
-		uint64_t delta = item - *last_item;	\
-		*last_item = item;			\
-		(qlist_put_delta(qbuf, delta));		\
-	})
+int qlist_count(uint8_t *qbuf) {
+	struct qlist_reader r;
+	if(qlist_reader_init(&r, qbuf))
+		return(-2);
+	if(r.count >= 0)
+		return(r.count);
+
+	int count = 0;
+	if(r.format != QLIST_FMT_PLAIN) {
+		while(-1 != qlist_reader_block(&r)) {
+			count += r.block_left;
+			r.qbuf = r.block_end;
+		}
+	} else {
+		while(-1 != qlist_reader_next(&r))
+			count++;
+	}
+	return(count);
+}
+
+/*
+	-2: bad magic
+*/
+int qlist_is_empty(uint8_t *qbuf) {
+	int format, count;
+	int hdr_sz = qlist_header(qbuf, &format, &count);
+	if(hdr_sz < 0)
+		return(-2);
+	/* Stop byte, in the blocks formats an empty block header. */
+	return(qbuf[hdr_sz] == 0);
+}
+
+/*
+	Appends the items of qpb to qpa in place, the items already in qpa
+	are not decoded. Possible when qpa has the tailed header and all the
+	items of qpb are above its last one, a partially filled last block
+	is reopened and filled first. qpa_len is the size of qpa, qpa_sz the
+	size of its buffer. Returns the new size of qpa, which keeps the
+	tailed header.
+	-1: qpa_sz too small, qpa is left broken
+	-2: bad magic
+	-3: not appendable, qpa is untouched
+*/
+int qlist_append(uint8_t *qpa, int qpa_len, int qpa_sz, uint8_t *qpb) {
+	struct qlist_reader rb;
+	struct qlist_writer w;
+	int format, count;
+	int hdr_sz = qlist_header(qpa, &format, &count);
+	if(hdr_sz < 0 || qlist_reader_init(&rb, qpb))
+		return(-2);
+	if(hdr_sz != QLIST_HDR_TAILED)
+		return(-3);
+	uint64_t last = qlist_get_u64(qpa + 13);
+	uint32_t tail = qlist_get_u32(qpa + 21);
+	if(-1 == qlist_reader_next(&rb))
+		return(qpa_len);
+	if(count && rb.item <= last)
+		return(-3);
+
+	if(qlist_writer_init(&w, qpa, qpa_sz, format | QLIST_FMT_TAILED))
+		return(-1);
+	w.count = count;
+	w.last = last;
+	if(format == QLIST_FMT_PLAIN) {
+		w.qbuf = qpa + tail;	/* over the stop byte */
+	} else if(tail == 0) {
+		w.qbuf = qpa + QLIST_HDR_TAILED;
+	} else {
+		uint8_t *hdr = qpa + tail;
+		int n = hdr[0];
+		int body_sz = hdr[1] | (hdr[2] << 8);
+		w.last_block = hdr;
+		w.qbuf = hdr + QLIST_BLOCK_HDR + body_sz;
+		/* Header only blocks (a too big delta) stay closed. */
+		if(n < QLIST_BLOCK_ITEMS && body_sz) {
+			w.block = hdr;
+			w.block_items = n;
+			if(format == QLIST_FMT_SVB) {
+				/* Back to the layout of an open block, room for all the control bytes. */
+				uint8_t *ctrl = hdr + QLIST_BLOCK_HDR;
+				int ctrl_sz = (n + 3) / 4;
+				int data_sz = body_sz - ctrl_sz;
+				if(unlikely(ctrl + QLIST_SVB_CTRL + data_sz >= w.end))
+					return(-1);
+				memmove(ctrl + QLIST_SVB_CTRL, ctrl + ctrl_sz, data_sz);
+				memset(ctrl + ctrl_sz, 0, QLIST_SVB_CTRL - ctrl_sz);
+				w.qbuf = ctrl;
+				w.svb_data = ctrl + QLIST_SVB_CTRL + data_sz;
+			}
+		}
+	}
+	if(unlikely(w.qbuf >= w.end))
+		return(-1);
+
+	do {
+		if(unlikely(qlist_writer_put(&w, rb.item)))
+			return(-1);
+	} while(-1 != qlist_reader_next(&rb));
+	return(qlist_writer_finish(&w));
+}
+
+/*
+	Cursor, decodes only as much as the caller consumes. Forward it's
+	just a reader. Backward, blocks are decoded one at a time starting
+	from the last one (plain format lists are decoded whole, there's no
+	other way to get to the end).
+*/
+struct qlist_cursor {
+	struct qlist_reader r;
+	uint8_t *qbuf;
+	int reverse;
+	int started;
+	int done;
+	/* reverse */
+	uint8_t **blocks;	/* block headers */
+	int blocks_n;		/* blocks not yet decoded */
+	uint64_t *items;	/* decoded, not yet returned items are [0, pos) */
+	int pos;
+	uint64_t *plain_items;
+	uint64_t block_items[QLIST_BLOCK_ITEMS];
+};
+
+/*
+	NULL: bad magic or out of memory
+*/
+struct qlist_cursor *qlist_cursor_new(uint8_t *qbuf, int reverse) {
+	struct qlist_cursor *c = calloc(1, sizeof(struct qlist_cursor));
+	if(c == NULL)
+		return(NULL);
+	if(qlist_reader_init(&c->r, qbuf)) {
+		free(c);
+		return(NULL);
+	}
+	c->qbuf = qbuf;
+	c->reverse = reverse;
+	return(c);
+}
 
+void qlist_cursor_free(struct qlist_cursor *c) {
+	free(c->blocks);
+	free(c->plain_items);
+	free(c);
+}
+
+/*
+	-1: out of memory
+*/
+static int qlist_cursor_start_reverse(struct qlist_cursor *c) {
+	struct qlist_reader r = c->r;
+	if(r.format == QLIST_FMT_PLAIN) {
+		int n = qlist_count(c->qbuf);
+		c->plain_items = malloc(sizeof(uint64_t) * (n + 1));
+		if(c->plain_items == NULL)
+			return(-1);
+		c->items = c->plain_items;
+		c->pos = qlist_unpack(c->items, n, c->qbuf);
+		return(0);
+	}
+	int n = 0;
+	while(-1 != qlist_reader_block(&r)) {
+		n++;
+		r.qbuf = r.block_end;
+	}
+	c->blocks = malloc(sizeof(uint8_t *) * (n + 1));
+	if(c->blocks == NULL)
+		return(-1);
+	r = c->r;
+	while(-1 != qlist_reader_block(&r)) {
+		c->blocks[c->blocks_n++] = r.qbuf - QLIST_BLOCK_HDR;
+		r.qbuf = r.block_end;
+	}
+	c->items = c->block_items;
+	c->pos = 0;
+	return(0);
+}
+
+static inline uint64_t qlist_cursor_block_last(struct qlist_cursor *c, int i) {
+	return(qlist_get_u64(&c->blocks[i][3]));
+}
+
+/*
+	Decodes the last not yet decoded block, skipping those that
+	contain only items above target.
+	-1: no more blocks
+*/
+static int qlist_cursor_prev_block(struct qlist_cursor *c, uint64_t target) {
+	while(c->blocks_n > 1 && qlist_cursor_block_last(c, c->blocks_n - 2) >= target)
+		c->blocks_n--;
+	if(c->blocks_n == 0 || c->blocks == NULL)
+		return(-1);
+	c->blocks_n--;
+	struct qlist_reader r = c->r;
+	r.qbuf = c->blocks[c->blocks_n];
+	r.item = c->blocks_n ? qlist_cursor_block_last(c, c->blocks_n - 1) : 0;
+	r.block_left = 0;
+	c->pos = 0;
+	do {
+		qlist_reader_next(&r);
+		c->items[c->pos++] = r.item;
+	} while(r.block_left);
+	return(0);
+}
+
+/*
+	Moves to the first not yet returned item that is >= target (<= when
+	going backwards), qlist_cursor_next is a seek to 0 (UINT64_MAX).
+	-1: no more items
+	-2: out of memory
+*/
+int qlist_cursor_seek(struct qlist_cursor *c, uint64_t target, uint64_t *item) {
+	if(c->done)
+		return(-1);
+	if(!c->reverse) {
+		if(-1 == qlist_reader_next(&c->r) ||
+		   -1 == qlist_reader_seek(&c->r, target)) {
+			c->done = 1;
+			return(-1);
+		}
+		*item = c->r.item;
+		return(0);
+	}
+	if(!c->started) {
+		if(qlist_cursor_start_reverse(c))
+			return(-2);
+		c->started = 1;
+	}
+	while(1) {
+		while(c->pos && c->items[c->pos - 1] > target)
+			c->pos--;
+		if(c->pos) {
+			*item = c->items[--c->pos];
+			return(0);
+		}
+		if(-1 == qlist_cursor_prev_block(c, target)) {
+			c->done = 1;
+			return(-1);
+		}
+	}
+}
+
+int qlist_cursor_next(struct qlist_cursor *c, uint64_t *item) {
+	return(qlist_cursor_seek(c, c->reverse ? UINT64_MAX : 0, item));
+}
+
+/*
+	Set operations. With qpc_start NULL the result is only counted,
+	nothing is encoded and the number of items is returned.
+*/
 #define PREFIX						\
-	/* We might have 9 bytes overcommit, assume the bufffer is smaller. */	\
-	qpc_sz -= 9;					\
-	if(qpc_sz < 0)					\
-		return(-1);				\
-							\
-	uint8_t *qpc = qpc_start;			\
-	uint8_t *qpc_end = qpc + qpc_sz;		\
-	uint64_t magic = 0;				\
-							\
-	qpc += qlist_put_delta(qpc, QLIST_MAGIC);	\
-	if(unlikely(qpc >= qpc_end))			\
-		return(-1);				\
+	struct qlist_reader ra;				\
+	struct qlist_reader rb;				\
+	struct qlist_writer wc;				\
 							\
-	qlist_get_delta(&qpa, &magic);			\
-	if(magic != QLIST_MAGIC)			\
+	if(qlist_reader_init(&ra, qpa))			\
 		return(-2);				\
-							\
-	qlist_get_delta(&qpb, &magic);			\
-	if(magic != QLIST_MAGIC)			\
+	if(qlist_reader_init(&rb, qpb))			\
 		return(-2);				\
+	/* Result is in the format of the first operand. */	\
+	if(qlist_writer_init(&wc, qpc_start, qpc_sz, ra.format))	\
+		return(-1);				\
 							\
-	int a_d = 0;					\
-	int b_d = 0;					\
-	uint64_t a = 0;				\
-	uint64_t b = 0;				\
-	uint64_t c = 0;				\
-							\
-	a_d = qlist_get_item(&qpa, &a);			\
-	b_d = qlist_get_item(&qpb, &b);
+	int a_d = qlist_reader_next(&ra);		\
+	int b_d = qlist_reader_next(&rb);
+
+#define PUT(item)					\
+	if(unlikely(qlist_writer_put(&wc, (item))))	\
+		return(-1);
 
 #define SUFFIX_A_D					\
 	while( a_d != -1 ) {				\
-		qpc += qlist_put_item(qpc, &c, a);	\
-		if(qpc >= qpc_end)			\
-			return(-1);			\
-		a_d = qlist_get_item(&qpa, &a);		\
+		PUT(ra.item);				\
+		a_d = qlist_reader_next(&ra);		\
 	}
 
 #define SUFFIX_B_D					\
 	while( b_d != -1 ) {				\
-		qpc += qlist_put_item(qpc, &c, b);	\
-		if(qpc >= qpc_end)			\
-			return(-1);			\
-		b_d = qlist_get_item(&qpb, &b);		\
+		PUT(rb.item);				\
+		b_d = qlist_reader_next(&rb);		\
 	}
 
 #define SUFFIX_RET					\
-	qpc += qlist_put_stop(qpc);			\
-	return(qpc - qpc_start);
+	return(qlist_writer_finish(&wc));
 
 /*
 	-1: qpc_sz too small
@@ -243,25 +1059,19 @@ int qlist_or(uint8_t *qpc_start, int qpc_sz, uint8_t *qpa, uint8_t *qpb) {
 	PREFIX;
 
 	while(a_d != -1 && b_d != -1) {
-		if(a < b) {
-			qpc += qlist_put_item(qpc, &c, a);
-			if(qpc >= qpc_end)
-				return(-1);
-			a_d = qlist_get_item(&qpa, &a);
-		}else if(a > b) {
-			qpc += qlist_put_item(qpc, &c, b);
-			if(qpc >= qpc_end)
-				return(-1);
-			b_d = qlist_get_item(&qpb, &b);
+		if(ra.item < rb.item) {
+			PUT(ra.item);
+			a_d = qlist_reader_next(&ra);
+		}else if(ra.item > rb.item) {
+			PUT(rb.item);
+			b_d = qlist_reader_next(&rb);
 		}else{
-			qpc += qlist_put_item(qpc, &c, a);
-			if(qpc >= qpc_end)
-				return(-1);
-			a_d = qlist_get_item(&qpa, &a);
-			b_d = qlist_get_item(&qpb, &b);
+			PUT(ra.item);
+			a_d = qlist_reader_next(&ra);
+			b_d = qlist_reader_next(&rb);
 		}
 	}
-	
+
 	SUFFIX_A_D;
 	SUFFIX_B_D;
 	SUFFIX_RET;
@@ -274,20 +1084,19 @@ int qlist_or(uint8_t *qpc_start, int qpc_sz, uint8_t *qpa, uint8_t *qpb) {
 int qlist_and(uint8_t *qpc_start, int qpc_sz, uint8_t *qpa, uint8_t *qpb) {
 	PREFIX;
 
+	/* Leapfrog, with blocks format seek jumps over whole blocks. */
 	while(a_d != -1 && b_d != -1) {
-		if(a < b) {
-			a_d = qlist_get_item(&qpa, &a);
-		}else if(a > b) {
-			b_d = qlist_get_item(&qpb, &b);
+		if(ra.item < rb.item) {
+			a_d = qlist_reader_seek(&ra, rb.item);
+		}else if(ra.item > rb.item) {
+			b_d = qlist_reader_seek(&rb, ra.item);
 		}else{
-			qpc += qlist_put_item(qpc, &c, a);
-			if(qpc >= qpc_end)
-				return(-1);
-			a_d = qlist_get_item(&qpa, &a);
-			b_d = qlist_get_item(&qpb, &b);
+			PUT(ra.item);
+			a_d = qlist_reader_next(&ra);
+			b_d = qlist_reader_next(&rb);
 		}
 	}
-	
+
 	SUFFIX_RET;
 }
 
@@ -299,20 +1108,312 @@ int qlist_andnot(uint8_t *qpc_start, int qpc_sz, uint8_t *qpa, uint8_t *qpb) {
 	PREFIX;
 
 	while(a_d != -1 && b_d != -1) {
-		if(a < b) {
-			qpc += qlist_put_item(qpc, &c, a);
-			if(qpc >= qpc_end)
-				return(-1);
-			a_d = qlist_get_item(&qpa, &a);
-		}else if(a > b) {
-			b_d = qlist_get_item(&qpb, &b);
+		if(ra.item < rb.item) {
+			PUT(ra.item);
+			a_d = qlist_reader_next(&ra);
+		}else if(ra.item > rb.item) {
+			b_d = qlist_reader_seek(&rb, ra.item);
 		}else{
-			a_d = qlist_get_item(&qpa, &a);
-			b_d = qlist_get_item(&qpb, &b);
+			a_d = qlist_reader_next(&ra);
+			b_d = qlist_reader_next(&rb);
 		}
 	}
-	
+
 	SUFFIX_A_D;
 	SUFFIX_RET;
 }
 
+/*
+	Writes the n items collected backwards in ascending order and frees
+	them.
+*/
+static int qlist_write_reversed(uint8_t *qpc_start, int qpc_sz, int format,
+				uint64_t *items, int n) {
+	struct qlist_writer wc;
+	int r = 0;
+	if(qlist_writer_init(&wc, qpc_start, qpc_sz, format))
+		r = -1;
+	while(r == 0 && n--)
+		if(unlikely(qlist_writer_put(&wc, items[n])))
+			r = -1;
+	free(items);
+	if(r)
+		return(r);
+	return(qlist_writer_finish(&wc));
+}
+
+/*
+	Top limit items of the AND, found going backwards with cursors.
+*/
+static int qlist_and_many_reverse(uint8_t *qpc_start, int qpc_sz, int format,
+				  uint8_t **qps, int qps_n, uint8_t **nots, int nots_n,
+				  int limit) {
+	struct qlist_cursor *cs[qps_n + 1];
+	struct qlist_cursor *ns[nots_n + 1];
+	uint64_t cur[qps_n + 1];
+	uint64_t ns_cur[nots_n + 1];
+	int ns_d[nots_n + 1];
+	uint64_t *out = malloc(sizeof(uint64_t) * limit);
+	int out_n = 0;
+	int r = 0;
+	int i;
+
+	memset(cs, 0, sizeof(cs));
+	memset(ns, 0, sizeof(ns));
+	if(out == NULL)
+		r = -3;
+	for(i = 0; r == 0 && i < qps_n; i++)
+		if((cs[i] = qlist_cursor_new(qps[i], 1)) == NULL)
+			r = -2;
+	for(i = 0; r == 0 && i < nots_n; i++) {
+		if((ns[i] = qlist_cursor_new(nots[i], 1)) == NULL)
+			r = -2;
+		ns_d[i] = 1; /* not started */
+	}
+	if(r)
+		goto done;
+
+	/* Seeks return -1 at the end of a list, -2 is an error. */
+	int d;
+	for(i = 0; i < qps_n; i++)
+		if((d = qlist_cursor_next(cs[i], &cur[i])))
+			goto seek_done;
+	uint64_t candidate = cur[0];
+	while(out_n < limit) {
+		for(i = 0; i < qps_n; i++) {
+			if(cur[i] > candidate &&
+			   (d = qlist_cursor_seek(cs[i], candidate, &cur[i])))
+				goto seek_done;
+			if(cur[i] < candidate) {
+				candidate = cur[i];
+				break;
+			}
+		}
+		if(i < qps_n)
+			continue;
+
+		int excluded = 0;
+		for(i = 0; i < nots_n; i++) {
+			if(ns_d[i] == -1)
+				continue;
+			if(ns_d[i] == 1 || ns_cur[i] > candidate)
+				ns_d[i] = qlist_cursor_seek(ns[i], candidate, &ns_cur[i]);
+			if(ns_d[i] == -2) {
+				r = -2;
+				goto done;
+			}
+			if(ns_d[i] == 0 && ns_cur[i] == candidate) {
+				excluded = 1;
+				break;
+			}
+		}
+		if(!excluded)
+			out[out_n++] = candidate;
+
+		if(candidate == 0)
+			goto done;
+		if((d = qlist_cursor_seek(cs[0], candidate - 1, &cur[0])))
+			goto seek_done;
+		candidate = cur[0];
+	}
+	goto done;
+seek_done:
+	if(d == -2)
+		r = -2;
+done:
+	for(i = 0; i < qps_n; i++)
+		if(cs[i])
+			qlist_cursor_free(cs[i]);
+	for(i = 0; i < nots_n; i++)
+		if(ns[i])
+			qlist_cursor_free(ns[i]);
+	if(r) {
+		free(out);
+		return(r);
+	}
+	return(qlist_write_reversed(qpc_start, qpc_sz, format, out, out_n));
+}
+
+/*
+	AND of all qps, minus every item present in any of nots. Operands
+	are walked in the given order, so the shortest list should go first.
+	Nothing is materialised between the operands. With limit set, only
+	the first limit items (the last ones if reverse is set) are emitted
+	and the evaluation stops there.
+	-1: qpc_sz too small
+	-2: bad magic
+	-3: out of memory
+*/
+int qlist_and_many(uint8_t *qpc_start, int qpc_sz, int format,
+		   uint8_t **qps, int qps_n, uint8_t **nots, int nots_n,
+		   int limit, int reverse) {
+	if(limit > 0 && reverse && qps_n > 0)
+		return(qlist_and_many_reverse(qpc_start, qpc_sz, format,
+					      qps, qps_n, nots, nots_n, limit));
+	struct qlist_reader rs[qps_n + 1];
+	struct qlist_reader ns[nots_n + 1];
+	int ns_d[nots_n + 1];
+	struct qlist_writer wc;
+	int written = 0;
+	int i;
+
+	for(i = 0; i < qps_n; i++)
+		if(qlist_reader_init(&rs[i], qps[i]))
+			return(-2);
+	for(i = 0; i < nots_n; i++)
+		if(qlist_reader_init(&ns[i], nots[i]))
+			return(-2);
+	if(qlist_writer_init(&wc, qpc_start, qpc_sz, format))
+		return(-1);
+	if(qps_n < 1)
+		goto done;
+
+	for(i = 0; i < qps_n; i++)
+		if(-1 == qlist_reader_next(&rs[i]))
+			goto done;
+	for(i = 0; i < nots_n; i++)
+		ns_d[i] = qlist_reader_next(&ns[i]);
+
+	uint64_t candidate = rs[0].item;
+	while(1) {
+		for(i = 0; i < qps_n; i++) {
+			if(-1 == qlist_reader_seek(&rs[i], candidate))
+				goto done;
+			if(rs[i].item > candidate) {
+				candidate = rs[i].item;
+				break;
+			}
+		}
+		if(i < qps_n)
+			continue;
+
+		/* All positive lists agree, check the negative ones. */
+		int excluded = 0;
+		for(i = 0; i < nots_n; i++) {
+			if(ns_d[i] == -1)
+				continue;
+			ns_d[i] = qlist_reader_seek(&ns[i], candidate);
+			if(ns_d[i] != -1 && ns[i].item == candidate) {
+				excluded = 1;
+				break;
+			}
+		}
+		if(!excluded) {
+			PUT(candidate);
+			if(++written == limit)
+				goto done;
+		}
+
+		if(-1 == qlist_reader_next(&rs[0]))
+			goto done;
+		candidate = rs[0].item;
+	}
+done:
+	SUFFIX_RET;
+}
+
+static int qlist_or_many_reverse(uint8_t *qpc_start, int qpc_sz, int format,
+				 uint8_t **qps, int qps_n, int limit) {
+	struct qlist_cursor *cs[qps_n + 1];
+	uint64_t cur[qps_n + 1];
+	int cs_d[qps_n + 1];
+	uint64_t *out = malloc(sizeof(uint64_t) * limit);
+	int out_n = 0;
+	int r = 0;
+	int i;
+
+	memset(cs, 0, sizeof(cs));
+	if(out == NULL)
+		r = -3;
+	for(i = 0; r == 0 && i < qps_n; i++)
+		if((cs[i] = qlist_cursor_new(qps[i], 1)) == NULL)
+			r = -2;
+	if(r)
+		goto done;
+
+	int active = 0;
+	for(i = 0; i < qps_n; i++) {
+		cs_d[i] = qlist_cursor_next(cs[i], &cur[i]);
+		if(cs_d[i] == -2) {
+			r = -2;
+			goto done;
+		}
+		if(cs_d[i] == 0)
+			active++;
+	}
+	while(active && out_n < limit) {
+		uint64_t largest = 0;
+		for(i = 0; i < qps_n; i++)
+			if(cs_d[i] == 0 && cur[i] >= largest)
+				largest = cur[i];
+		out[out_n++] = largest;
+		for(i = 0; i < qps_n; i++) {
+			if(cs_d[i] == 0 && cur[i] == largest) {
+				cs_d[i] = qlist_cursor_next(cs[i], &cur[i]);
+				if(cs_d[i] == -2) {
+					r = -2;
+					goto done;
+				}
+				if(cs_d[i] != 0)
+					active--;
+			}
+		}
+	}
+done:
+	for(i = 0; i < qps_n; i++)
+		if(cs[i])
+			qlist_cursor_free(cs[i]);
+	if(r) {
+		free(out);
+		return(r);
+	}
+	return(qlist_write_reversed(qpc_start, qpc_sz, format, out, out_n));
+}
+
+/*
+	OR of all qps, limit and reverse as in qlist_and_many.
+	-1: qpc_sz too small
+	-2: bad magic
+	-3: out of memory
+*/
+int qlist_or_many(uint8_t *qpc_start, int qpc_sz, int format,
+		  uint8_t **qps, int qps_n, int limit, int reverse) {
+	if(limit > 0 && reverse)
+		return(qlist_or_many_reverse(qpc_start, qpc_sz, format,
+					     qps, qps_n, limit));
+	struct qlist_reader rs[qps_n + 1];
+	int rs_d[qps_n + 1];
+	struct qlist_writer wc;
+	int written = 0;
+	int i;
+
+	for(i = 0; i < qps_n; i++)
+		if(qlist_reader_init(&rs[i], qps[i]))
+			return(-2);
+	if(qlist_writer_init(&wc, qpc_start, qpc_sz, format))
+		return(-1);
+
+	int active = 0;
+	for(i = 0; i < qps_n; i++) {
+		rs_d[i] = qlist_reader_next(&rs[i]);
+		if(rs_d[i] != -1)
+			active++;
+	}
+
+	while(active && (limit <= 0 || written < limit)) {
+		uint64_t smallest = UINT64_MAX;
+		for(i = 0; i < qps_n; i++)
+			if(rs_d[i] != -1 && rs[i].item < smallest)
+				smallest = rs[i].item;
+		PUT(smallest);
+		written++;
+		for(i = 0; i < qps_n; i++) {
+			if(rs_d[i] != -1 && rs[i].item == smallest) {
+				rs_d[i] = qlist_reader_next(&rs[i]);
+				if(rs_d[i] == -1)
+					active--;
+			}
+		}
+	}
+	SUFFIX_RET;
+}
@@ -1,7 +1,29 @@
 /* qlist.c */
+#define QLIST_FMT_PLAIN 0
+#define QLIST_FMT_BLOCKS 1
+#define QLIST_FMT_SVB 2
+#define QLIST_FMT_TAILED 0x10
+
 int qlist_or(u_int8_t *qpc_start, int qpc_sz, u_int8_t *qpa, u_int8_t *qpb);
 int qlist_and(u_int8_t *qpc_start, int qpc_sz, u_int8_t *qpa, u_int8_t *qpb);
 int qlist_andnot(u_int8_t *qpc_start, int qpc_sz, u_int8_t *qpa, u_int8_t *qpb);
+int qlist_and_many(u_int8_t *qpc_start, int qpc_sz, int format,
+		   u_int8_t **qps, int qps_n, u_int8_t **nots, int nots_n,
+		   int limit, int reverse);
+int qlist_or_many(u_int8_t *qpc_start, int qpc_sz, int format,
+		  u_int8_t **qps, int qps_n, int limit, int reverse);
 
-int qlist_pack(u_int8_t *qbuf_start, int qbuf_sz, u_int64_t *items, int items_sz);
+int qlist_format(u_int8_t *qbuf);
+int qlist_pack(u_int8_t *qbuf_start, int qbuf_sz, u_int64_t *items, int items_sz, int format);
+int qlist_pack32(u_int8_t *qbuf_start, int qbuf_sz, u_int32_t *items, int items_sz, int format);
 int qlist_unpack(u_int64_t *items_start, int items_sz,  u_int8_t *qbuf);
+int qlist_unpack_to(void *items, int items_sz, int itemsize, int reverse, u_int8_t *qbuf);
+int qlist_count(u_int8_t *qbuf);
+int qlist_is_empty(u_int8_t *qbuf);
+int qlist_append(u_int8_t *qpa, int qpa_len, int qpa_sz, u_int8_t *qpb);
+
+struct qlist_cursor;
+struct qlist_cursor *qlist_cursor_new(u_int8_t *qbuf, int reverse);
+void qlist_cursor_free(struct qlist_cursor *c);
+int qlist_cursor_next(struct qlist_cursor *c, u_int64_t *item);
+int qlist_cursor_seek(struct qlist_cursor *c, u_int64_t target, u_int64_t *item);
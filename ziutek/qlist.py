@@ -2,9 +2,9 @@
 # -*- coding: utf-8 -*-
 '''
 >>> pack([]).encode('hex')
-'10deadbeefdeadbaaf00'
+'10deadbeefdeadbac00000000000'
 >>> pack([1,2,3,4]).encode('hex')
-'10deadbeefdeadbaaf8181818100'
+'10deadbeefdeadbac0000000048181818100'
 
 >>> a = pack([1, 256L, 65536L, 16777216L, 4294967295L])
 >>> b = pack([3, 256])
@@ -20,6 +20,89 @@ array('L', [256L])
 array('L', [1L, 65536L, 16777216L, 4294967295L])
 >>> unpack( do_andnot(b, a) )
 array('L', [3L])
+
+Blocks format, set operations accept any mix of formats and emit the
+format of the first operand.
+
+>>> pack([], fmt=FMT_BLOCKS).encode('hex')
+'10deadbeefdeadbac10000000000'
+>>> pack([1,2,3,4], fmt=FMT_BLOCKS).encode('hex')
+'10deadbeefdeadbac10000000404040000000000000000048181818100'
+>>> c = pack(range(0, 1000, 3), fmt=FMT_BLOCKS)
+>>> get_format(c) == FMT_BLOCKS
+True
+>>> unpack(c) == array.array('L', range(0, 1000, 3))
+True
+>>> unpack( do_and(c, b) )
+array('L', [3L])
+>>> get_format( do_and(c, b) ) == FMT_BLOCKS
+True
+>>> get_format( do_and(b, c) ) == FMT_PLAIN
+True
+>>> d = pack(range(0, 1000, 2), fmt=FMT_BLOCKS)
+>>> unpack( do_and(c, d) ) == array.array('L', range(0, 1000, 6))
+True
+>>> unpack( do_andnot(d, c) ) == array.array('L', [i for i in range(0, 1000, 2) if i % 3])
+True
+>>> unpack( do_or(c, d) ) == array.array('L', [i for i in range(1000) if i % 2 == 0 or i % 3 == 0])
+True
+>>> unpack( do_and(pack([999]), d) )
+array('L')
+>>> unpack( do_and(pack([0, 998]), d) )
+array('L', [0L, 998L])
+
+Stream VByte format, deltas over 32 bits get a block of their own.
+
+>>> pack([1,2,3,4], fmt=FMT_SVB).encode('hex')
+'10deadbeefdeadbac2000000040405000000000000000004000101010100'
+>>> e = pack([5, 300, 70000, 2**33, 2**33 + 1] + range(2**34, 2**34 + 500, 7), fmt=FMT_SVB)
+>>> unpack(e)[:6]
+array('L', [5L, 300L, 70000L, 8589934592L, 8589934593L, 17179869184L])
+>>> unpack(e) == array.array('L', sorted(unpack(do_or(e, pack([])))))
+True
+>>> count(e)
+77
+>>> unpack( do_and(pack([300, 2**33, 2**34 + 7]), e) )
+array('L', [300L, 8589934592L, 17179869191L])
+>>> get_format( do_or(e, c) ) == FMT_SVB
+True
+>>> unpack( do_and(e, pack(range(0, 1000, 5), fmt=FMT_SVB)) )
+array('L', [5L, 300L])
+
+The header holds the number of items, boolean expressions can be counted
+without encoding the result. Lists written before the count was added
+to the header are still read, they are counted by scanning.
+
+>>> count_andnot_many([a, pack([1, 3, 256, 65536])], [pack([1])])
+2
+>>> count_or_many([a, b, c])
+339
+>>> old = '10deadbeefdeadbaaf8181818100'.decode('hex')
+>>> count(old), is_empty(old), unpack(do_or(old, pack([9])))
+(4, False, array('L', [1L, 2L, 3L, 4L, 9L]))
+
+Accumulator collects docids per (word, chunk_no) key, add() returns keys
+it has seen for the first time. Docids are sorted when packed, pop()
+also tells how many were added, duplicates included.
+
+>>> acc = Accumulator()
+>>> acc.add(7, ['ala', 'ma', 'ala'], 0)
+[('ala', 0), ('ma', 0)]
+>>> acc.add(3, ['ala'], 0), len(acc)
+([], 2)
+>>> qbuf, n = acc.pop(('ala', 0), FMT_BLOCKS)
+>>> unpack(qbuf), n, len(acc)
+(array('L', [3L, 7L]), 3, 1)
+
+take() moves keys to a new Accumulator without packing them.
+
+>>> acc.add(9, ['kot'], 1)
+[('kot', 1)]
+>>> taken, n = acc.take([('ma', 0), ('kot', 1)])
+>>> len(acc), len(taken), n
+(0, 2, 2)
+>>> unpack(taken.pop(('ma', 0))[0])
+array('L', [7L])
 '''
 import array
 try:
@@ -27,52 +110,240 @@ try:
 except ImportError:
     import _qlist
 
-def pack(arr, sort=False, typecode='L'):
+ListTooBigError = _qlist.ListTooBigError
+NotSortedError = _qlist.NotSortedError
+
+# Docids buffered per (word, chunk_no), 4-8 bytes each, see Hitlists.
+Accumulator = _qlist.Accumulator
+
+# Plain varint deltas, the original format.
+FMT_PLAIN=0
+# Deltas split into blocks of 128 items, each block header holds the last
+# item and the block size so AND/ANDNOT can skip whole blocks.
+FMT_BLOCKS=1
+# Same blocks, Stream VByte coded deltas, decoded four at a time with SSSE3.
+FMT_SVB=2
+# Or-ed with a format: the header also holds the last item and where the
+# list ends, so append() doesn't need to decode it.
+FMT_TAILED=0x10
+
+def pack(arr, sort=False, typecode='L', fmt=FMT_PLAIN):
     '''
     >>> pack([1]).encode('hex')
-    '10deadbeefdeadbaaf8100'
+    '10deadbeefdeadbac0000000018100'
     >>> pack(array.array('L', [1])).encode('hex')
-    '10deadbeefdeadbaaf8100'
+    '10deadbeefdeadbac0000000018100'
     '''
     # Is arr a sequence?
     if sort:
         arr = sorted(arr)
     # list() is used by default instead of array. It appears to be twice faster!
-    #if not isinstance(arr, array.array):
-    arr = array.array(typecode, arr)
-    #assert arr.typecode in 'LI'
-    return _qlist.pack_array(arr.tostring(), arr.itemsize)
+    if not isinstance(arr, array.array) or arr.itemsize not in (4, 8):
+        arr = array.array(typecode, arr)
+    return _qlist.pack_array(arr, arr.itemsize, fmt)
+
+def pack_buffer(buf, itemsize=8, fmt=FMT_PLAIN):
+    '''
+    Packs sorted unsigned integers straight from anything exposing a
+    buffer (array, bytearray, numpy array, mmap), nothing is copied.
+
+    >>> pack_buffer(bytearray('\\x01\\x00\\x00\\x00\\x05\\x00\\x00\\x00'), 4).encode('hex')
+    '10deadbeefdeadbac000000002818400'
+    >>> pack_buffer(array.array('L', [1, 5])) == pack([1, 5])
+    True
+    '''
+    return _qlist.pack_array(buf, itemsize, fmt)
 
 def unpack(qbuf, reverse=False, typecode='L'):
     '''
+    >>> unpack(pack([1, 2, 3]), reverse=True)
+    array('L', [3L, 2L, 1L])
+    >>> unpack(pack([1, 2, 3], fmt=FMT_SVB), typecode='I')
+    array('I', [1L, 2L, 3L])
+    '''
+    arr = _zeros(typecode, count(qbuf))
+    _qlist.unpack_into(qbuf, arr, arr.itemsize, reverse)
+    return arr
+
+def cursor(qbuf, reverse=False):
+    '''
+    Lazy iterator, items are decoded only as they are consumed. seek(x)
+    skips to the first not yet returned item >= x (<= x when reversed)
+    and returns it, or None if there's no such item.
+
+    >>> c = cursor(pack(range(0, 1000, 10), fmt=FMT_BLOCKS))
+    >>> c.next(), c.seek(55), c.next(), c.seek(0), c.seek(2000)
+    (0L, 60L, 70L, 80L, None)
+    >>> list(c)
+    []
+    >>> c = cursor(pack(range(0, 1000, 10), fmt=FMT_SVB), reverse=True)
+    >>> c.next(), c.seek(555), c.next(), c.seek(5000), c.seek(3)
+    (990L, 550L, 540L, 530L, 0L)
+    >>> list(cursor(pack([1, 2, 3]), reverse=True))
+    [3L, 2L, 1L]
     '''
-    arr = array.array(typecode)
-    s = _qlist.unpack_to_array(qbuf, arr.itemsize)
-    arr.fromstring(s)
-    if reverse:
-        return array.array(typecode, reversed(arr))
+    return _qlist.Cursor(qbuf, reverse)
+
+def _zeros(typecode, n):
+    # array * n copies the item one by one, repeating a bigger block is
+    # an order of magnitude faster for long arrays.
+    block = array.array(typecode, [0]) * min(n, 4096)
+    if n <= len(block):
+        return block
+    arr = block * (n // len(block))
+    arr.extend(block[:n % len(block)])
     return arr
 
-def do_or(qbuf_a, qbuf_b):
+def unpack_into(qbuf, buf, itemsize=8, reverse=False):
     '''
+    Decodes qbuf straight into a writable buffer (array, bytearray,
+    numpy array, mmap) as 4 or 8 byte native integers, in descending
+    order if reverse is set. Returns the number of items stored, raises
+    ListTooBigError if the buffer is too small.
+
+    >>> buf = bytearray(16)
+    >>> unpack_into(pack([1, 2, 3]), buf, 4, reverse=True)
+    3
+    >>> array.array('I', str(buf[:12]))
+    array('I', [3L, 2L, 1L])
+    >>> unpack_into(pack(range(5)), buf, 4)
+    Traceback (most recent call last):
+    ...
+    ListTooBigError: buffer too small for 5 items
+    '''
+    return _qlist.unpack_into(qbuf, buf, itemsize, reverse)
+
+def unpack_numpy(qbuf, reverse=False, dtype='uint64'):
+    '''
+    Items as a numpy array of uint64 or uint32, decoded in place. numpy
+    is imported only here, it's not required otherwise.
+    '''
+    import numpy
+    arr = numpy.empty(count(qbuf), dtype=dtype)
+    unpack_into(qbuf, arr, arr.itemsize, reverse)
+    return arr
+
+# All the set operations take an optional limit: only the first limit
+# items of the result, or the last ones with reverse set, are computed
+# and the operation stops as soon as it has them.
+
+def do_or(qbuf_a, qbuf_b, limit=0, reverse=False):
+    '''
+    >>> unpack( do_or(pack([1, 4, 7]), pack([2, 4, 9]), limit=3, reverse=True) )
+    array('L', [4L, 7L, 9L])
+    '''
+    return _qlist.do_or(qbuf_a, qbuf_b, limit, reverse)
+
+def do_and(qbuf_a, qbuf_b, limit=0, reverse=False):
+    '''
+    >>> unpack( do_and(pack(range(100)), pack(range(0, 100, 7)), limit=2) )
+    array('L', [0L, 7L])
+    '''
+    return _qlist.do_and(qbuf_a, qbuf_b, limit, reverse)
+
+def do_andnot(qbuf_a, qbuf_b, limit=0, reverse=False):
+    '''
+    >>> unpack( do_andnot(pack(range(10)), pack([8]), limit=2, reverse=True) )
+    array('L', [7L, 9L])
+    '''
+    return _qlist.do_andnot(qbuf_a, qbuf_b, limit, reverse)
+
+def do_and_many(qbufs, limit=0, reverse=False):
+    '''
+    Intersection of all the qbufs, done in one pass starting from the
+    shortest one. The result has the format of qbufs[0].
+
+    >>> unpack( do_and_many([pack([1,2,3,4]), pack([2,3,4]), pack([3,4,5])]) )
+    array('L', [3L, 4L])
+    '''
+    return _qlist.do_and_many(qbufs, [], limit, reverse)
+
+def do_or_many(qbufs, limit=0, reverse=False):
+    '''
+    >>> unpack( do_or_many([pack([1,5]), pack([2,5]), pack([3])]) )
+    array('L', [1L, 2L, 3L, 5L])
+    >>> unpack( do_or_many([pack([1,5]), pack([2,5]), pack([3])], limit=2) )
+    array('L', [1L, 2L])
+    '''
+    return _qlist.do_or_many(qbufs, limit, reverse)
+
+def do_andnot_many(qbufs, not_qbufs, limit=0, reverse=False):
+    '''
+    Items present in all of qbufs and in none of not_qbufs.
+
+    >>> unpack( do_andnot_many([pack([1,2,3,4]), pack([2,3,4])], [pack([3]), pack([4,9])]) )
+    array('L', [2L])
+    '''
+    return _qlist.do_andnot_many(qbufs, not_qbufs, limit, reverse)
+
+def count(qbuf):
+    '''
+    >>> count(pack([1, 2, 3])), count(pack(range(300), fmt=FMT_BLOCKS))
+    (3, 300)
+    '''
+    return _qlist.count(qbuf)
+
+def count_and_many(qbufs):
+    '''
+    Number of items present in all of qbufs.
+
+    >>> count_and_many([pack([1, 2, 3]), pack([2, 3, 4])])
+    2
+    '''
+    return _qlist.count_and_many(qbufs)
+
+def count_andnot_many(qbufs, not_qbufs):
+    return _qlist.count_andnot_many(qbufs, not_qbufs)
+
+def count_or_many(qbufs):
+    return _qlist.count_or_many(qbufs)
+
+def append(qbuf_a, qbuf_b):
+    '''
+    qbuf_a with the items of qbuf_b added at the end, or None unless
+    qbuf_a is tailed and qbuf_b starts above its last item. The result
+    is the same as do_or(), but qbuf_a is copied, not decoded.
+
+    >>> t = pack([1, 5], fmt=FMT_SVB | FMT_TAILED)
+    >>> unpack(append(t, pack([6, 300]))), count(append(t, pack([6])))
+    (array('L', [1L, 5L, 6L, 300L]), 3)
+    >>> append(t, pack([5, 6])) is None, append(pack([1, 5]), pack([6])) is None
+    (True, True)
+    >>> unpack(append(pack([], fmt=FMT_TAILED), pack([0, 2])))
+    array('L', [0L, 2L])
     '''
-    return _qlist.do_or(qbuf_a, qbuf_b)
+    return _qlist.append(qbuf_a, qbuf_b)
 
-def do_and(qbuf_a, qbuf_b):
+def is_empty(qbuf):
     '''
+    >>> is_empty(pack([])), is_empty(pack([], fmt=FMT_BLOCKS)), is_empty(pack([0]))
+    (True, True, False)
     '''
-    return _qlist.do_and(qbuf_a, qbuf_b)
+    return _qlist.is_empty(qbuf)
 
-def do_andnot(qbuf_a, qbuf_b):
+def get_format(qbuf):
     '''
+    >>> get_format(pack([1])) == FMT_PLAIN
+    True
+    >>> get_format(pack([1], fmt=FMT_BLOCKS | FMT_TAILED)) == FMT_BLOCKS
+    True
     '''
-    return _qlist.do_andnot(qbuf_a, qbuf_b)
+    return _qlist.get_format(qbuf)
 
 def is_valid(qbuf):
     return is_qbuf(qbuf)
 
 def is_qbuf(qbuf):
-    return isinstance(qbuf, str) and qbuf.startswith('\x10\xde\xad\xbe\xef\xde\xad\xba\xaf')
+    return isinstance(qbuf, str) and \
+        qbuf[:9] in ('\x10\xde\xad\xbe\xef\xde\xad\xba\xc0',
+                     '\x10\xde\xad\xbe\xef\xde\xad\xba\xc1',
+                     '\x10\xde\xad\xbe\xef\xde\xad\xba\xc2',
+                     '\x10\xde\xad\xbe\xef\xde\xad\xba\xd0',
+                     '\x10\xde\xad\xbe\xef\xde\xad\xba\xd1',
+                     '\x10\xde\xad\xbe\xef\xde\xad\xba\xd2',
+                     '\x10\xde\xad\xbe\xef\xde\xad\xba\xaf',
+                     '\x10\xde\xad\xbe\xef\xde\xad\xba\xb1',
+                     '\x10\xde\xad\xbe\xef\xde\xad\xba\xb3')
 
 
 if __name__ == "__main__":
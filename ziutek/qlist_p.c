@@ -4,11 +4,6 @@
 static PyObject *ListTooBig;
 static PyObject *NotSorted;
 
-/* warn: allocated on stack */
-/* +magic +firstitem +<1M items> +stop +9bytes_safety= */
-#define MAX_BUF_SIZE (9 +9 +1024*1024 +1 +9)
-#define MAX_ITEMS_NUMBER (1024*1024+1)
-
 // stolen from sqlite
 #if defined(COVERAGE_TEST)
 # define ALWAYS(X)      (1)
@@ -21,73 +16,167 @@ static PyObject *NotSorted;
 # define NEVER(X)       (X)
 #endif
 
+/*
+	The GIL is released while qbufs are encoded, decoded or merged, so
+	threads can work on different chunks at once. Taking it back costs
+	more than a short qbuf takes to process, below NOGIL_MIN_SZ input
+	bytes it's kept. Strings can't change meanwhile, other buffers must
+	not be resized by another thread during the call, like with
+	file.readinto.
+*/
+#define NOGIL_MIN_SZ 4096
+
+#define NOGIL_BEGIN(sz)						\
+	{							\
+		PyThreadState *_save = NULL;			\
+		if ((sz) >= NOGIL_MIN_SZ)			\
+			_save = PyEval_SaveThread();
+
+#define NOGIL_END						\
+		if (_save)					\
+			PyEval_RestoreThread(_save);		\
+	}
+
+/*
+	Worst case size of a qbuf of n items in any format: header, 9 bytes
+	per delta doubled (a 9 byte delta may become an 11 byte header only
+	block in the Stream VByte format), a block header per 128 items,
+	stop byte and the writer's slack, which is a whole block for Stream
+	VByte. It's the item count that bounds a result, not the size of
+	the inputs: the same deltas take up to 2.8 times more bytes as
+	varints than in Stream VByte.
+*/
+static Py_ssize_t qbuf_bound(Py_ssize_t n)
+{
+	return 25 + 18 * n + 11 * (n / 128 + 1) + 1 + 20 + 32 + 4 * 128;
+}
+
+/*
+	Result string big enough for n items, qbuf_finish() shrinks it to
+	the real size. Only the touched pages of a big one are ever used.
+*/
+static PyObject *qbuf_alloc(Py_ssize_t n)
+{
+	if (n > INT_MAX / 18) {
+		PyErr_Format(ListTooBig, "result is too big to fit into qbuf");
+		return NULL;
+	}
+	return PyString_FromStringAndSize(NULL, qbuf_bound(n));
+}
+
+/*
+	Items in the qbufs: the fewest of them, the most a result of an AND
+	can have, or all of them for an OR. Only lists without the count in
+	the header are scanned.
+	-1: bad magic, error set
+*/
+static Py_ssize_t qbufs_items(u_int8_t **qps, int qps_n, int fewest)
+{
+	Py_ssize_t items = 0;
+	int i;
+	for (i = 0; i < qps_n; i++) {
+		int n = qlist_count(qps[i]);
+		if (n < 0) {
+			PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
+			return -1;
+		}
+		if (!fewest)
+			items += n;
+		else if (i == 0 || n < items)
+			items = n;
+	}
+	return items;
+}
+
+/* Steals the reference. */
+static PyObject *qbuf_finish(PyObject *ret, int r)
+{
+	if (r < 0) {
+		Py_DECREF(ret);
+		if (r == -1)
+			PyErr_Format(ListTooBig, "result is too big to fit into qbuf");
+		if (r == -2)
+			PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
+		if (r == -3)
+			PyErr_NoMemory();
+		return NULL;
+	}
+	if (_PyString_Resize(&ret, r) < 0)
+		return NULL;
+	return ret;
+}
+
 static PyObject *qlist_pack_array(PyObject *self, PyObject *args) 
 {
-	char *arr;
-	int arr_sz;
+	PyObject *src;
+	const void *arr;
+	Py_ssize_t arr_sz;
 	int itemsize;
-	if (!PyArg_ParseTuple(args, "s#i", &arr, &arr_sz, &itemsize)) {
-		PyErr_Format(PyExc_TypeError, "<string> <itemsize> required");
+	int format = QLIST_FMT_PLAIN;
+	if (!PyArg_ParseTuple(args, "Oi|i", &src, &itemsize, &format)) {
+		PyErr_Format(PyExc_TypeError, "<buffer> <itemsize> [format] required");
 		return NULL;
 	}
+	/* Any object with a buffer, nothing is copied. */
+	if (PyObject_AsReadBuffer(src, &arr, &arr_sz) < 0)
+		return NULL;
 	
 	if (itemsize != 4 && itemsize != 8) {
 		PyErr_Format(PyExc_TypeError, "itemsize must be 4 or 8");
 		return NULL;
 	}
 
+	int base_format = format & ~QLIST_FMT_TAILED;
+	if (base_format < QLIST_FMT_PLAIN || base_format > QLIST_FMT_SVB) {
+		PyErr_Format(PyExc_TypeError, "unknown format %i", format);
+		return NULL;
+	}
+
 	if (arr_sz % itemsize) {
 		PyErr_Format(PyExc_TypeError,
-				"string size must be a multiplication of %i",
+				"buffer size must be a multiplication of %i",
 				itemsize);
 		return NULL;
 	}
-	int items_sz = arr_sz/itemsize;
-	u_int64_t *items;
-	
-	if(itemsize == 4) {
-		items = (u_int64_t*)PyMem_Malloc(sizeof(u_int64_t) * items_sz);
-		if (NEVER(items == NULL)) {
-			PyErr_NoMemory();
-			return NULL;
-		}
-		int i;
-		unsigned int *items32 = (unsigned int *)arr;
-		for(i = 0; i < items_sz; i++) {
-			items[i] = items32[i];
-		}
-	} else { // itemsize = 8
-		items = (u_int64_t *)arr;
-	}
-	char qbuf[MAX_BUF_SIZE];
-	int r = qlist_pack((u_int8_t*)qbuf, sizeof(qbuf), items, items_sz);
-	if(itemsize == 4) {
-		PyMem_FREE(items);
-	}
-	if(r == -1) {
+	if (arr_sz / itemsize > INT_MAX) {
 		PyErr_Format(ListTooBig, "supplied data is too big to fit into qlist");
 		return NULL;
 	}
+	int items_sz = arr_sz/itemsize;
+	PyObject *ret = qbuf_alloc(items_sz);
+	if(ret == NULL)
+		return NULL;
+	int r;
+	NOGIL_BEGIN(arr_sz);
+	if(itemsize == 4) {
+		r = qlist_pack32((u_int8_t*)PyString_AS_STRING(ret),
+				PyString_GET_SIZE(ret), (u_int32_t*)arr, items_sz, format);
+	} else {
+		r = qlist_pack((u_int8_t*)PyString_AS_STRING(ret),
+				PyString_GET_SIZE(ret), (u_int64_t*)arr, items_sz, format);
+	}
+	NOGIL_END;
 	if(r == -2) {
+		Py_DECREF(ret);
 		PyErr_Format(NotSorted, "items aren't sorted");
 		return NULL;
 	}
-	
-	return PyString_FromStringAndSize(qbuf, r);
+	return qbuf_finish(ret, r);
 }
 
 
-static PyObject *qlist_unpack_to_array(PyObject *self, PyObject *args)
-{	
-	PyObject *ret;
+static PyObject *qlist_unpack_into(PyObject *self, PyObject *args)
+{
 	char *qbuf;
 	int qbuf_sz;
+	PyObject *dst;
 	int itemsize;
-	if (!PyArg_ParseTuple(args, "s#i", &qbuf, &qbuf_sz, &itemsize)) {
-		PyErr_Format(PyExc_TypeError, "<string> <itemsize> required");
+	int reverse = 0;
+	if (!PyArg_ParseTuple(args, "s#Oi|i", &qbuf, &qbuf_sz, &dst, &itemsize, &reverse)) {
+		PyErr_Format(PyExc_TypeError, "<string> <writable buffer> <itemsize> [reverse] required");
 		return NULL;
 	}
-	
+
 	if (itemsize != 4 && itemsize != 8) {
 		PyErr_Format(PyExc_TypeError, "itemsize must be 4 or 8");
 		return NULL;
@@ -97,38 +186,90 @@ static PyObject *qlist_unpack_to_array(PyObject *self, PyObject *args)
 		return NULL;
 	}
 
-	u_int64_t *items = (u_int64_t*)PyMem_Malloc(sizeof(u_int64_t) * MAX_ITEMS_NUMBER );
-	if (NEVER(items == NULL)) {
-		PyErr_NoMemory();
+	void *buf;
+	Py_ssize_t buf_sz;
+	if (PyObject_AsWriteBuffer(dst, &buf, &buf_sz) < 0)
+		return NULL;
+
+	int items_sz = qlist_count((u_int8_t*)qbuf);
+	if(items_sz < 0) {
+		PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
+		return NULL;
+	}
+	if(items_sz > buf_sz / itemsize) {
+		PyErr_Format(ListTooBig, "buffer too small for %i items", items_sz);
+		return NULL;
+	}
+	if(items_sz && (Py_uintptr_t)buf % itemsize) {
+		PyErr_Format(PyExc_TypeError, "buffer isn't aligned to %i bytes", itemsize);
 		return NULL;
 	}
-	int items_sz = MAX_ITEMS_NUMBER;
 
-	int r = qlist_unpack(items, items_sz, (u_int8_t*)qbuf);
+	int r;
+	NOGIL_BEGIN(qbuf_sz);
+	r = qlist_unpack_to(buf, items_sz, itemsize, reverse, (u_int8_t*)qbuf);
+	NOGIL_END;
 	if(r < 0) {
-		if(r == -1)
-			PyErr_Format(ListTooBig, "supplied qbuf is too big to fit into array");
-		if(r == -2)
-			PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
-		ret = NULL;
-		goto done;
+		PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
+		return NULL;
 	}
+	return PyInt_FromLong(r);
+}
 
-	if(itemsize == 8) {
-		ret = PyString_FromStringAndSize((char *)items, sizeof(u_int64_t) * r);
-		goto done;
+static PyObject *qlist_get_format(PyObject *self, PyObject *args)
+{
+	char *qbuf;
+	int qbuf_sz;
+	if (!PyArg_ParseTuple(args, "s#", &qbuf, &qbuf_sz)) {
+		PyErr_Format(PyExc_TypeError, "<string> required");
+		return NULL;
+	}
+	int format = -1;
+	if(qbuf_sz >= 9)
+		format = qlist_format((u_int8_t*)qbuf);
+	if(format < 0) {
+		PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
+		return NULL;
 	}
+	return PyInt_FromLong(format);
+}
 
-	// itemsize == 4, reuse the same buffer
-	int i;
-	u_int32_t *items32 = (u_int32_t *)items;
-	for(i = 0; i < r; i++) {
-		items32[i] = items[i];
+static PyObject *qlist_do_count(PyObject *self, PyObject *args)
+{
+	char *qbuf;
+	int qbuf_sz;
+	if (!PyArg_ParseTuple(args, "s#", &qbuf, &qbuf_sz)) {
+		PyErr_Format(PyExc_TypeError, "<string> required");
+		return NULL;
 	}
-	ret = PyString_FromStringAndSize((char *)items, sizeof(u_int32_t) * r);
-done:
-	PyMem_FREE(items);
-	return(ret);
+	if(qbuf_sz < 1) {
+		PyErr_Format(PyExc_TypeError, "qbuf must contain some data");
+		return NULL;
+	}
+	int r = qlist_count((u_int8_t*)qbuf);
+	if(r < 0) {
+		PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
+		return NULL;
+	}
+	return PyInt_FromLong(r);
+}
+
+static PyObject *qlist_do_is_empty(PyObject *self, PyObject *args)
+{
+	char *qbuf;
+	int qbuf_sz;
+	if (!PyArg_ParseTuple(args, "s#", &qbuf, &qbuf_sz)) {
+		PyErr_Format(PyExc_TypeError, "<string> required");
+		return NULL;
+	}
+	int r = -2;
+	if(qbuf_sz >= 10)
+		r = qlist_is_empty((u_int8_t*)qbuf);
+	if(r < 0) {
+		PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
+		return NULL;
+	}
+	return PyBool_FromLong(r);
 }
 
 #define PREFIX					\
@@ -136,8 +277,11 @@ done:
 	int qbufa_sz;				\
 	char *qbufb;				\
 	int qbufb_sz;				\
-	if (!PyArg_ParseTuple(args, "s#s#", &qbufa, &qbufa_sz, &qbufb, &qbufb_sz)) {	\
-		PyErr_Format(PyExc_TypeError, "<string> <string> required");		\
+	int limit = 0;				\
+	int reverse = 0;			\
+	if (!PyArg_ParseTuple(args, "s#s#|ii", &qbufa, &qbufa_sz, &qbufb, &qbufb_sz,	\
+			      &limit, &reverse)) {	\
+		PyErr_Format(PyExc_TypeError, "<string> <string> [limit] [reverse] required");	\
 		return NULL;			\
 	}					\
 	if(qbufa_sz < 1 || qbufb_sz < 1) {	\
@@ -145,51 +289,1167 @@ done:
 		return NULL;			\
 	}					\
 						\
-	char qbufc[MAX_BUF_SIZE];		\
+	PyObject *ret;				\
+	u_int8_t *qbufc;			\
 	int r;
 
+/* Room for the items of the qbufs, all of them or the fewest. */
+#define ALLOC(fewest, ...)					\
+	{							\
+		u_int8_t *_qps[] = {__VA_ARGS__};		\
+		Py_ssize_t _n = qbufs_items(_qps, sizeof(_qps) / sizeof(_qps[0]),	\
+					    fewest);		\
+		if (_n < 0)					\
+			return NULL;				\
+		ret = qbuf_alloc(_n);				\
+		if (ret == NULL)				\
+			return NULL;				\
+		qbufc = (u_int8_t*)PyString_AS_STRING(ret);	\
+	}
+
 #define SUFFIX					\
-	if(r == -1) {				\
-		PyErr_Format(ListTooBig, "result is too big to fit into qbuf");	\
-		return NULL;			\
-	}					\
-	if(r == -2) {				\
-		PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");	\
-		return NULL;			\
-	}					\
-						\
-	return PyString_FromStringAndSize(qbufc, r);
+	return qbuf_finish(ret, r);
+
+/* With a limit the n-way versions are used, they know how to stop early. */
+#define QPS(...)				\
+	u_int8_t *qps[] = {__VA_ARGS__};	\
+	int format = qlist_format((u_int8_t*)qbufa);
+
+/* None when qbufb can't be appended, see qlist_append. */
+static PyObject *qlist_do_append(PyObject *self, PyObject *args)
+{
+	char *qbufa;
+	int qbufa_sz;
+	char *qbufb;
+	int qbufb_sz;
+	if (!PyArg_ParseTuple(args, "s#s#", &qbufa, &qbufa_sz, &qbufb, &qbufb_sz)) {
+		PyErr_Format(PyExc_TypeError, "<string> <string> required");
+		return NULL;
+	}
+	if(qbufa_sz < 1 || qbufb_sz < 1) {
+		PyErr_Format(PyExc_TypeError, "qbuf must contain some data");
+		return NULL;
+	}
+	PyObject *ret;
+	u_int8_t *qbufc;
+	int r;
+	/* qbufa is copied as it is, qbufb written in its format. */
+	ALLOC(0, (u_int8_t*)qbufa, (u_int8_t*)qbufb);
+	NOGIL_BEGIN(qbufa_sz + qbufb_sz);
+	memcpy(qbufc, qbufa, qbufa_sz);
+	r = qlist_append(qbufc, qbufa_sz, PyString_GET_SIZE(ret), (u_int8_t*)qbufb);
+	NOGIL_END;
+	if (r == -3) {
+		Py_DECREF(ret);
+		Py_RETURN_NONE;
+	}
+	SUFFIX;
+}
 
 static PyObject *qlist_do_or(PyObject *self, PyObject *args)
 {
 	PREFIX;
-	r = qlist_or((u_int8_t*)qbufc, sizeof(qbufc), (u_int8_t*)qbufa, (u_int8_t*)qbufb);
+	ALLOC(0, (u_int8_t*)qbufa, (u_int8_t*)qbufb);
+	NOGIL_BEGIN(qbufa_sz + qbufb_sz);
+	if (limit > 0) {
+		QPS((u_int8_t*)qbufa, (u_int8_t*)qbufb);
+		r = qlist_or_many(qbufc, PyString_GET_SIZE(ret), format, qps, 2,
+				  limit, reverse);
+	} else
+		r = qlist_or(qbufc, PyString_GET_SIZE(ret), (u_int8_t*)qbufa, (u_int8_t*)qbufb);
+	NOGIL_END;
 	SUFFIX;
 }
 
 static PyObject *qlist_do_and(PyObject *self, PyObject *args)
 {
 	PREFIX;
-	r = qlist_and((u_int8_t*)qbufc, sizeof(qbufc), (u_int8_t*)qbufa, (u_int8_t*)qbufb);
+	ALLOC(1, (u_int8_t*)qbufa, (u_int8_t*)qbufb);
+	NOGIL_BEGIN(qbufa_sz + qbufb_sz);
+	if (limit > 0) {
+		QPS((u_int8_t*)qbufa, (u_int8_t*)qbufb);
+		r = qlist_and_many(qbufc, PyString_GET_SIZE(ret), format, qps, 2,
+				   NULL, 0, limit, reverse);
+	} else
+		r = qlist_and(qbufc, PyString_GET_SIZE(ret), (u_int8_t*)qbufa, (u_int8_t*)qbufb);
+	NOGIL_END;
 	SUFFIX;
 }
 
 static PyObject *qlist_do_andnot(PyObject *self, PyObject *args)
 {
 	PREFIX;
-	r = qlist_andnot((u_int8_t*)qbufc, sizeof(qbufc), (u_int8_t*)qbufa, (u_int8_t*)qbufb);
+	ALLOC(1, (u_int8_t*)qbufa);
+	NOGIL_BEGIN(qbufa_sz + qbufb_sz);
+	if (limit > 0) {
+		QPS((u_int8_t*)qbufa);
+		u_int8_t *nots[] = {(u_int8_t*)qbufb};
+		r = qlist_and_many(qbufc, PyString_GET_SIZE(ret), format, qps, 1,
+				   nots, 1, limit, reverse);
+	} else
+		r = qlist_andnot(qbufc, PyString_GET_SIZE(ret), (u_int8_t*)qbufa, (u_int8_t*)qbufb);
+	NOGIL_END;
 	SUFFIX;
 }
 
 
 
+struct qbuf_ref {
+	u_int8_t *qbuf;
+	Py_ssize_t qbuf_sz;
+};
+
+static int qbuf_ref_cmp(const void *a, const void *b)
+{
+	Py_ssize_t sa = ((struct qbuf_ref *)a)->qbuf_sz;
+	Py_ssize_t sb = ((struct qbuf_ref *)b)->qbuf_sz;
+	return (sa > sb) - (sa < sb);
+}
+
+/*
+	Unpacks a sequence of qbufs into a PyMem_Malloc'ed array of pointers,
+	optionally shortest first. Returns a new reference that keeps the
+	strings alive, *format is set to the format of the first qbuf.
+*/
+static PyObject *qbufs_from_sequence(PyObject *seq, u_int8_t ***qps_ptr,
+				     int *qps_n, int shortest_first, int *format,
+				     Py_ssize_t *sum_sz)
+{
+	/* A tuple, not the list itself: the strings must stay alive with
+	   the GIL released even if another thread changes the list. */
+	PyObject *fast = PySequence_Tuple(seq);
+	if (fast == NULL) {
+		PyErr_Clear();
+		PyErr_Format(PyExc_TypeError, "sequence of qbufs required");
+		return NULL;
+	}
+	int n = PySequence_Fast_GET_SIZE(fast);
+	struct qbuf_ref *refs = PyMem_Malloc(sizeof(struct qbuf_ref) * (n + 1));
+	u_int8_t **qps = PyMem_Malloc(sizeof(u_int8_t *) * (n + 1));
+	if (NEVER(refs == NULL || qps == NULL)) {
+		PyMem_FREE(refs);
+		PyMem_FREE(qps);
+		Py_DECREF(fast);
+		PyErr_NoMemory();
+		return NULL;
+	}
+	int i;
+	for (i = 0; i < n; i++) {
+		char *qbuf;
+		Py_ssize_t qbuf_sz;
+		PyObject *item = PySequence_Fast_GET_ITEM(fast, i);
+		if (PyString_AsStringAndSize(item, &qbuf, &qbuf_sz) == -1 || qbuf_sz < 1) {
+			PyErr_Clear();
+			PyErr_Format(PyExc_TypeError, "qbuf must contain some data");
+			PyMem_FREE(refs);
+			PyMem_FREE(qps);
+			Py_DECREF(fast);
+			return NULL;
+		}
+		refs[i].qbuf = (u_int8_t *)qbuf;
+		refs[i].qbuf_sz = qbuf_sz;
+		if (sum_sz)
+			*sum_sz += qbuf_sz;
+	}
+	if (format && n)
+		*format = qlist_format(refs[0].qbuf);
+	if (shortest_first)
+		qsort(refs, n, sizeof(struct qbuf_ref), qbuf_ref_cmp);
+	for (i = 0; i < n; i++)
+		qps[i] = refs[i].qbuf;
+	PyMem_FREE(refs);
+	*qps_ptr = qps;
+	*qps_n = n;
+	return fast;
+}
+
+static PyObject *qlist_do_andnot_many(PyObject *self, PyObject *args)
+{
+	PyObject *seq;
+	PyObject *nots_seq = NULL;
+	int limit = 0;
+	int reverse = 0;
+	if (!PyArg_ParseTuple(args, "O|Oii", &seq, &nots_seq, &limit, &reverse)) {
+		PyErr_Format(PyExc_TypeError, "<sequence> [<sequence>] [limit] [reverse] required");
+		return NULL;
+	}
+	u_int8_t **qps = NULL;
+	u_int8_t **nots = NULL;
+	int qps_n = 0;
+	int nots_n = 0;
+	int format = QLIST_FMT_PLAIN;
+	PyObject *ret = NULL;
+	PyObject *fast_nots = NULL;
+	Py_ssize_t sum_sz = 0;
+	PyObject *fast = qbufs_from_sequence(seq, &qps, &qps_n, 1, &format,
+					     &sum_sz);
+	if (fast == NULL)
+		return NULL;
+	if (nots_seq) {
+		fast_nots = qbufs_from_sequence(nots_seq, &nots, &nots_n, 0, NULL,
+						NULL);
+		if (fast_nots == NULL)
+			goto done;
+	}
+	if (qps_n < 1) {
+		PyErr_Format(PyExc_TypeError, "at least one qbuf required");
+		goto done;
+	}
+	if (qps_n == 1 && nots_n == 0 && limit <= 0) {
+		ret = PySequence_Fast_GET_ITEM(fast, 0);
+		Py_INCREF(ret);
+		goto done;
+	}
+	Py_ssize_t items = qbufs_items(qps, qps_n, 1);
+	if (items < 0)
+		goto done;
+	ret = qbuf_alloc(items);
+	if (ret == NULL)
+		goto done;
+	int r;
+	NOGIL_BEGIN(sum_sz);
+	r = qlist_and_many((u_int8_t*)PyString_AS_STRING(ret),
+			   PyString_GET_SIZE(ret), format,
+			   qps, qps_n, nots, nots_n, limit, reverse);
+	NOGIL_END;
+	ret = qbuf_finish(ret, r);
+done:
+	PyMem_FREE(qps);
+	PyMem_FREE(nots);
+	Py_DECREF(fast);
+	Py_XDECREF(fast_nots);
+	return ret;
+}
+
+static PyObject *qlist_do_or_many(PyObject *self, PyObject *args)
+{
+	PyObject *seq;
+	int limit = 0;
+	int reverse = 0;
+	if (!PyArg_ParseTuple(args, "O|ii", &seq, &limit, &reverse)) {
+		PyErr_Format(PyExc_TypeError, "<sequence> [limit] [reverse] required");
+		return NULL;
+	}
+	u_int8_t **qps = NULL;
+	int qps_n = 0;
+	int format = QLIST_FMT_PLAIN;
+	PyObject *ret = NULL;
+	Py_ssize_t sum_sz = 0;
+	PyObject *fast = qbufs_from_sequence(seq, &qps, &qps_n, 0, &format,
+					     &sum_sz);
+	if (fast == NULL)
+		return NULL;
+	if (qps_n < 1) {
+		PyErr_Format(PyExc_TypeError, "at least one qbuf required");
+		goto done;
+	}
+	if (qps_n == 1 && limit <= 0) {
+		ret = PySequence_Fast_GET_ITEM(fast, 0);
+		Py_INCREF(ret);
+		goto done;
+	}
+	Py_ssize_t items = qbufs_items(qps, qps_n, 0);
+	if (items < 0)
+		goto done;
+	ret = qbuf_alloc(items);
+	if (ret == NULL)
+		goto done;
+	int r;
+	NOGIL_BEGIN(sum_sz);
+	r = qlist_or_many((u_int8_t*)PyString_AS_STRING(ret),
+			  PyString_GET_SIZE(ret), format, qps, qps_n,
+			  limit, reverse);
+	NOGIL_END;
+	ret = qbuf_finish(ret, r);
+done:
+	PyMem_FREE(qps);
+	Py_DECREF(fast);
+	return ret;
+}
+
+/* Same as do_andnot_many, but the result is only counted. */
+static PyObject *qlist_count_andnot_many(PyObject *self, PyObject *args)
+{
+	PyObject *seq;
+	PyObject *nots_seq = NULL;
+	if (!PyArg_ParseTuple(args, "O|O", &seq, &nots_seq)) {
+		PyErr_Format(PyExc_TypeError, "<sequence> [<sequence>] required");
+		return NULL;
+	}
+	u_int8_t **qps = NULL;
+	u_int8_t **nots = NULL;
+	int qps_n = 0;
+	int nots_n = 0;
+	PyObject *ret = NULL;
+	PyObject *fast_nots = NULL;
+	Py_ssize_t sum_sz = 0;
+	PyObject *fast = qbufs_from_sequence(seq, &qps, &qps_n, 1, NULL,
+					     &sum_sz);
+	if (fast == NULL)
+		return NULL;
+	if (nots_seq) {
+		fast_nots = qbufs_from_sequence(nots_seq, &nots, &nots_n, 0, NULL,
+						NULL);
+		if (fast_nots == NULL)
+			goto done;
+	}
+	if (qps_n < 1) {
+		PyErr_Format(PyExc_TypeError, "at least one qbuf required");
+		goto done;
+	}
+	int r;
+	if (qps_n == 1 && nots_n == 0)
+		r = qlist_count(qps[0]);
+	else {
+		NOGIL_BEGIN(sum_sz);
+		r = qlist_and_many(NULL, 0, QLIST_FMT_PLAIN, qps, qps_n,
+				   nots, nots_n, 0, 0);
+		NOGIL_END;
+	}
+	if (r < 0)
+		PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
+	else
+		ret = PyInt_FromLong(r);
+done:
+	PyMem_FREE(qps);
+	PyMem_FREE(nots);
+	Py_DECREF(fast);
+	Py_XDECREF(fast_nots);
+	return ret;
+}
+
+/* Same as do_or_many, but the result is only counted. */
+static PyObject *qlist_count_or_many(PyObject *self, PyObject *args)
+{
+	PyObject *seq;
+	if (!PyArg_ParseTuple(args, "O", &seq)) {
+		PyErr_Format(PyExc_TypeError, "<sequence> required");
+		return NULL;
+	}
+	u_int8_t **qps = NULL;
+	int qps_n = 0;
+	PyObject *ret = NULL;
+	Py_ssize_t sum_sz = 0;
+	PyObject *fast = qbufs_from_sequence(seq, &qps, &qps_n, 0, NULL,
+					     &sum_sz);
+	if (fast == NULL)
+		return NULL;
+	int r;
+	if (qps_n == 1)
+		r = qlist_count(qps[0]);
+	else {
+		NOGIL_BEGIN(sum_sz);
+		r = qlist_or_many(NULL, 0, QLIST_FMT_PLAIN, qps, qps_n, 0, 0);
+		NOGIL_END;
+	}
+	if (r < 0)
+		PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
+	else
+		ret = PyInt_FromLong(r);
+	PyMem_FREE(qps);
+	Py_DECREF(fast);
+	return ret;
+}
+
+
+typedef struct {
+	PyObject_HEAD
+	PyObject *qbuf;		/* keeps the string alive */
+	struct qlist_cursor *c;
+} Cursor;
+
+static int Cursor_init(Cursor *self, PyObject *args, PyObject *kwds)
+{
+	static char *kwlist[] = {"qbuf", "reverse", NULL};
+	PyObject *qbuf;
+	int reverse = 0;
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "S|i", kwlist, &qbuf, &reverse))
+		return -1;
+	if (PyString_GET_SIZE(qbuf) < 1) {
+		PyErr_Format(PyExc_TypeError, "qbuf must contain some data");
+		return -1;
+	}
+	struct qlist_cursor *c = qlist_cursor_new((u_int8_t*)PyString_AS_STRING(qbuf), reverse);
+	if (c == NULL) {
+		PyErr_Format(PyExc_TypeError, "qbuf magic is invalid");
+		return -1;
+	}
+	if (self->c)
+		qlist_cursor_free(self->c);
+	Py_XDECREF(self->qbuf);
+	Py_INCREF(qbuf);
+	self->qbuf = qbuf;
+	self->c = c;
+	return 0;
+}
+
+static void Cursor_dealloc(Cursor *self)
+{
+	if (self->c)
+		qlist_cursor_free(self->c);
+	Py_XDECREF(self->qbuf);
+	self->ob_type->tp_free((PyObject*)self);
+}
+
+static PyObject *Cursor_result(int r, u_int64_t item)
+{
+	if (r == -2)
+		return PyErr_NoMemory();
+	if (r < 0)
+		return NULL;
+	return PyLong_FromUnsignedLongLong(item);
+}
+
+static PyObject *Cursor_iternext(Cursor *self)
+{
+	u_int64_t item = 0;
+	if (self->c == NULL) {
+		PyErr_Format(PyExc_TypeError, "cursor not initialized");
+		return NULL;
+	}
+	int r = qlist_cursor_next(self->c, &item);
+	return Cursor_result(r, item);
+}
+
+static PyObject *Cursor_seek(Cursor *self, PyObject *args)
+{
+	unsigned PY_LONG_LONG target;
+	u_int64_t item = 0;
+	if (!PyArg_ParseTuple(args, "K", &target))
+		return NULL;
+	if (self->c == NULL) {
+		PyErr_Format(PyExc_TypeError, "cursor not initialized");
+		return NULL;
+	}
+	int r = qlist_cursor_seek(self->c, target, &item);
+	PyObject *ret = Cursor_result(r, item);
+	if (ret == NULL && !PyErr_Occurred())
+		Py_RETURN_NONE;
+	return ret;
+}
+
+static PyMethodDef Cursor_methods[] = {
+	{"seek", (PyCFunction)Cursor_seek, METH_VARARGS,
+	 "seek(item) -> first not yet returned item >= item (<= if reversed) or None"},
+	{NULL, NULL}
+};
+
+static PyTypeObject CursorType = {
+	PyObject_HEAD_INIT(NULL)
+	0,				/* ob_size */
+	"_qlist.Cursor",		/* tp_name */
+	sizeof(Cursor),			/* tp_basicsize */
+	0,				/* tp_itemsize */
+	(destructor)Cursor_dealloc,	/* tp_dealloc */
+	0,				/* tp_print */
+	0,				/* tp_getattr */
+	0,				/* tp_setattr */
+	0,				/* tp_compare */
+	0,				/* tp_repr */
+	0,				/* tp_as_number */
+	0,				/* tp_as_sequence */
+	0,				/* tp_as_mapping */
+	0,				/* tp_hash */
+	0,				/* tp_call */
+	0,				/* tp_str */
+	0,				/* tp_getattro */
+	0,				/* tp_setattro */
+	0,				/* tp_as_buffer */
+	Py_TPFLAGS_DEFAULT,		/* tp_flags */
+	"Cursor(qbuf, reverse=0), lazy iterator over the items of qbuf",	/* tp_doc */
+	0,				/* tp_traverse */
+	0,				/* tp_clear */
+	0,				/* tp_richcompare */
+	0,				/* tp_weaklistoffset */
+	PyObject_SelfIter,		/* tp_iter */
+	(iternextfunc)Cursor_iternext,	/* tp_iternext */
+	Cursor_methods,			/* tp_methods */
+	0,				/* tp_members */
+	0,				/* tp_getset */
+	0,				/* tp_base */
+	0,				/* tp_dict */
+	0,				/* tp_descr_get */
+	0,				/* tp_descr_set */
+	0,				/* tp_dictoffset */
+	(initproc)Cursor_init,		/* tp_init */
+	0,				/* tp_alloc */
+	PyType_GenericNew,		/* tp_new */
+};
+
+
+/*
+	Accumulator, postings of (word, chunk_no) keys buffered until they
+	are packed. Words are interned, keys are compared by pointer. Open
+	addressing with linear probing, a removed entry is filled by shifting
+	the following ones back, so there are no tombstones. Items are kept
+	32 bit wide until a docid doesn't fit, appended in any order and
+	sorted only when packed. Most keys get just a docid or two, those
+	are stored in place of the items pointer.
+*/
+struct acc_entry {
+	PyObject *word;		/* interned, owned; NULL for a free slot */
+	u_int64_t chunk;
+	void *items;		/* u_int32_t, u_int64_t if wide */
+	u_int32_t n;		/* appended items, duplicates included */
+	u_int32_t cap;		/* 0 if items are stored inline */
+	u_int8_t wide;
+	u_int8_t sorted;
+};
+
+#define ACC_INLINE(e) ((e)->wide ? 1 : 2)
+
+static inline void *acc_items(struct acc_entry *e)
+{
+	return e->cap ? e->items : (void *)&e->items;
+}
+
+typedef struct {
+	PyObject_HEAD
+	struct acc_entry *table;
+	size_t mask;		/* table size - 1 */
+	Py_ssize_t used;
+	Py_ssize_t items_bytes;
+} Accumulator;
+
+#define ACC_MIN_SIZE 64
+
+static size_t acc_hash(PyObject *word, u_int64_t chunk)
+{
+	size_t h = (size_t)PyObject_Hash(word);
+	return h ^ (size_t)(chunk * 0x9E3779B97F4A7C15ULL);
+}
+
+static struct acc_entry *acc_find(Accumulator *self, PyObject *word,
+				  u_int64_t chunk, size_t hash)
+{
+	/* Hashes of interned strings are cached, nothing is stored. */
+	size_t i = hash & self->mask;
+	while (1) {
+		struct acc_entry *e = &self->table[i];
+		if (e->word == NULL || (e->word == word && e->chunk == chunk))
+			return e;
+		i = (i + 1) & self->mask;
+	}
+}
+
+/* -1: out of memory */
+static int acc_resize(Accumulator *self, size_t size)
+{
+	struct acc_entry *old = self->table;
+	size_t old_size = old ? self->mask + 1 : 0;
+	struct acc_entry *table = PyMem_Malloc(sizeof(struct acc_entry) * size);
+	if (table == NULL)
+		return -1;
+	memset(table, 0, sizeof(struct acc_entry) * size);
+	self->table = table;
+	self->mask = size - 1;
+	size_t i;
+	for (i = 0; i < old_size; i++) {
+		if (old[i].word == NULL)
+			continue;
+		*acc_find(self, old[i].word, old[i].chunk,
+			  acc_hash(old[i].word, old[i].chunk)) = old[i];
+	}
+	PyMem_Free(old);
+	return 0;
+}
+
+static void acc_remove(Accumulator *self, struct acc_entry *e)
+{
+	size_t mask = self->mask;
+	size_t i = e - self->table;
+	size_t j = i;
+	while (1) {
+		j = (j + 1) & mask;
+		if (self->table[j].word == NULL)
+			break;
+		/* Stays unless its home slot is cyclically in (i, j]. */
+		size_t k = acc_hash(self->table[j].word, self->table[j].chunk) & mask;
+		if (i <= j ? (i < k && k <= j) : (i < k || k <= j))
+			continue;
+		self->table[i] = self->table[j];
+		i = j;
+	}
+	self->table[i].word = NULL;
+	self->used--;
+}
+
+static void acc_entry_free(Accumulator *self, struct acc_entry *e)
+{
+	if (e->cap) {
+		self->items_bytes -= (Py_ssize_t)e->cap * (e->wide ? 8 : 4);
+		PyMem_Free(e->items);
+	}
+	Py_DECREF(e->word);
+}
+
+/* -1: out of memory */
+static int acc_append(Accumulator *self, struct acc_entry *e, u_int64_t docid)
+{
+	if (!e->wide && docid > 0xFFFFFFFFULL) {
+		u_int64_t *items = PyMem_Malloc(sizeof(u_int64_t) * (e->n + 1));
+		if (items == NULL)
+			return -1;
+		u_int32_t *narrow = acc_items(e);
+		u_int32_t i;
+		for (i = 0; i < e->n; i++)
+			items[i] = narrow[i];
+		if (e->cap) {
+			self->items_bytes -= (Py_ssize_t)e->cap * 4;
+			PyMem_Free(e->items);
+		}
+		self->items_bytes += (Py_ssize_t)(e->n + 1) * 8;
+		e->items = items;
+		e->cap = e->n + 1;
+		e->wide = 1;
+	}
+	if (e->n == (e->cap ? e->cap : ACC_INLINE(e))) {
+		/* Grows by half, it's memory we are short of. */
+		u_int32_t cap = e->n + e->n / 2 + 2;
+		if (cap < e->n)
+			return -1;
+		size_t itemsize = e->wide ? 8 : 4;
+		void *items;
+		if (e->cap) {
+			items = PyMem_Realloc(e->items, cap * itemsize);
+		} else {
+			items = PyMem_Malloc(cap * itemsize);
+			if (items)
+				memcpy(items, &e->items, e->n * itemsize);
+		}
+		if (items == NULL)
+			return -1;
+		self->items_bytes += (Py_ssize_t)(cap - e->cap) * itemsize;
+		e->items = items;
+		e->cap = cap;
+	}
+	if (e->wide) {
+		u_int64_t *items = acc_items(e);
+		if (e->n && items[e->n - 1] > docid)
+			e->sorted = 0;
+		items[e->n++] = docid;
+	} else {
+		u_int32_t *items = acc_items(e);
+		if (e->n && items[e->n - 1] > docid)
+			e->sorted = 0;
+		items[e->n++] = docid;
+	}
+	return 0;
+}
+
+static int cmp_u32(const void *a, const void *b)
+{
+	u_int32_t x = *(u_int32_t *)a, y = *(u_int32_t *)b;
+	return (x > y) - (x < y);
+}
+
+static int cmp_u64(const void *a, const void *b)
+{
+	u_int64_t x = *(u_int64_t *)a, y = *(u_int64_t *)b;
+	return (x > y) - (x < y);
+}
+
+static int Accumulator_init(Accumulator *self, PyObject *args, PyObject *kwds)
+{
+	if (!PyArg_ParseTuple(args, ""))
+		return -1;
+	if (self->table == NULL && acc_resize(self, ACC_MIN_SIZE) < 0) {
+		PyErr_NoMemory();
+		return -1;
+	}
+	return 0;
+}
+
+static void Accumulator_dealloc(Accumulator *self)
+{
+	size_t i;
+	for (i = 0; self->table && i <= self->mask; i++)
+		if (self->table[i].word)
+			acc_entry_free(self, &self->table[i]);
+	PyMem_Free(self->table);
+	self->ob_type->tp_free((PyObject*)self);
+}
+
+/*
+	Interned word, a new reference.
+*/
+static PyObject *acc_word(PyObject *word)
+{
+	if (!PyString_Check(word)) {
+		PyErr_Format(PyExc_TypeError, "words must be strings");
+		return NULL;
+	}
+	Py_INCREF(word);
+	PyString_InternInPlace(&word);
+	return word;
+}
+
+/*
+	Looks the key up, a new entry is created and its key appended to
+	new_keys if it's not there. Steals the word.
+	NULL: error set
+*/
+static struct acc_entry *acc_get(Accumulator *self, PyObject *word,
+				 Py_ssize_t chunk, PyObject *new_keys)
+{
+	if ((size_t)(self->used + 1) * 3 > (self->mask + 1) * 2 &&
+	    acc_resize(self, (self->mask + 1) * 2) < 0) {
+		Py_DECREF(word);
+		PyErr_NoMemory();
+		return NULL;
+	}
+	struct acc_entry *e = acc_find(self, word, chunk, acc_hash(word, chunk));
+	if (e->word != NULL) {
+		Py_DECREF(word);
+		return e;
+	}
+	PyObject *key = Py_BuildValue("(On)", word, chunk);
+	if (key == NULL || PyList_Append(new_keys, key) < 0) {
+		Py_XDECREF(key);
+		Py_DECREF(word);
+		return NULL;
+	}
+	Py_DECREF(key);
+	memset(e, 0, sizeof(struct acc_entry));
+	e->word = word;
+	e->chunk = chunk;
+	e->sorted = 1;
+	self->used++;
+	return e;
+}
+
+static PyObject *Accumulator_add(Accumulator *self, PyObject *args)
+{
+	PyObject *docid_obj;
+	PyObject *words;
+	Py_ssize_t chunk;
+	if (!PyArg_ParseTuple(args, "OOn", &docid_obj, &words, &chunk))
+		return NULL;
+	if (self->table == NULL) {
+		PyErr_Format(PyExc_TypeError, "accumulator not initialized");
+		return NULL;
+	}
+	PyObject *docid_long = PyNumber_Long(docid_obj);
+	if (docid_long == NULL)
+		return NULL;
+	u_int64_t docid = PyLong_AsUnsignedLongLong(docid_long);
+	Py_DECREF(docid_long);
+	if (docid == (u_int64_t)-1 && PyErr_Occurred())
+		return NULL;
+	PyObject *fast = PySequence_Fast(words, "sequence of words required");
+	if (fast == NULL)
+		return NULL;
+	PyObject *new_keys = PyList_New(0);
+	if (new_keys == NULL)
+		goto error;
+	Py_ssize_t i;
+	for (i = 0; i < PySequence_Fast_GET_SIZE(fast); i++) {
+		PyObject *word = acc_word(PySequence_Fast_GET_ITEM(fast, i));
+		if (word == NULL)
+			goto error;
+		struct acc_entry *e = acc_get(self, word, chunk, new_keys);
+		if (e == NULL)
+			goto error;
+		if (acc_append(self, e, docid) < 0) {
+			PyErr_NoMemory();
+			goto error;
+		}
+	}
+	Py_DECREF(fast);
+	return new_keys;
+error:
+	Py_DECREF(fast);
+	Py_XDECREF(new_keys);
+	return NULL;
+}
+
+static PyObject *Accumulator_pop(Accumulator *self, PyObject *args)
+{
+	PyObject *key;
+	int format = QLIST_FMT_PLAIN;
+	if (!PyArg_ParseTuple(args, "O!|i", &PyTuple_Type, &key, &format))
+		return NULL;
+	PyObject *word_obj;
+	Py_ssize_t chunk;
+	if (!PyArg_ParseTuple(key, "On", &word_obj, &chunk))
+		return NULL;
+	if (format < QLIST_FMT_PLAIN || format > QLIST_FMT_SVB) {
+		PyErr_Format(PyExc_TypeError, "unknown format %i", format);
+		return NULL;
+	}
+	if (self->table == NULL) {
+		PyErr_Format(PyExc_TypeError, "accumulator not initialized");
+		return NULL;
+	}
+	PyObject *word = acc_word(word_obj);
+	if (word == NULL)
+		return NULL;
+	struct acc_entry *e = acc_find(self, word, chunk, acc_hash(word, chunk));
+	Py_DECREF(word);
+	if (e->word == NULL) {
+		PyErr_SetObject(PyExc_KeyError, key);
+		return NULL;
+	}
+
+	void *items = acc_items(e);
+	if (!e->sorted)
+		qsort(items, e->n, e->wide ? 8 : 4, e->wide ? cmp_u64 : cmp_u32);
+	PyObject *ret = qbuf_alloc(e->n);
+	if (ret == NULL)
+		return NULL;
+	int r;
+	if (e->wide)
+		r = qlist_pack((u_int8_t*)PyString_AS_STRING(ret), PyString_GET_SIZE(ret),
+			       items, e->n, format);
+	else
+		r = qlist_pack32((u_int8_t*)PyString_AS_STRING(ret), PyString_GET_SIZE(ret),
+				 items, e->n, format);
+	ret = qbuf_finish(ret, r);
+	if (ret == NULL)
+		return NULL;
+	Py_ssize_t n = e->n;
+	acc_entry_free(self, e);
+	acc_remove(self, e);
+	return Py_BuildValue("(Nn)", ret, n);
+}
+
+/*
+	Moves the keys into a new Accumulator. Entries are copied as they
+	are, nothing is sorted or packed, so it's cheap enough to do under a
+	lock and pop() the keys from the new one later. Either all the keys
+	are moved or none.
+*/
+static PyObject *Accumulator_take(Accumulator *self, PyObject *args)
+{
+	PyObject *keys;
+	if (!PyArg_ParseTuple(args, "O", &keys))
+		return NULL;
+	if (self->table == NULL) {
+		PyErr_Format(PyExc_TypeError, "accumulator not initialized");
+		return NULL;
+	}
+	PyObject *fast = PySequence_Fast(keys, "sequence of keys required");
+	if (fast == NULL)
+		return NULL;
+	Py_ssize_t n = PySequence_Fast_GET_SIZE(fast);
+	Accumulator *dst = (Accumulator *)PyObject_CallObject((PyObject *)self->ob_type, NULL);
+	if (dst == NULL)
+		goto error;
+	/* Sized up front, moving must not fail half way. */
+	size_t size = dst->mask + 1;
+	while ((size_t)n * 3 > size * 2)
+		size *= 2;
+	if (size != dst->mask + 1 && acc_resize(dst, size) < 0) {
+		PyErr_NoMemory();
+		goto error;
+	}
+	Py_ssize_t i;
+	for (i = 0; i < n; i++) {
+		PyObject *key = PySequence_Fast_GET_ITEM(fast, i);
+		PyObject *word_obj;
+		Py_ssize_t chunk;
+		if (!PyTuple_Check(key) || !PyArg_ParseTuple(key, "On", &word_obj, &chunk)) {
+			if (!PyErr_Occurred())
+				PyErr_Format(PyExc_TypeError, "keys must be (word, chunk_no) tuples");
+			goto error;
+		}
+		PyObject *word = acc_word(word_obj);
+		if (word == NULL)
+			goto error;
+		struct acc_entry *e = acc_find(self, word, chunk, acc_hash(word, chunk));
+		Py_DECREF(word);
+		if (e->word == NULL || acc_find(dst, e->word, e->chunk,
+						acc_hash(e->word, e->chunk))->word != NULL) {
+			PyErr_SetObject(PyExc_KeyError, key);
+			goto error;
+		}
+		/* The key is checked, not moved yet: a later bad key must
+		   leave self as it was. */
+		*acc_find(dst, e->word, e->chunk, acc_hash(e->word, e->chunk)) = *e;
+		dst->used++;
+	}
+	Py_ssize_t items = 0;
+	size_t j;
+	for (j = 0; j <= dst->mask; j++) {
+		struct acc_entry *d = &dst->table[j];
+		if (d->word == NULL)
+			continue;
+		struct acc_entry *e = acc_find(self, d->word, d->chunk,
+					       acc_hash(d->word, d->chunk));
+		if (e->cap) {
+			Py_ssize_t bytes = (Py_ssize_t)e->cap * (e->wide ? 8 : 4);
+			self->items_bytes -= bytes;
+			dst->items_bytes += bytes;
+		}
+		items += e->n;
+		acc_remove(self, e);
+	}
+	Py_DECREF(fast);
+	return Py_BuildValue("(Nn)", dst, items);
+error:
+	if (dst != NULL) {
+		/* Nothing was moved, the copies mustn't be freed twice. */
+		memset(dst->table, 0, sizeof(struct acc_entry) * (dst->mask + 1));
+		dst->used = 0;
+		Py_DECREF(dst);
+	}
+	Py_DECREF(fast);
+	return NULL;
+}
+
+/*
+	Stable LSD radix sort of 0..n-1 by keys, 16 bits per pass, the
+	second pass only when some key needs it. Returns the permutation,
+	PyMem_Malloc'ed.
+*/
+static u_int32_t *radix_order(u_int32_t *keys, Py_ssize_t n)
+{
+	u_int32_t *perm = PyMem_Malloc(sizeof(u_int32_t) * (n + 1));
+	u_int32_t *tmp = PyMem_Malloc(sizeof(u_int32_t) * (n + 1));
+	Py_ssize_t *counts = PyMem_Malloc(sizeof(Py_ssize_t) * 65536);
+	if (perm == NULL || tmp == NULL || counts == NULL) {
+		PyMem_Free(perm);
+		PyMem_Free(tmp);
+		PyMem_Free(counts);
+		return NULL;
+	}
+	u_int32_t max_key = 0;
+	Py_ssize_t i;
+	for (i = 0; i < n; i++) {
+		tmp[i] = i;
+		if (keys[i] > max_key)
+			max_key = keys[i];
+	}
+	int shift;
+	for (shift = 0; shift == 0 || (shift < 32 && max_key >> shift); shift += 16) {
+		memset(counts, 0, sizeof(Py_ssize_t) * 65536);
+		for (i = 0; i < n; i++)
+			counts[(keys[tmp[i]] >> shift) & 0xFFFF]++;
+		Py_ssize_t pos = 0;
+		int b;
+		for (b = 0; b < 65536; b++) {
+			Py_ssize_t c = counts[b];
+			counts[b] = pos;
+			pos += c;
+		}
+		for (i = 0; i < n; i++)
+			perm[counts[(keys[tmp[i]] >> shift) & 0xFFFF]++] = tmp[i];
+		u_int32_t *swap = perm;
+		perm = tmp;
+		tmp = swap;
+	}
+	PyMem_Free(perm);
+	PyMem_Free(counts);
+	return tmp;
+}
+
+static PyObject *Accumulator_add_batch(Accumulator *self, PyObject *args)
+{
+	PyObject *docids_obj, *offsets_obj, *term_ids_obj, *vocabulary;
+	Py_ssize_t block_size;
+	const void *docids_buf, *offsets_buf, *term_ids_buf;
+	Py_ssize_t docids_sz, offsets_sz, term_ids_sz;
+	if (!PyArg_ParseTuple(args, "OOOOn", &docids_obj, &offsets_obj,
+			      &term_ids_obj, &vocabulary, &block_size))
+		return NULL;
+	if (self->table == NULL) {
+		PyErr_Format(PyExc_TypeError, "accumulator not initialized");
+		return NULL;
+	}
+	if (PyObject_AsReadBuffer(docids_obj, &docids_buf, &docids_sz) < 0 ||
+	    PyObject_AsReadBuffer(offsets_obj, &offsets_buf, &offsets_sz) < 0 ||
+	    PyObject_AsReadBuffer(term_ids_obj, &term_ids_buf, &term_ids_sz) < 0)
+		return NULL;
+	if (docids_sz % 8 || offsets_sz % 8 || term_ids_sz % 4) {
+		PyErr_Format(PyExc_TypeError, "docids and offsets must be 8, "
+			     "term_ids 4 bytes wide");
+		return NULL;
+	}
+	u_int64_t *docids = (u_int64_t *)docids_buf;
+	u_int64_t *offsets = (u_int64_t *)offsets_buf;
+	u_int32_t *term_ids = (u_int32_t *)term_ids_buf;
+	Py_ssize_t docs_n = docids_sz / 8;
+	Py_ssize_t tokens_n = term_ids_sz / 4;
+	if (offsets_sz / 8 != docs_n + 1 || offsets[0] != 0 ||
+	    offsets[docs_n] != (u_int64_t)tokens_n) {
+		PyErr_Format(PyExc_ValueError, "offsets must have len(docids) + 1 "
+			     "items, from 0 to len(term_ids)");
+		return NULL;
+	}
+	if (block_size < 1 || tokens_n > 0xFFFFFFFFLL) {
+		PyErr_Format(PyExc_ValueError, "bad block_size or too many tokens");
+		return NULL;
+	}
+	Py_ssize_t i, j;
+	/* All of them before anything is written, they index token_docids. */
+	for (i = 0; i < docs_n; i++) {
+		if (offsets[i] > offsets[i + 1] ||
+		    offsets[i + 1] > (u_int64_t)tokens_n) {
+			PyErr_Format(PyExc_ValueError, "offsets must be ascending, "
+				     "up to len(term_ids)");
+			return NULL;
+		}
+	}
+	PyObject *fast = PySequence_Fast(vocabulary, "sequence of words required");
+	if (fast == NULL)
+		return NULL;
+	Py_ssize_t vocabulary_n = PySequence_Fast_GET_SIZE(fast);
+	PyObject *new_keys = PyList_New(0);
+	u_int64_t *token_docids = PyMem_Malloc(sizeof(u_int64_t) * (tokens_n + 1));
+	u_int32_t *order = NULL;
+	if (new_keys == NULL || token_docids == NULL)
+		goto nomem;
+
+	for (i = 0; i < docs_n; i++) {
+		for (j = offsets[i]; j < (Py_ssize_t)offsets[i + 1]; j++)
+			token_docids[j] = docids[i];
+	}
+	for (i = 0; i < tokens_n; i++) {
+		if (term_ids[i] >= vocabulary_n) {
+			PyErr_Format(PyExc_IndexError, "term id %u out of vocabulary",
+				     term_ids[i]);
+			goto error;
+		}
+	}
+	/* Tokens grouped by term, in document order within a term. */
+	order = radix_order(term_ids, tokens_n);
+	if (order == NULL)
+		goto nomem;
+
+	for (i = 0; i < tokens_n; ) {
+		u_int32_t term_id = term_ids[order[i]];
+		PyObject *word = acc_word(PySequence_Fast_GET_ITEM(fast, term_id));
+		if (word == NULL)
+			goto error;
+		/* One lookup per run of a term in a chunk. */
+		while (i < tokens_n && term_ids[order[i]] == term_id) {
+			u_int64_t docid = token_docids[order[i]];
+			Py_ssize_t chunk = docid / block_size;
+			Py_INCREF(word);
+			struct acc_entry *e = acc_get(self, word, chunk, new_keys);
+			if (e == NULL) {
+				Py_DECREF(word);
+				goto error;
+			}
+			do {
+				if (acc_append(self, e, docid) < 0) {
+					Py_DECREF(word);
+					goto nomem;
+				}
+				i++;
+			} while (i < tokens_n && term_ids[order[i]] == term_id &&
+				 (Py_ssize_t)((docid = token_docids[order[i]]) / block_size) == chunk);
+		}
+		Py_DECREF(word);
+	}
+	PyMem_Free(order);
+	PyMem_Free(token_docids);
+	Py_DECREF(fast);
+	return new_keys;
+nomem:
+	PyErr_NoMemory();
+error:
+	PyMem_Free(order);
+	PyMem_Free(token_docids);
+	Py_DECREF(fast);
+	Py_XDECREF(new_keys);
+	return NULL;
+}
+
+static Py_ssize_t Accumulator_length(Accumulator *self)
+{
+	return self->used;
+}
+
+static PyObject *Accumulator_get_nbytes(Accumulator *self, void *closure)
+{
+	Py_ssize_t table_bytes = self->table ? (self->mask + 1) * sizeof(struct acc_entry) : 0;
+	return PyInt_FromSsize_t(sizeof(Accumulator) + table_bytes + self->items_bytes);
+}
+
+static PyMethodDef Accumulator_methods[] = {
+	{"add", (PyCFunction)Accumulator_add, METH_VARARGS,
+	 "add(docid, words, chunk_no) -> list of (word, chunk_no) keys seen for the first time"},
+	{"add_batch", (PyCFunction)Accumulator_add_batch, METH_VARARGS,
+	 "add_batch(docids, offsets, term_ids, vocabulary, block_size) -> list of new keys"},
+	{"pop", (PyCFunction)Accumulator_pop, METH_VARARGS,
+	 "pop((word, chunk_no)[, format]) -> (qbuf, number of items added), removes the key"},
+	{"take", (PyCFunction)Accumulator_take, METH_VARARGS,
+	 "take(keys) -> (Accumulator, number of items added), moves the keys unpacked"},
+	{NULL, NULL}
+};
+
+static PyGetSetDef Accumulator_getset[] = {
+	{"nbytes", (getter)Accumulator_get_nbytes, NULL,
+	 "memory used by the table and the buffers, words not included", NULL},
+	{NULL}
+};
+
+static PyMappingMethods Accumulator_as_mapping = {
+	(lenfunc)Accumulator_length,	/* mp_length */
+	0,				/* mp_subscript */
+	0,				/* mp_ass_subscript */
+};
+
+static PyTypeObject AccumulatorType = {
+	PyObject_HEAD_INIT(NULL)
+	0,				/* ob_size */
+	"_qlist.Accumulator",		/* tp_name */
+	sizeof(Accumulator),		/* tp_basicsize */
+	0,				/* tp_itemsize */
+	(destructor)Accumulator_dealloc,	/* tp_dealloc */
+	0,				/* tp_print */
+	0,				/* tp_getattr */
+	0,				/* tp_setattr */
+	0,				/* tp_compare */
+	0,				/* tp_repr */
+	0,				/* tp_as_number */
+	0,				/* tp_as_sequence */
+	&Accumulator_as_mapping,	/* tp_as_mapping */
+	0,				/* tp_hash */
+	0,				/* tp_call */
+	0,				/* tp_str */
+	0,				/* tp_getattro */
+	0,				/* tp_setattro */
+	0,				/* tp_as_buffer */
+	Py_TPFLAGS_DEFAULT,		/* tp_flags */
+	"Accumulator(), docids buffered per (word, chunk_no) until packed",	/* tp_doc */
+	0,				/* tp_traverse */
+	0,				/* tp_clear */
+	0,				/* tp_richcompare */
+	0,				/* tp_weaklistoffset */
+	0,				/* tp_iter */
+	0,				/* tp_iternext */
+	Accumulator_methods,		/* tp_methods */
+	0,				/* tp_members */
+	Accumulator_getset,		/* tp_getset */
+	0,				/* tp_base */
+	0,				/* tp_dict */
+	0,				/* tp_descr_get */
+	0,				/* tp_descr_set */
+	0,				/* tp_dictoffset */
+	(initproc)Accumulator_init,	/* tp_init */
+	0,				/* tp_alloc */
+	PyType_GenericNew,		/* tp_new */
+};
+
 static PyMethodDef Methods[] =
 {
 	{"pack_array", qlist_pack_array, METH_VARARGS},
-	{"unpack_to_array", qlist_unpack_to_array, METH_VARARGS},
+	{"unpack_into", qlist_unpack_into, METH_VARARGS},
+	{"append", qlist_do_append, METH_VARARGS},
 	{"do_or", qlist_do_or, METH_VARARGS},
 	{"do_and", qlist_do_and, METH_VARARGS},
 	{"do_andnot", qlist_do_andnot, METH_VARARGS},
+	{"do_and_many", qlist_do_andnot_many, METH_VARARGS},
+	{"do_andnot_many", qlist_do_andnot_many, METH_VARARGS},
+	{"do_or_many", qlist_do_or_many, METH_VARARGS},
+	{"get_format", qlist_get_format, METH_VARARGS},
+	{"count", qlist_do_count, METH_VARARGS},
+	{"is_empty", qlist_do_is_empty, METH_VARARGS},
+	{"count_and_many", qlist_count_andnot_many, METH_VARARGS},
+	{"count_andnot_many", qlist_count_andnot_many, METH_VARARGS},
+	{"count_or_many", qlist_count_or_many, METH_VARARGS},
 	{NULL, NULL}
 };
 
@@ -201,11 +1461,24 @@ init_qlist(void)
 	m = Py_InitModule("_qlist", Methods);
 	if (NEVER(m == NULL))
 		return;
+
+	if (PyType_Ready(&CursorType) < 0)
+		return;
+	Py_INCREF(&CursorType);
+	PyModule_AddObject(m, "Cursor", (PyObject *)&CursorType);
+	if (PyType_Ready(&AccumulatorType) < 0)
+		return;
+	Py_INCREF(&AccumulatorType);
+	PyModule_AddObject(m, "Accumulator", (PyObject *)&AccumulatorType);
 	
 	ListTooBig = PyErr_NewException("_qlist.ListTooBigError", NULL, NULL);
 	Py_INCREF(ListTooBig);
 	PyModule_AddObject(m, "error", ListTooBig);
+	Py_INCREF(ListTooBig);
+	PyModule_AddObject(m, "ListTooBigError", ListTooBig);
 	NotSorted = PyErr_NewException("_qlist.NotSortedError", NULL, NULL);
 	Py_INCREF(NotSorted);
 	PyModule_AddObject(m, "error", NotSorted);
+	Py_INCREF(NotSorted);
+	PyModule_AddObject(m, "NotSortedError", NotSorted);
 }
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Turns the RPN produced by parsetorpn into a normalized tree and
+evaluates it against fetched qbufs.
+
+Nodes are tuples: a term (a string), ('OR', operands) or
+('AND', operands, excluded_operands). Chains of the same operator are
+flattened and repeated operands removed.
+
+>>> from . import parsetorpn
+>>> plan(parsetorpn.parse("a AND b AND a".split()))
+('AND', ('a', 'b'), ())
+>>> plan(parsetorpn.parse("a AND b ANDNOT ( c OR d ) ANDNOT c".split()))
+('AND', ('a', 'b'), ('c', 'd'))
+>>> plan(parsetorpn.parse("a OR ( b OR a ) OR c".split()))
+('OR', ('a', 'b', 'c'))
+>>> plan(parsetorpn.parse("( a AND ( b ANDNOT c ) ) OR ( d AND e )".split()))
+('OR', (('AND', ('a', 'b'), ('c',)), ('AND', ('d', 'e'), ())))
+>>> plan(parsetorpn.parse("a ANDNOT a".split())) == EMPTY
+True
+>>> plan(parsetorpn.parse("a OR a".split()))
+'a'
+
+Terms known to be missing in a chunk are pruned before anything is
+fetched. An AND with a missing operand needs no fetches at all.
+
+>>> p = plan(parsetorpn.parse("a AND ( b OR c ) ANDNOT d".split()))
+>>> prune(p, lambda term: term != 'c')
+('AND', ('a', 'b'), ('d',))
+>>> prune(p, lambda term: term != 'd')
+('AND', ('a', ('OR', ('b', 'c'))), ())
+>>> prune(p, lambda term: term not in ('b', 'c')) == EMPTY
+True
+>>> sorted(terms(p))
+['a', 'b', 'c', 'd']
+>>> without_negatives(p)
+('AND', ('a', ('OR', ('b', 'c'))), ())
+>>> to_rpn(p)
+['a', 'b', 'c', 'OR', 'AND', 'd', 'ANDNOT']
+
+>>> qbufs = dict(a=qlist.pack([1, 2, 3, 4]), b=qlist.pack([2, 3]),
+...              c=qlist.pack([4, 5]), d=qlist.pack([3]))
+>>> qlist.unpack( execute(p, qbufs) )
+array('L', [2L, 4L])
+>>> qlist.unpack( execute(EMPTY, qbufs) )
+array('L')
+>>> qlist.unpack( execute(plan(['a', 'c', 'OR']), qbufs, limit=2, reverse=True) )
+array('L', [4L, 5L])
+>>> qlist.unpack( execute(p, qbufs, limit=1) )
+array('L', [2L])
+>>> q = plan(parsetorpn.parse("( a ANDNOT d ) OR ( b AND c ) OR c".split()))
+>>> qlist.unpack( execute(q, qbufs, limit=2, reverse=True) )
+array('L', [4L, 5L])
+>>> count(p, qbufs), count(plan(['a', 'c', 'OR']), qbufs), count('b', qbufs)
+(2, 5, 2)
+'''
+from . import qlist
+
+OPERATORS = ('AND', 'ANDNOT', 'OR')
+
+# Empty OR, matches nothing.
+EMPTY = ('OR', ())
+
+
+def _unique(operands):
+    seen = set()
+    out = []
+    for n in operands:
+        if n not in seen:
+            seen.add(n)
+            out.append(n)
+    return out
+
+def _or(operands):
+    ops = []
+    for n in operands:
+        if isinstance(n, tuple) and n[0] == 'OR':
+            ops.extend(n[1])
+        else:
+            ops.append(n)
+    ops = _unique(ops)
+    if len(ops) == 1:
+        return ops[0]
+    return ('OR', tuple(ops))
+
+def _and(operands, excluded):
+    pos, neg = [], []
+    for n in operands:
+        if n == EMPTY:
+            return EMPTY
+        if isinstance(n, tuple) and n[0] == 'AND':
+            # (a and not b) and c == a and c and not b
+            pos.extend(n[1])
+            neg.extend(n[2])
+        else:
+            pos.append(n)
+    for n in excluded:
+        if isinstance(n, tuple) and n[0] == 'OR':
+            # not (a or b) == not a and not b
+            neg.extend(n[1])
+        else:
+            neg.append(n)
+    pos, neg = _unique(pos), _unique(neg)
+    if set(pos) & set(neg):
+        return EMPTY
+    if len(pos) == 1 and not neg:
+        return pos[0]
+    return ('AND', tuple(pos), tuple(neg))
+
+def plan(rpn):
+    stack = []
+    for token in rpn:
+        if token not in OPERATORS:
+            stack.append(token)
+            continue
+        b = stack.pop()
+        a = stack.pop()
+        if token == 'OR':
+            stack.append(_or([a, b]))
+        elif token == 'AND':
+            stack.append(_and([a, b], []))
+        else:
+            stack.append(_and([a], [b]))
+    assert len(stack) == 1
+    return stack[0]
+
+def _rebuild(node, leaf, drop_negatives=False):
+    if not isinstance(node, tuple):
+        return leaf(node)
+    if node[0] == 'OR':
+        return _or([_rebuild(n, leaf, drop_negatives) for n in node[1]])
+    return _and([_rebuild(n, leaf, drop_negatives) for n in node[1]],
+                [] if drop_negatives else \
+                    [_rebuild(n, leaf, drop_negatives) for n in node[2]])
+
+def prune(node, is_present):
+    '''
+    Replace terms for which is_present(term) is false with EMPTY.
+    '''
+    return _rebuild(node, lambda term: term if is_present(term) else EMPTY)
+
+def without_negatives(node):
+    '''
+    Meta chunks can't be used to exclude anything, ANDNOT only removes
+    some items from a chunk.
+    '''
+    return _rebuild(node, lambda term: term, drop_negatives=True)
+
+def terms(node):
+    if not isinstance(node, tuple):
+        return set([node])
+    s = set()
+    for group in node[1:]:
+        for n in group:
+            s.update(terms(n))
+    return s
+
+def to_rpn(node):
+    '''
+    Back to the RPN with binary operators, for the server side execution.
+    '''
+    if not isinstance(node, tuple):
+        return [node]
+    assert node != EMPTY
+    rpn = to_rpn(node[1][0])
+    for n in node[1][1:]:
+        rpn.extend(to_rpn(n))
+        rpn.append(node[0])
+    if node[0] == 'AND':
+        for n in node[2]:
+            rpn.extend(to_rpn(n))
+            rpn.append('ANDNOT')
+    return rpn
+
+def _estimate(node, qbufs):
+    if not isinstance(node, tuple):
+        return len(qbufs[node])
+    sizes = [_estimate(n, qbufs) for n in node[1]]
+    if node[0] == 'OR':
+        return sum(sizes)
+    return min(sizes)
+
+def execute(node, qbufs, limit=0, reverse=False):
+    '''
+    Evaluate the tree, qbufs maps terms to qbufs. AND operands are
+    evaluated cheapest first and evaluation stops at the first empty one.
+    With limit only the first (last with reverse) limit items are
+    computed. The first limit items of an OR are among the first limit
+    items of its operands, so the limit goes down to them; AND operands
+    are evaluated whole.
+    '''
+    if not isinstance(node, tuple):
+        if limit:
+            return qlist.do_or_many([qbufs[node]], limit, reverse)
+        return qbufs[node]
+    if node == EMPTY:
+        return qlist.pack([])
+    if node[0] == 'OR':
+        return qlist.do_or_many([execute(n, qbufs, limit, reverse)
+                                 for n in node[1]], limit, reverse)
+
+    operands = _and_operands(node, qbufs)
+    if operands is None:
+        return qlist.pack([])
+    return qlist.do_andnot_many(operands[0], operands[1], limit, reverse)
+
+def _and_operands(node, qbufs):
+    # None if any of the positive operands is empty.
+    operands = sorted(node[1], key=lambda n: (isinstance(n, tuple),
+                                              _estimate(n, qbufs)))
+    pos = []
+    for n in operands:
+        qbuf = execute(n, qbufs)
+        if qlist.is_empty(qbuf):
+            return None
+        pos.append(qbuf)
+    neg = [qbuf for qbuf in (execute(n, qbufs) for n in node[2])
+                                                if not qlist.is_empty(qbuf)]
+    return pos, neg
+
+def count(node, qbufs):
+    '''
+    Number of items execute() would return. The root node is only
+    counted, nothing is encoded, a single term is counted from the
+    header of its qbuf.
+    '''
+    if not isinstance(node, tuple):
+        return qlist.count(qbufs[node])
+    if node == EMPTY:
+        return 0
+    if node[0] == 'OR':
+        return qlist.count_or_many([execute(n, qbufs) for n in node[1]])
+    operands = _and_operands(node, qbufs)
+    if operands is None:
+        return 0
+    return qlist.count_andnot_many(operands[0], operands[1])
@@ -89,10 +89,66 @@ Limit results.
 >>> srch.materialized_query(["ala"], limit=3, reverse=True)
 (4, [999L, 3L, 2L])
 >>> srch.materialized_query(["ala"], limit=2)
-(4, [1L, 2L, 3L])
+(4, [1L, 2L])
 >>> srch.materialized_query(["ala"], limit=1) # 3 chunks, every has 1 item
 (3, [1L])
 
+Exact counts.
+>>> srch.count(["ala"]), srch.count("ala AND w ANDNOT bardzo".split())
+(4, 1)
+
+Server side execution.
+>>> ssrch = Searcher(mc, namespace='test3', block_size=2, server_side=True)
+>>> ssrch.materialized_query(["ala"])
+(4, [1L, 2L, 3L, 999L])
+>>> ssrch.materialized_query(["ala"], reverse=True)
+(4, [999L, 3L, 2L, 1L])
+>>> ssrch.materialized_query(["ala"], limit=2)
+(4, [1L, 2L])
+>>> ssrch.materialized_query("ala AND w ANDNOT bardzo".split())
+(1, [2L])
+>>> ssrch.count(["ala"]), ssrch.count("ala AND w ANDNOT bardzo".split())
+(4, 1)
+
+Cached results.
+>>> csrch = Searcher(mc, namespace='test3', block_size=2, cache_size=65536)
+>>> csrch.materialized_query(["ala"])
+(4, [1L, 2L, 3L, 999L])
+>>> csrch.materialized_query(["ala"])
+(4, [1L, 2L, 3L, 999L])
+>>> csrch.cache.hits
+3
+
+>>> idx.close()
+>>> mc.close()
+
+Stream VByte coded namespace, the searcher reads any format.
+
+>>> mc = QListClient("127.0.0.1:11211")
+>>> idx = Indexer(mc, flush_delay=555, max_tuples=16, namespace='test4',
+...               fmt=qlist.FMT_SVB)
+>>> srch = Searcher(mc, namespace='test4')
+>>> idx.put(1, "ala ma kota".split())
+3
+>>> idx.put(7, "ala ma psa".split())
+3
+>>> idx.flush()
+(2, 6)
+>>> srch.materialized_query("ala ANDNOT kota".split())
+(1, [7L])
+>>> qlist.get_format(mc.qlist_get_multi(['test4:ala:0'])['test4:ala:0']) == qlist.FMT_SVB
+True
+
+Pre-tokenized documents, term ids index the vocabulary.
+
+>>> idx.put_batch([9, 11], [0, 2, 3], [0, 2, 0], ['ala', 'ma', 'kota'])
+(2, 3)
+>>> idx.flush()
+(2, 3)
+>>> srch.materialized_query("ala ANDNOT ma".split())
+(2, [9L, 11L])
+>>> srch.materialized_query(["kota"])
+(2, [1L, 9L])
 >>> idx.close()
 >>> mc.close()
 
@@ -105,16 +161,23 @@ import time
 import Queue as queue
 import threading
 import itertools
+import math
 
 import os
+import sys
 import logging
 
 from . import parsetorpn
+from . import queryplan
 from . import qlist
 from . import lrucache
 from . import expirator
+from . import shmqueue
+from . import asyncclient
+from . import histogram
 
 import multiprocessing
+import multiprocessing.pool
 import functools
 
 log = logging.getLogger(__name__)
@@ -125,6 +188,68 @@ logging.basicConfig(level=logging.DEBUG, format=FORMAT_CONS)
 CPU_COUNT=multiprocessing.cpu_count()
 QUEUE_LIMIT=CPU_COUNT*3
 SENDER_CONCURRENCY=max(2, int(CPU_COUNT*1.5))
+# Queued batches a sender process takes at once and merges per key.
+COALESCE_BATCHES=8
+# Detached batches waiting to be packed, past that putters wait for the
+# flusher once they have released the lock.
+FLUSH_QUEUE_LIMIT=4
+# Hitlists per batch pushed to the Sender.
+FLUSH_BATCH_KEYS=512
+EMPTY_QBUF=qlist.pack([])
+
+def generation_key(namespace, chunk_no):
+    '''
+    Sender overwrites it after every change in the chunk, Searcher uses it
+    to validate cached results. Words are never empty, so it can't clash
+    with the namespace:word:chunk_no keys.
+
+    >>> generation_key('ns', 7)
+    'ns::gen:7'
+    '''
+    return '%s::gen:%s' % (namespace, chunk_no)
+
+def coalesce(batches):
+    '''
+    Merges queued (cmd, dd) batches into a dict of additions and a dict
+    of deletions, which have the same effect as the batches in order
+    when the additions are sent first. An ADD takes its items out of the
+    pending deletions of the key and a DEL out of the additions.
+
+    >>> p = qlist.pack
+    >>> adds, dels = coalesce([('ADD', {('a', 0): p([1, 2])}),
+    ...                        ('DEL', {('a', 0): p([2, 3]), ('b', 1): p([5])}),
+    ...                        ('ADD', {('a', 0): p([3, 4]), ('b', 1): p([6])}),
+    ...                        ('DEL', {('c', 0): p([7])}),
+    ...                        ('ADD', {('c', 0): p([7])})])
+    >>> sorted((k, list(qlist.unpack(v))) for k, v in adds.items())
+    [(('a', 0), [1L, 3L, 4L]), (('b', 1), [6L]), (('c', 0), [7L])]
+    >>> sorted((k, list(qlist.unpack(v))) for k, v in dels.items())
+    [(('a', 0), [2L]), (('b', 1), [5L])]
+    '''
+    if len(batches) == 1:
+        cmd, dd = batches[0]
+        return (dd, {}) if cmd == 'ADD' else ({}, dd)
+    adds, dels = {}, {}
+    for cmd, dd in batches:
+        into, other = (adds, dels) if cmd == 'ADD' else (dels, adds)
+        for key, qbuf in dd.iteritems():
+            if key in other:
+                rest = qlist.do_andnot(other[key], qbuf)
+                if qlist.is_empty(rest):
+                    del other[key]
+                else:
+                    other[key] = rest
+            if key in into:
+                into[key] = qlist.do_or(into[key], qbuf)
+            else:
+                into[key] = qbuf
+    return adds, dels
+
+def _as_array(items, typecode):
+    # Buffers of the right width (array, numpy) are passed as they are.
+    if getattr(items, 'itemsize', None) == array.array(typecode).itemsize:
+        return items
+    return array.array(typecode, items)
 
 def with_lock(fun):
     @functools.wraps(fun)
@@ -137,15 +262,21 @@ def with_lock(fun):
 
 
 class Sender:
-    def __init__(self, mc, namespace, metachunk_cache_size):
+    def __init__(self, mc, namespace, metachunk_cache_size, fmt=qlist.FMT_PLAIN):
         self.namespace = namespace
-        self._send_queue = multiprocessing.Queue(maxsize=QUEUE_LIMIT)
+        self.fmt = fmt
+        # Hitlists travel through shared memory, not through the pipe.
+        self._send_queue = shmqueue.ShmQueue(slots=QUEUE_LIMIT)
         self._mc = mc
         self._exit = multiprocessing.Event()
         self._empty = multiprocessing.Event()
         self._empty.set()
         self._parent_pid = os.getpid()
-        self.metachunk_cache = lrucache.LRUCache(maxsize=metachunk_cache_size)
+        # Shared by the sender processes, so each meta update is sent
+        # once and not once per process.
+        self.metachunk_cache = lrucache.SharedKeySet(buckets=metachunk_cache_size)
+        # Chunk keys looked up in / found in the metachunk cache.
+        self._meta_lookups = multiprocessing.Array('L', 2)
 
         self._processes = []
         for p in range(SENDER_CONCURRENCY):
@@ -157,7 +288,7 @@ class Sender:
     def push(self, item):
         if self._send_queue.qsize() == 0:
             self._empty.clear()
-        self._send_queue.put( item )
+        self._send_queue.put( *item )
 
     def join(self):
         self._empty.wait()
@@ -165,6 +296,13 @@ class Sender:
     def size(self):
         return self._send_queue.qsize()
 
+    def meta_hit_rate(self):
+        '''
+        Share of sent chunks that didn't need a meta update.
+        '''
+        lookups, hits = self._meta_lookups
+        return float(hits) / lookups if lookups else 0.0
+
     def close(self):
         self._empty.wait()
         self._exit.set()
@@ -176,18 +314,20 @@ class Sender:
             import os
             log.info("(Net) Sender pid:%i" % (os.getpid(), ))
             namespace = self.namespace
+            fmt = self.fmt
             mc = self._mc.clone()
             cache = self.metachunk_cache
             normal_chunks = 0
             meta_chunks = 0
+            coalesced = 0
             transferred = 0
             while True:
-                dd = None
                 try:
-                    send_cmd, dd = self._send_queue.get(block=True, timeout=2.5)
-                    log.info("(Net) Queued:%i  Hitlists: chunks/meta %i/%i  Through_queue_MiB: %.1f" % (
+                    batches = [self._send_queue.get(block=True, timeout=2.5)]
+                    log.info("(Net) Queued:%i  Hitlists: chunks/meta/coalesced %i/%i/%i  Meta_hit_rate: %.3f  Through_queue_MiB: %.1f" % (
                                 self.size()+1,
-                                normal_chunks, meta_chunks, 
+                                normal_chunks, meta_chunks, coalesced,
+                                self.meta_hit_rate(),
                                 transferred/1048576.0, 
                             ))
                 except queue.Empty:
@@ -195,23 +335,42 @@ class Sender:
                         break
                     else:
                         continue
+                # Under backlog the same chunks are usually in several of
+                # the queued batches, send each of them once.
+                while len(batches) < COALESCE_BATCHES:
+                    try:
+                        batches.append( self._send_queue.get(block=False) )
+                    except queue.Empty:
+                        break
+                adds, dels = coalesce(batches)
+                coalesced += sum(len(dd) for _, dd in batches) - len(adds) - len(dels)
                 cmds = {
                     'ADD': {},
                     'DEL': {},
                 }
-                cmd = cmds[send_cmd]
                 meta = collections.defaultdict(lambda:array.array('L'))
-                for ((key, chunk_no), hitlist) in dd.iteritems():
-                    transferred += len(hitlist)
-                    k = namespace + ':' + key + ':' + str(chunk_no)
-                    if len(k) > 255:
-                        log.error("key %r too long, ignored" % (k,))
-                        continue
-                    cmd[k] = hitlist # assume it's already packed
-                    if k not in cache:
-                        meta[key].append( chunk_no )
-                    cache.add(k)
-                    normal_chunks += 1
+                touched = set()
+                lookups = hits = 0
+                for send_cmd, dd in (('ADD', adds), ('DEL', dels)):
+                    cmd = cmds[send_cmd]
+                    for ((key, chunk_no), hitlist) in dd.iteritems():
+                        transferred += len(hitlist)
+                        k = namespace + ':' + key + ':' + str(chunk_no)
+                        if len(k) > 255:
+                            log.error("key %r too long, ignored" % (k,))
+                            continue
+                        cmd[k] = hitlist # assume it's already packed
+                        touched.add(chunk_no)
+                        lookups += 1
+                        if k in cache:
+                            hits += 1
+                        else:
+                            meta[key].append( chunk_no )
+                            cache.add(k)
+                        normal_chunks += 1
+                with self._meta_lookups.get_lock():
+                    self._meta_lookups[0] += lookups
+                    self._meta_lookups[1] += hits
 
                 for key, chunk_numbers in meta.iteritems():
                     k = namespace + ':' + key + ':meta'
@@ -219,12 +378,14 @@ class Sender:
                     if len(k) > 255:
                         log.error("key %r too long, ignored" % (k,))
                         continue
-                    cmds['ADD'][k] = qlist.pack(chunk_numbers, sort=True)
+                    cmds['ADD'][k] = qlist.pack(chunk_numbers, sort=True, fmt=fmt)
 
-                if cmds['ADD']:
-                    mc.qlist_add_multi( cmds['ADD'] )
-                if cmds['DEL']:
-                    mc.qlist_del_multi( cmds['DEL'] )
+                mc.qlist_update_multi( cmds['ADD'], cmds['DEL'] )
+                # After the data, so a reader never caches stale data
+                # under a fresh generation.
+                if touched:
+                    mc.qlist_touch_multi( generation_key(namespace, chunk_no)
+                                                    for chunk_no in touched )
 
                 if self._send_queue.qsize() == 0:
                     self._empty.set()
@@ -235,31 +396,83 @@ class Sender:
             os.kill(self._parent_pid, signal.SIGKILL)
 
 
-class HitlistDefaultdict(collections.defaultdict):
-    def __init__(self, exp):
-        self.exp = exp
-        collections.defaultdict.__init__(self)
+class Flusher:
+    '''
+    Sorts and packs the hitlists taken out of the Indexer and pushes them
+    to the Sender, in a thread of its own. The Indexer lock is held only
+    while the hitlists are detached, push() never blocks and a full send
+    queue stalls this thread and not the putters. They are held back by
+    wait_room() instead, outside the lock. Batches are sent in the order
+    they were pushed.
+    '''
+    def __init__(self, sender, fmt):
+        self.sender = sender
+        self.fmt = fmt
+        self._queue = queue.Queue()
+        self._room = threading.Condition()
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def push(self, send_cmd, hitlists, keys):
+        ''' hitlists is an Accumulator holding the keys, owned from now on. '''
+        self._queue.put( (send_cmd, hitlists, keys) )
+
+    def wait_room(self):
+        '''
+        Blocks while FLUSH_QUEUE_LIMIT batches or more wait to be packed.
+        Must be called without the Indexer lock.
+        '''
+        with self._room:
+            while self._queue.qsize() >= FLUSH_QUEUE_LIMIT:
+                self._room.wait()
+
+    def join(self):
+        self._queue.join()
+        if self._exc_info:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
 
-    def __missing__(self, key):
-        self.exp.push( key )
-        # Let's try list() instead of array. It appears to be twice faster!
-        ## a = array.array('L')
-        a = []
-        self[key] = a
-        return a
+    def close(self):
+        self.join()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            with self._room:
+                self._room.notify_all()
+            try:
+                if item is None:
+                    break
+                send_cmd, hitlists, keys = item
+                for i in xrange(0, len(keys), FLUSH_BATCH_KEYS):
+                    dd = {}
+                    for key in keys[i:i+FLUSH_BATCH_KEYS]:
+                        dd[ key ], _ = hitlists.pop(key, self.fmt)
+                    self.sender.push( (send_cmd, dd) )
+            except Exception:
+                log.critical("Exception in flusher:", exc_info=True)
+                self._exc_info = sys.exc_info()
+            finally:
+                self._queue.task_done()
 
 
 class Hitlists:
-    def __init__(self, max_tuples, sender, block_size, expirator_runner, flush_delay, send_cmd):
+    def __init__(self, max_tuples, flusher, block_size, expirator_runner, flush_delay, send_cmd, fmt):
         self.max_tuples = max_tuples
-        self.sender     = sender
+        self.flusher    = flusher
         self.block_size = block_size
         self.expirator  = expirator_runner.Expirator(flush_delay, self._timeouted)
-        self.hitlists   = HitlistDefaultdict(self.expirator)
+        # (word, chunk_no) -> docids, new keys go to the expirator.
+        self.hitlists   = qlist.Accumulator()
         self.tuples_inmem = 0
         self.total_tuples = 0
         self.total_docids = 0
         self.send_cmd = send_cmd
+        self.fmt = fmt
 
     def update_counters(self, counter, docids):
         self.total_docids += docids
@@ -268,8 +481,7 @@ class Hitlists:
 
         while self.tuples_inmem > self.max_tuples:
             to_flush = len(self.hitlists)//3
-            quarter_keys = [self.expirator.pop() \
-                                        for _ in xrange(to_flush)]
+            quarter_keys = self.expirator.pop_many(to_flush)
             log.info('(Mem)           Tokens: all/in_mem %i/%i  Hitlists: flushing/total: %i/%i' %
                         (self.total_tuples, self.tuples_inmem,
                         to_flush, len(self.hitlists), ))
@@ -280,16 +492,12 @@ class Hitlists:
         self._flush_keys(keys)
 
     def _flush_keys(self, keys):
-        dd = {}
-        counter = 0
-        for key in keys: #word, chunk_no = key
-            hitlist = self.hitlists[key]
-            dd[ key ] = qlist.pack(hitlist, sort=False)
-            counter += len(hitlist)
-            del self.hitlists[key]
+        if not keys:
+            return 0
+        # Runs under the Indexer lock, packing is left to the flusher.
+        detached, counter = self.hitlists.take(keys)
         self.tuples_inmem -= counter
-        if dd:
-            self.sender.push( (self.send_cmd, dd) )
+        self.flusher.push(self.send_cmd, detached, keys)
         return counter
 
     def flush(self):
@@ -333,35 +541,48 @@ class Indexer:
     sender (child process):
             * sends items from shared queue
             * can be scaled to multiple processes
+
+    Expired hitlists are only detached under the lock, a Flusher thread
+    packs them and waits for room in the shared queue. When the flusher
+    falls behind, putters wait for it after releasing the lock. put_latency
+    is a histogram of put_multi() times, waiting for the lock and for the
+    flusher included.
     '''
-    def __init__(self, mc, namespace='', flush_delay=600, max_tuples=128000, block_size=16384):
+    def __init__(self, mc, namespace='', flush_delay=600, max_tuples=128000, block_size=16384,
+                 fmt=qlist.FMT_PLAIN):
         log.info("Indexer pid:%i" % (os.getpid(), ))
-        log.info("Indexer namespace:%r block_size:%i  flush_delay:%i max_tuples=%i" % (
+        log.info("Indexer namespace:%r block_size:%i  flush_delay:%i max_tuples=%i fmt=%i" % (
                     namespace,
                     block_size,
                     flush_delay,
                     max_tuples,
+                    fmt,
                 ))
         self.lock = threading.Lock()
         self.block_size = block_size
 
         self.sender= Sender(mc,
                         namespace = namespace,
-                        metachunk_cache_size = max_tuples // 4,)
+                        metachunk_cache_size = max_tuples // 4,
+                        fmt = fmt,)
+        self.flusher = Flusher(self.sender, fmt)
         self.expirator_runner = expirator.ExpiratorRunner(self.lock)
+        self.put_latency = histogram.LatencyHistogram()
 
         self.put_hitlists = Hitlists(flush_delay=flush_delay,
                                     max_tuples=max_tuples,
                                     block_size=block_size,
                                     expirator_runner = self.expirator_runner,
-                                    sender=self.sender,
-                                    send_cmd='ADD',)
+                                    flusher=self.flusher,
+                                    send_cmd='ADD',
+                                    fmt=fmt,)
         self.del_hitlists = Hitlists(flush_delay=flush_delay,
                                     max_tuples=max_tuples,
                                     block_size=block_size,
                                     expirator_runner = self.expirator_runner,
-                                    sender=self.sender,
-                                    send_cmd='DEL',)
+                                    flusher=self.flusher,
+                                    send_cmd='DEL',
+                                    fmt=fmt,)
         self.put_docs = DocidRing(expirator_runner = self.expirator_runner,
                                     flush_delay=flush_delay*1.1)
         self.del_docs = DocidRing(expirator_runner = self.expirator_runner,
@@ -374,6 +595,7 @@ class Indexer:
         docs    = self.put_docs.flush()
         tokens += self.del_hitlists.flush()
         docs   += self.del_docs.flush()
+        self.flusher.join()
         self.sender.join()
         log.info("(Flu) Done")
         return (docs, tokens)
@@ -383,6 +605,7 @@ class Indexer:
         self.flush()
         self.put_hitlists.close()
         self.del_hitlists.close()
+        self.flusher.close()
         self.sender.close()
 
     def put(self, docid, keywords):
@@ -394,16 +617,44 @@ class Indexer:
         return r[1]
 
     def put_multi(self, sequence):
-        return self._multi(sequence, self.del_docs, self.del_hitlists,
-                                     self.put_docs, self.put_hitlists)
+        start = time.time()
+        r = self._multi(sequence, self.del_docs, self.del_hitlists,
+                                  self.put_docs, self.put_hitlists)
+        self.flusher.wait_room()
+        self.put_latency.add(time.time() - start)
+        return r
 
     def delete_multi(self, sequence):
-        return self._multi(sequence, self.put_docs, self.put_hitlists,
-                                     self.del_docs, self.del_hitlists)
+        r = self._multi(sequence, self.put_docs, self.put_hitlists,
+                                  self.del_docs, self.del_hitlists)
+        self.flusher.wait_room()
+        return r
+
+    def put_batch(self, docids, offsets, term_ids, vocabulary):
+        '''
+        Bulk load of pre-tokenized documents, document docids[i] has the
+        words vocabulary[t] for t in term_ids[offsets[i]:offsets[i+1]].
+        docids and offsets are 64 bit, term_ids 32 bit; arrays or numpy
+        arrays of that width are used without a copy. The inversion runs
+        in C, a whole batch at a time.
+        '''
+        r = self._batch(docids, offsets, term_ids, vocabulary,
+                        self.del_docs, self.del_hitlists,
+                        self.put_docs, self.put_hitlists)
+        self.flusher.wait_room()
+        return r
+
+    def delete_batch(self, docids, offsets, term_ids, vocabulary):
+        r = self._batch(docids, offsets, term_ids, vocabulary,
+                        self.put_docs, self.put_hitlists,
+                        self.del_docs, self.del_hitlists)
+        self.flusher.wait_room()
+        return r
 
     @with_lock
     def _multi(self, sequence, bad_docs, bad_hitlists, my_docs, my_hitlists):
-        hld = my_hitlists.hitlists
+        add = my_hitlists.hitlists.add
+        push = my_hitlists.expirator.push
         tokens = 0
         docs = 0
         for docid, words in sequence:
@@ -417,94 +668,436 @@ class Indexer:
 
             chunk_no = docid // self.block_size
 
-            for word in words:
-                hld[(word, chunk_no)].append( docid )
+            for key in add(docid, words, chunk_no):
+                push(key)
 
             my_docs.push(docid)
         my_hitlists.update_counters(tokens, docs)
         return (docs, tokens)
 
+    @with_lock
+    def _batch(self, docids, offsets, term_ids, vocabulary,
+               bad_docs, bad_hitlists, my_docs, my_hitlists):
+        docids = _as_array(docids, 'L')
+        offsets = _as_array(offsets, 'L')
+        term_ids = _as_array(term_ids, 'I')
+        for docid in docids:
+            if docid in bad_docs:
+                log.warning("Modifying recently saved doc #%r. That is slow!" % (docid, ))
+                bad_hitlists.flush()
+                bad_docs.flush()
+                break
+
+        push = my_hitlists.expirator.push
+        for key in my_hitlists.hitlists.add_batch(docids, offsets, term_ids,
+                                                  vocabulary, self.block_size):
+            push(key)
+        for docid in docids:
+            my_docs.push(docid)
+        docs, tokens = len(docids), len(term_ids)
+        my_hitlists.update_counters(tokens, docs)
+        return (docs, tokens)
+
     def stats(self):
-        log.info("      Queued:%i  Tokens: all/in_mem %i/%i  Docs: add/del %i/%i" % (
+        log.info("      Queued:%i  Tokens: all/in_mem %i/%i  Docs: add/del %i/%i  Meta_hit_rate: %.3f" % (
             self.sender.size(),
             self.put_hitlists.total_tuples + self.del_hitlists.total_tuples,
             self.put_hitlists.tuples_inmem + self.del_hitlists.tuples_inmem,
             self.put_hitlists.total_docids, self.del_hitlists.total_docids,
+            self.sender.meta_hit_rate(),
             ))
+        log.info("      put_multi latency: %s" % (self.put_latency,))
 
 
 
+class _Fetch(threading.Thread):
+    ''' Runs fun(*args) in a background thread, get() waits for the result. '''
+    def __init__(self, fun, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._fun = fun
+        self._args = args
+        self._result = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self._fun(*self._args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def get(self):
+        self.join()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
 class Searcher:
-    def __init__(self, mc, block_size=16384, namespace=''):
+    '''
+    Chunks are fetched in batches of up to `prefetch` chunks per round
+    trip. The next batch is fetched in the background while the current
+    one is evaluated. Batches start with a single chunk and grow only as
+    long as the `limit` seems far away.
+
+    With `server_side` the whole query runs in the qlist plugin and only
+    the result is transferred.
+
+    With `cache_size` (in bytes) per chunk results are kept in a LRU
+    cache. A cached chunk costs only a fetch of its generation key, which
+    Sender overwrites whenever the chunk changes.
+
+    With `workers` the chunks of a batch are evaluated by that many
+    threads at once, _qlist releases the GIL while it decodes and merges.
+    Results are still taken in chunk order, so they don't change.
+
+    `mc` is used from background threads too. Searchers running in
+    different threads need a client of their own, or one shared
+    smalltable_extra.pooled_client().
+
+    query() returns the estimated number of results and a lazy iterator,
+    chunk results are decoded only as far as it is consumed. count()
+    returns the exact number of results.
+    '''
+    def __init__(self, mc, block_size=16384, namespace='', prefetch=8,
+                            server_side=False, cache_size=0, workers=0):
         self.namespace = namespace
         self.mc = mc
         self.block_size = block_size
+        self.prefetch = max(1, prefetch)
+        self.server_side = server_side
+        self.cache = lrucache.LRUDict(cache_size) if cache_size else None
+        self.pool = multiprocessing.pool.ThreadPool(workers) if workers > 1 else None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def _bind_chunks(self, chunk_plans, plan=None):
+        '''
+        Fetches qbufs for the terms of many chunks in one round trip.
+        Returns (chunk_number, chunk_plan, bound_terms, generation, qbuf),
+        qbuf is the cached result or None. Only generations are fetched
+        for chunks found in the cache.
+        '''
+        cache = self.cache if plan is not None else None
+        keys = {}
+        cached = {}
+        for chunk_number, chunk_plan in chunk_plans:
+            if cache is not None:
+                keys[generation_key(self.namespace, chunk_number)] = \
+                                                        (chunk_number, None)
+                entry = cache.get((self.namespace, plan, chunk_number))
+                if entry is not None:
+                    cached[chunk_number] = entry
+                    continue
+            for term in queryplan.terms(chunk_plan):
+                keys[self._term_key(term, chunk_number)] = (chunk_number, term)
+        qbufs = self.mc.qlist_get_multi(keys.keys()) if keys else {}
+        bound = collections.defaultdict(dict)
+        generations = {}
+        for key, (chunk_number, term) in keys.iteritems():
+            if term is None:
+                generations[chunk_number] = qbufs.get(key, EMPTY_QBUF)
+            else:
+                bound[chunk_number][term] = qbufs.get(key, EMPTY_QBUF)
+
+        stale = []
+        batch = []
+        for chunk_number, chunk_plan in chunk_plans:
+            generation = generations.get(chunk_number)
+            qbuf = None
+            if chunk_number in cached:
+                cached_generation, qbuf = cached[chunk_number]
+                if cached_generation != generation:
+                    cache.pop((self.namespace, plan, chunk_number))
+                    stale.append((chunk_number, chunk_plan))
+            batch.append((chunk_number, chunk_plan, bound[chunk_number],
+                          generation, qbuf))
+        if stale:
+            refetched = dict((r[0], r) for r in self._bind_chunks(stale, plan))
+            batch = [refetched.get(r[0], r) for r in batch]
+        return batch
+
+    def _next_window(self, window, found_items, srchd_chunks, pending_chunks, limit):
+        window = min(self.prefetch, window * 2)
+        if found_items:
+            per_chunk = float(found_items) / srchd_chunks
+            needed = int(math.ceil((limit - found_items) / per_chunk)) - pending_chunks
+            window = min(window, needed)
+        return max(0, window)
+
+    def _term_key(self, term, chunk_number):
+        return '%s:%s:%s' % (self.namespace, term, chunk_number)
+
+    def _server_query(self, plan, limit, reverse):
+        if plan == queryplan.EMPTY:
+            return (0, iter([]))
+        qbuf, chunks_total, chunks_searched = self.mc.qlist_query(
+                                self.namespace, queryplan.to_rpn(plan),
+                                limit=limit, reverse=reverse)
+        return self._server_results(qbuf, chunks_total, chunks_searched,
+                                    limit, reverse)
+
+    def _server_results(self, qbuf, chunks_total, chunks_searched, limit, reverse):
+        found_items = qlist.count(qbuf)
+        if chunks_searched == 0:
+            results = 0
+        else:
+            results = int(float(found_items) / chunks_searched * chunks_total)
+        return (results, itertools.islice(qlist.cursor(qbuf, reverse), limit))
+
+    def _searched_span(self, chunk_number, qbuf, reverse):
+        # Evaluation stopped at the limit, only the docids up to the last
+        # item found were searched.
+        start = chunk_number * self.block_size
+        if reverse:
+            return start + self.block_size - qlist.cursor(qbuf).next()
+        return qlist.cursor(qbuf, True).next() - start + 1
+
+    def _execute_chunk(self, chunk_number, chunk_plan, bound, remaining, reverse):
+        '''
+        Returns (qbuf, items, searched span).
+        '''
+        qbuf = queryplan.execute(chunk_plan, bound, remaining, reverse)
+        items = qlist.count(qbuf)
+        span = self.block_size
+        if items >= remaining:
+            span = self._searched_span(chunk_number, qbuf, reverse)
+        return (qbuf, items, span)
+
+    def _execute_batch(self, batch, limit, reverse):
+        '''
+        Evaluates the not cached chunks of a batch in the worker threads,
+        each up to the limit. Returns {chunk_number: (qbuf, items, span)}.
+        '''
+        todo = [(chunk_number, chunk_plan, bound)
+                for chunk_number, chunk_plan, bound, _, qbuf in batch
+                                                            if qbuf is None]
+        if self.pool is None or len(todo) < 2:
+            return {}
+        results = self.pool.map(lambda (chunk_number, chunk_plan, bound):
+                                    self._execute_chunk(chunk_number, chunk_plan,
+                                                        bound, limit, reverse),
+                                todo)
+        return dict(zip((chunk_number for chunk_number, _, _ in todo), results))
+
+    def _estimate(self, found_items, srchd_items, chunks):
+        if srchd_items == 0:
+            return 0
+        return int((float(found_items) / float(srchd_items)) * chunks * self.block_size)
+
+    def _chunk_plans(self, plan, reverse=False):
+        [(_, _, metas, _, _)] = self._bind_chunks([('meta', plan)])
+        return self._plans_from_metas(plan, metas, reverse)
 
-    def _bind_query(self, query, chunk_number):
-        query = query[:]
-        keys = []
-        for i, token in enumerate(query):
-            if token not in ['AND', 'ANDNOT', 'OR']:
-                key = '%s:%s:%s' % (self.namespace, token, chunk_number)
-                query[i] = key
-                keys.append( key )
-        metachunks = self.mc.qlist_get_multi(keys)
-        return [metachunks.get(token, token)  for token in query]
+    def _plans_from_metas(self, plan, metas, reverse):
+        chunk_hitlist = queryplan.execute(queryplan.without_negatives(plan), metas)
+        chunk_numbers = qlist.unpack( chunk_hitlist, reverse=reverse)
 
+        # Meta chunks tell where a term may be present, terms that are
+        # missing in a chunk are pruned from the plan and never fetched.
+        term_chunks = dict((term, frozenset(qlist.unpack(qbuf)))
+                                            for term, qbuf in metas.iteritems())
+        return [(chunk_number,
+                 queryplan.prune(plan,
+                     lambda term: chunk_number in term_chunks[term]))
+                                            for chunk_number in chunk_numbers]
+
+    def count(self, tokenized_query):
+        '''
+        Exact number of results. Every chunk is searched, but results are
+        only counted, single terms straight from the qbuf headers.
+        '''
+        plan = queryplan.plan(parsetorpn.parse(tokenized_query))
+        if plan == queryplan.EMPTY:
+            return 0
+        if self.server_side:
+            return self.mc.qlist_query_count(self.namespace,
+                                             queryplan.to_rpn(plan))
+        chunk_plans = self._chunk_plans(plan)
+        count = lambda (chunk_number, chunk_plan, bound, generation, qbuf): \
+                    queryplan.count(chunk_plan, bound) if qbuf is None \
+                                                    else qlist.count(qbuf)
+        mapper = self.pool.map if self.pool is not None else map
+        found_items = 0
+        for pos in xrange(0, len(chunk_plans), self.prefetch):
+            batch = self._bind_chunks(chunk_plans[pos:pos+self.prefetch], plan)
+            found_items += sum(mapper(count, batch))
+        return found_items
 
     def query(self, tokenized_query, limit=1000, reverse=False):
-        unbound_query = parsetorpn.parse(tokenized_query)
-        meta_query = self._bind_query(unbound_query, 'meta')
+        plan = queryplan.plan(parsetorpn.parse(tokenized_query))
+        if self.server_side:
+            return self._server_query(plan, limit, reverse)
 
         hitlists = []
         found_items = 0
         srchd_items = 0
+        chunk_plans = self._chunk_plans(plan, reverse)
 
-        chunk_hitlist =  self._execute_bound_query(meta_query, self.meta_actions)
-        chunk_numbers = qlist.unpack( chunk_hitlist, reverse=reverse)
-
-        for chunk_number in chunk_numbers:
-            bound_query = self._bind_query(unbound_query, chunk_number)
-            qbuf = self._execute_bound_query(bound_query, self.normal_actions)
-            hitlist = qlist.unpack(qbuf, reverse=reverse)
-            hitlists.append(hitlist)
-            found_items += len(hitlist)
-            srchd_items += self.block_size
-            if found_items >= limit:
-                break
+        pos = 0
+        window = 1
+        fetch = None
+        try:
+            while pos < len(chunk_plans):
+                if fetch is None:
+                    fetch = _Fetch(self._bind_chunks,
+                                   chunk_plans[pos:pos+window], plan)
+                batch = fetch.get()
+                fetch = None
+                pos += len(batch)
+                window = self._next_window(window, found_items,
+                                           srchd_items // self.block_size,
+                                           len(batch), limit)
+                if pos < len(chunk_plans) and window:
+                    fetch = _Fetch(self._bind_chunks,
+                                   chunk_plans[pos:pos+window], plan)
+                else:
+                    window = 1
+
+                batch_limit = limit - found_items
+                executed = self._execute_batch(batch, batch_limit, reverse)
+                for chunk_number, chunk_plan, bound, generation, qbuf in batch:
+                    span = self.block_size
+                    if qbuf is None:
+                        remaining = limit - found_items
+                        result = executed.get(chunk_number)
+                        if result is None or (result[1] >= remaining and
+                                               batch_limit > remaining):
+                            # The chunk that reaches the limit is evaluated
+                            # again, to stop exactly where it would alone.
+                            result = self._execute_chunk(chunk_number,
+                                        chunk_plan, bound, remaining, reverse)
+                        qbuf, items, span = result
+                        if items < remaining and self.cache is not None:
+                            # Only whole chunk results are cached.
+                            self.cache.put((self.namespace, plan, chunk_number),
+                                           (generation, qbuf),
+                                           size=len(qbuf) + len(generation))
+                    else:
+                        items = qlist.count(qbuf)
+                    # Decoded only as far as the caller iterates.
+                    hitlists.append(qlist.cursor(qbuf, reverse))
+                    found_items += items
+                    srchd_items += span
+                    if found_items >= limit:
+                        break
+                if found_items >= limit:
+                    break
+        finally:
+            # Don't leave the connection busy in the background.
+            if fetch is not None:
+                fetch.join()
 
-        if srchd_items == 0:
-            results = 0
-        else:
-            results = int((float(found_items) / float(srchd_items)) * len(chunk_numbers) * self.block_size)
-        return (results, itertools.chain(*hitlists))
+        results = self._estimate(found_items, srchd_items, len(chunk_plans))
+        return (results, itertools.islice(itertools.chain(*hitlists), limit))
 
     def materialized_query(self, *args, **kwargs):
         results, out = self.query(*args, **kwargs)
         return (results, list(out))
 
 
-    normal_actions = {
-        'AND': qlist.do_and,
-        'OR': qlist.do_or,
-        'ANDNOT': qlist.do_andnot,
-    }
-
-    meta_actions = {
-        'AND': qlist.do_and,
-        'OR': qlist.do_or,
-        'ANDNOT': lambda a,b:a,
-    }
-
-    def _execute_bound_query(self, q, actions):
-        token = q.pop()
-        if token not in actions:
-            return token # is hitlist
-
-        fun = actions[token]
-
-        b = self._execute_bound_query(q, actions)
-        a = self._execute_bound_query(q, actions)
-        return fun(a, b)
-
+class AsyncSearcher(Searcher):
+    '''
+    Searcher for an AsyncQListClient. query() and count() return futures
+    and never block. Up to `concurrency` batches of chunks are fetched at
+    once, batches grow the same way as in Searcher. There's no result
+    cache.
 
+    The future of query() gets (estimated results, list of docids).
+    '''
+    def __init__(self, client, block_size=16384, namespace='', prefetch=8,
+                                            concurrency=4, server_side=False):
+        Searcher.__init__(self, client, block_size=block_size,
+                          namespace=namespace, prefetch=prefetch,
+                          server_side=server_side)
+        self.concurrency = max(1, concurrency)
+
+    @asyncclient.coroutine
+    def _bind_chunks(self, chunk_plans, plan=None):
+        keys = {}
+        for chunk_number, chunk_plan in chunk_plans:
+            for term in queryplan.terms(chunk_plan):
+                keys[self._term_key(term, chunk_number)] = (chunk_number, term)
+        qbufs = yield self.mc.qlist_get_many(keys.keys())
+        bound = collections.defaultdict(dict)
+        for key, (chunk_number, term) in keys.iteritems():
+            bound[chunk_number][term] = qbufs[key]
+        raise asyncclient.Return([(chunk_number, chunk_plan,
+                                   bound[chunk_number], None, None)
+                                  for chunk_number, chunk_plan in chunk_plans])
+
+    @asyncclient.coroutine
+    def _chunk_plans(self, plan, reverse=False):
+        [(_, _, metas, _, _)] = yield self._bind_chunks([('meta', plan)])
+        raise asyncclient.Return(self._plans_from_metas(plan, metas, reverse))
+
+    @asyncclient.coroutine
+    def count(self, tokenized_query):
+        plan = queryplan.plan(parsetorpn.parse(tokenized_query))
+        if plan == queryplan.EMPTY:
+            raise asyncclient.Return(0)
+        if self.server_side:
+            found_items = yield self.mc.qlist_query_count(self.namespace,
+                                                    queryplan.to_rpn(plan))
+            raise asyncclient.Return(found_items)
+        chunk_plans = yield self._chunk_plans(plan)
+        batches = yield [self._bind_chunks(chunk_plans[pos:pos+self.prefetch])
+                         for pos in xrange(0, len(chunk_plans), self.prefetch)]
+        raise asyncclient.Return(sum(queryplan.count(chunk_plan, bound)
+                                 for batch in batches
+                                 for _, chunk_plan, bound, _, _ in batch))
+
+    @asyncclient.coroutine
+    def query(self, tokenized_query, limit=1000, reverse=False):
+        plan = queryplan.plan(parsetorpn.parse(tokenized_query))
+        if self.server_side:
+            if plan == queryplan.EMPTY:
+                raise asyncclient.Return((0, []))
+            qbuf, chunks_total, chunks_searched = yield self.mc.qlist_query(
+                                self.namespace, queryplan.to_rpn(plan),
+                                limit=limit, reverse=reverse)
+            results, docids = self._server_results(qbuf, chunks_total,
+                                            chunks_searched, limit, reverse)
+            raise asyncclient.Return((results, list(docids)))
+
+        chunk_plans = yield self._chunk_plans(plan, reverse)
+        hitlists = []
+        found_items = 0
+        srchd_items = 0
+        pending = collections.deque()
+        pending_chunks = 0
+        pos = 0
+        window = 1
+        while pos < len(chunk_plans) or pending:
+            while pos < len(chunk_plans) and len(pending) < self.concurrency \
+                                                and (window or not pending):
+                size = max(1, window)
+                pending.append(self._bind_chunks(chunk_plans[pos:pos+size]))
+                pos += size
+                pending_chunks += size
+                window = min(self.prefetch, size * 2)
+            # Batches are evaluated in order, later ones may be ready first.
+            batch = yield pending.popleft()
+            pending_chunks -= len(batch)
+            for chunk_number, chunk_plan, bound, _, _ in batch:
+                qbuf, items, span = self._execute_chunk(chunk_number,
+                        chunk_plan, bound, limit - found_items, reverse)
+                hitlists.append(qlist.unpack(qbuf, reverse=reverse))
+                found_items += items
+                srchd_items += span
+                if found_items >= limit:
+                    break
+            if found_items >= limit:
+                # Responses to the batches still in flight are dropped.
+                break
+            # Batches only grow while issued, here they may shrink.
+            window = min(window, self._next_window(window, found_items,
+                                        srchd_items // self.block_size,
+                                        pending_chunks, limit))
+        results = self._estimate(found_items, srchd_items, len(chunk_plans))
+        raise asyncclient.Return((results,
+                    list(itertools.islice(itertools.chain(*hitlists), limit))))
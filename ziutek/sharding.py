@@ -0,0 +1,229 @@
+'''
+Spreads the index over several smalltable servers. Keys are placed by
+their chunk number on a consistent hash ring, so all the words of a
+chunk and its generation key live on one server and the plugin can
+evaluate queries there. Meta keys ("ns:word:meta") are split: every
+server keeps the chunk numbers of its own chunks.
+
+>>> ring = HashRing(['a:1', 'b:2', 'c:3'])
+>>> sorted(set(ring.get(str(chunk)) for chunk in xrange(100)))
+[0, 1, 2]
+>>> bigger = HashRing(['a:1', 'b:2', 'c:3', 'd:4'])
+>>> moved = [c for c in xrange(1000) if bigger.get(str(c)) != ring.get(str(c))]
+>>> 150 < len(moved) < 350, set(bigger.get(str(c)) for c in moved)
+(True, set([3]))
+
+>>> shard_key('ns:ala:12'), shard_key('ns::gen:12'), shard_key('ns:ala:meta')
+('12', '12', None)
+'''
+import bisect
+import hashlib
+import multiprocessing.pool
+import os
+import struct
+
+from . import qlist
+
+META_SUFFIX='meta'
+
+
+def _hash(s):
+    return struct.unpack('<Q', hashlib.md5(s).digest()[:8])[0]
+
+
+class HashRing(object):
+    '''
+    Every node gets `replicas` points on the ring, a key belongs to the
+    first point after its hash. Adding a node moves only the keys that
+    now belong to it.
+    '''
+    def __init__(self, names, replicas=160):
+        points = sorted((_hash('%s-%i' % (name, i)), n)
+                        for n, name in enumerate(names)
+                        for i in xrange(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+    def get(self, key):
+        i = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[i % len(self._nodes)]
+
+
+def shard_key(key):
+    '''
+    What places the key: the chunk number, None for meta keys, which are
+    on every shard. Other keys are placed as a whole.
+    '''
+    suffix = key.rpartition(':')[2]
+    if suffix == META_SUFFIX:
+        return None
+    if suffix.isdigit():
+        return suffix
+    return key
+
+
+class ShardedClient(object):
+    '''
+    Drop-in for QListClient in Indexer and Searcher. Batches are split
+    per shard and sent to all the shards at once.
+
+    `names` identify the shards on the ring, usually server addresses.
+    Keep them stable, or the keys move. A shard client is used by one
+    thread at a time as long as the ShardedClient is; to share it
+    between threads the shards must be pooled clients.
+    '''
+    def __init__(self, clients, names=None, replicas=160):
+        self.clients = list(clients)
+        self.names = list(names) if names else \
+                        ['shard%i' % (i,) for i in xrange(len(self.clients))]
+        self.replicas = replicas
+        self._ring = HashRing(self.names, replicas)
+        self._placed = {}
+        self._pool = None
+        self._pool_pid = None
+
+    def shard(self, key):
+        '''
+        Index of the shard holding the key, None for meta keys.
+        '''
+        skey = shard_key(key)
+        if skey is None:
+            return None
+        if skey is key:
+            return self._ring.get(skey)
+        # There are few chunks and they are asked for over and over.
+        n = self._placed.get(skey)
+        if n is None:
+            n = self._placed[skey] = self._ring.get(skey)
+        return n
+
+    def _fan_out(self, calls):
+        '''
+        Runs (shard, method name, args) calls at once, one thread per
+        shard. Returns their results in order.
+        '''
+        run = lambda (n, name, args): getattr(self.clients[n], name)(*args)
+        if len(calls) < 2:
+            return map(run, calls)
+        if self._pool is None or self._pool_pid != os.getpid():
+            # Threads don't survive a fork.
+            self._pool = multiprocessing.pool.ThreadPool(len(self.clients))
+            self._pool_pid = os.getpid()
+        return self._pool.map(run, calls)
+
+    def _split_map(self, key_map):
+        '''
+        Splits {key: qbuf} per shard. Chunk numbers in meta qbufs go to
+        the shards holding the chunks.
+        '''
+        shards = [{} for _ in self.clients]
+        for key, value in key_map.iteritems():
+            n = self.shard(key)
+            if n is not None:
+                shards[n][key] = value
+                continue
+            prefix = key[:-len(META_SUFFIX)]
+            parts = [[] for _ in self.clients]
+            for chunk_no in qlist.unpack(value):
+                parts[self.shard(prefix + str(chunk_no))].append(chunk_no)
+            fmt = qlist.get_format(value)
+            for n, chunk_numbers in enumerate(parts):
+                if chunk_numbers:
+                    shards[n][key] = qlist.pack(chunk_numbers, fmt=fmt)
+        return shards
+
+    def _split_keys(self, keys):
+        '''
+        Keys per shard, meta keys are asked from all of them.
+        '''
+        shards = [[] for _ in self.clients]
+        for key in keys:
+            n = self.shard(key)
+            if n is None:
+                for shard_keys in shards:
+                    shard_keys.append(key)
+            else:
+                shards[n].append(key)
+        return shards
+
+    def _write(self, name, *key_maps):
+        split = [self._split_map(key_map) for key_map in key_maps]
+        calls = [(n, name, [maps[n] for maps in split])
+                 for n in xrange(len(self.clients))
+                 if any(maps[n] for maps in split)]
+        self._fan_out(calls)
+        return True
+
+    def qlist_add_multi(self, key_map):
+        return self._write('qlist_add_multi', key_map)
+
+    def qlist_del_multi(self, key_map):
+        return self._write('qlist_del_multi', key_map)
+
+    def qlist_update_multi(self, add_map, del_map):
+        return self._write('qlist_update_multi', add_map, del_map)
+
+    def qlist_touch_multi(self, keys):
+        calls = [(n, 'qlist_touch_multi', [shard_keys])
+                 for n, shard_keys in enumerate(self._split_keys(keys))
+                                                            if shard_keys]
+        self._fan_out(calls)
+        return True
+
+    def qlist_get_multi(self, keys):
+        '''
+        {key: qbuf}, meta qbufs from all the shards are merged.
+        '''
+        calls = [(n, 'qlist_get_multi', [shard_keys])
+                 for n, shard_keys in enumerate(self._split_keys(keys))
+                                                            if shard_keys]
+        merged = {}
+        metas = {}
+        for qbufs in self._fan_out(calls):
+            for key, value in qbufs.iteritems():
+                if shard_key(key) is None:
+                    metas.setdefault(key, []).append(value)
+                else:
+                    merged[key] = value
+        for key, values in metas.iteritems():
+            merged[key] = qlist.do_or_many(values)
+        return merged
+
+    def qlist_get_many(self, keys):
+        keys = list(keys)
+        qbufs = self.qlist_get_multi(keys)
+        empty = qlist.pack([])
+        return dict((key, qbufs.get(key, empty)) for key in keys)
+
+    def qlist_query(self, namespace, rpn, chunk_from=0, chunk_to=2**64-1,
+                                                    limit=0, reverse=False):
+        '''
+        Every shard runs the query on its chunks and the results are
+        merged. They aren't cut to `limit`, the caller's estimate counts
+        everything the shards searched.
+        '''
+        args = [namespace, rpn, chunk_from, chunk_to, limit, reverse]
+        results = self._fan_out([(n, 'qlist_query', args)
+                                 for n in xrange(len(self.clients))])
+        qbuf = qlist.do_or_many([r[0] for r in results])
+        return (qbuf, sum(r[1] for r in results), sum(r[2] for r in results))
+
+    def qlist_query_count(self, namespace, rpn, chunk_from=0, chunk_to=2**64-1):
+        args = [namespace, rpn, chunk_from, chunk_to]
+        return sum(self._fan_out([(n, 'qlist_query_count', args)
+                                  for n in xrange(len(self.clients))]))
+
+    def ping(self):
+        self._fan_out([(n, 'ping', []) for n in xrange(len(self.clients))])
+        return True
+
+    def clone(self):
+        return ShardedClient([client.clone() for client in self.clients],
+                             self.names, self.replicas)
+
+    def close(self):
+        if self._pool is not None and self._pool_pid == os.getpid():
+            self._pool.close()
+        self._pool = None
+        for client in self.clients:
+            client.close()
@@ -0,0 +1,139 @@
+'''
+Queue of packed hitlists for the Sender processes. Payloads go through
+shared memory: hitlists are written into `slots` fixed size slots of an
+anonymous mmap, which forked consumers share, and only (cmd, slots,
+size) goes through the multiprocessing.Queue. Nothing is pickled, a slot
+holds an entry table and the words and hitlists one after another:
+
+    count:4  (word size:4 chunk_no:8 hitlist size:4) * count  data
+
+A consumer gives the slots back as soon as it has read them, so no more
+than `slots` slots are in flight. A batch that doesn't fit into a slot
+is split, a single hitlist bigger than a slot spans several of them.
+
+>>> q = ShmQueue(slots=2, slot_size=4096)
+>>> q.put('ADD', {('ala', 0): 'x' * 10, ('ma', 3): 'yy'})
+>>> q.qsize()
+1
+>>> cmd, dd = q.get(timeout=1)
+>>> cmd, sorted(dd.items())
+('ADD', [(('ala', 0), 'xxxxxxxxxx'), (('ma', 3), 'yy')])
+>>> q.put('DEL', {('big', 0): 'z' * 5000})
+>>> q.get(timeout=1)[1][('big', 0)] == 'z' * 5000
+True
+>>> q.put('ADD', {})
+>>> q.get(timeout=1)
+('ADD', {})
+>>> q.get(timeout=0.01)
+Traceback (most recent call last):
+    ...
+Empty
+
+Batches bigger than a slot come out in parts.
+
+>>> q.put('ADD', dict((('w%i' % i, i), 'q' * 1000) for i in xrange(6)))
+>>> parts = [q.get(timeout=1)[1] for _ in xrange(q.qsize())]
+>>> [len(dd) for dd in parts]
+[4, 2]
+>>> sorted(k for dd in parts for k in dd) == [('w%i' % i, i) for i in xrange(6)]
+True
+>>> q.put('ADD', {('huge', 0): 'z' * 10000})
+Traceback (most recent call last):
+    ...
+ValueError: hitlist of 10000 bytes doesn't fit into 2 slots
+'''
+import itertools
+import mmap
+import multiprocessing
+import struct
+
+_COUNT = struct.Struct('!I')
+_ENTRY = struct.Struct('!IQI')
+
+def _table_format(count):
+    return '!' + 'IQI' * count
+
+
+class ShmQueue(object):
+    def __init__(self, slots, slot_size=1024*1024):
+        self.slots = slots
+        self.slot_size = slot_size
+        # Anonymous maps are MAP_SHARED, children forked later see them.
+        self._shm = mmap.mmap(-1, slots * slot_size)
+        self._queue = multiprocessing.Queue(maxsize=slots)
+        self._free = multiprocessing.Queue()
+        for slot in xrange(slots):
+            self._free.put(slot)
+
+    def _batches(self, dd):
+        '''
+        Splits dd into lists of (word, chunk_no, hitlist) whose entry
+        table and data fit into a slot, or hold a single hitlist.
+        '''
+        batch = []
+        size = _COUNT.size
+        for (word, chunk_no), hitlist in dd.iteritems():
+            entry_sz = _ENTRY.size + len(word) + len(hitlist)
+            if batch and size + entry_sz > self.slot_size:
+                yield batch
+                batch = []
+                size = _COUNT.size
+            batch.append((word, chunk_no, hitlist))
+            size += entry_sz
+        yield batch
+
+    def put(self, cmd, dd):
+        '''
+        Blocks while all the slots are in use.
+        '''
+        for batch in self._batches(dd):
+            table = []
+            parts = [_COUNT.pack(len(batch)), None]
+            for word, chunk_no, hitlist in batch:
+                table += (len(word), chunk_no, len(hitlist))
+                parts += (word, hitlist)
+            parts[1] = struct.pack(_table_format(len(batch)), *table)
+            data = ''.join(parts)
+            n = (len(data) + self.slot_size - 1) // self.slot_size
+            if n > self.slots:
+                raise ValueError("hitlist of %i bytes doesn't fit into %i slots"
+                                 % (len(batch[0][2]), self.slots))
+            slots = []
+            for i in xrange(0, len(data), self.slot_size):
+                slot = self._free.get()
+                pos = slot * self.slot_size
+                piece = data[i:i+self.slot_size]
+                self._shm[pos:pos+len(piece)] = piece
+                slots.append(slot)
+            self._queue.put((cmd, tuple(slots), len(data)))
+
+    def get(self, block=True, timeout=None):
+        '''
+        Returns (cmd, dd), raises Queue.Empty like Queue.get.
+        '''
+        cmd, slots, size = self._queue.get(block, timeout)
+        if not slots:
+            return (cmd, {})
+        # One copy out of the map, the entries are slices of it.
+        parts = []
+        for slot in slots:
+            pos = slot * self.slot_size
+            parts.append(self._shm[pos:pos+min(size, self.slot_size)])
+            size -= self.slot_size
+        data = ''.join(parts) if len(parts) > 1 else parts[0]
+        for slot in slots:
+            self._free.put(slot)
+        count, = _COUNT.unpack_from(data)
+        table = struct.unpack_from(_table_format(count), data, _COUNT.size)
+        pos = _COUNT.size + count * _ENTRY.size
+        dd = {}
+        for word_sz, chunk_no, hitlist_sz in itertools.izip(table[0::3],
+                                                             table[1::3],
+                                                             table[2::3]):
+            end = pos + word_sz
+            pos = end + hitlist_sz
+            dd[(data[end-word_sz:end], chunk_no)] = data[end:pos]
+        return (cmd, dd)
+
+    def qsize(self):
+        return self._queue.qsize()
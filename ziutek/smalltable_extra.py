@@ -2,16 +2,24 @@
 >>> True == True
 True
 '''
+import os
+import struct
+import time
 import smalltable
 
 from . import qlist
+from . import connpool
+from . import sharding
 
-OP_QLIST_ADD=0xF0
-OP_QLIST_DEL=0xF1
+from .protocol import OP_QLIST_ADD, OP_QLIST_DEL, OP_QLIST_QUERY, \
+    OP_QLIST_MULTI, FLAG_QLIST, QUERY_REVERSE, QUERY_COUNT, MULTI_ADD, \
+    MULTI_DEL, multi_values, query_extras, multi_failure
 
-FLAG_QLIST=0x04
+OP_SET=0x01
 
 class QListClient(smalltable.Client):
+    _touch_counter = 0
+
     def _decode(self, value, flags):
         if flags == FLAG_QLIST:
             return value
@@ -49,6 +57,92 @@ class QListClient(smalltable.Client):
                 raise smalltable.status_exceptions[r_status](key=items[i])
         return True
 
+    @smalltable.code_loader(__name__, ['plugin_qlist.c', 'qlist.c'])
+    def qlist_update_multi(self, add_map, del_map):
+        '''
+        Like qlist_add_multi followed by qlist_del_multi, but the entries
+        go packed in a few OP_QLIST_MULTI requests, not a request per
+        key, and the server answers each with a single reply.
+        '''
+        entries = [(MULTI_ADD, key, value) for key, value in add_map.iteritems()]
+        entries.extend((MULTI_DEL, key, value) for key, value in del_map.iteritems())
+        if not entries:
+            return True
+        firsts = []
+        def _reqs():
+            for first, value in multi_values(entries):
+                firsts.append(first)
+                yield {
+                    'opcode':OP_QLIST_MULTI,
+                    'key':'',
+                    'value': value,
+                }
+        self.conn.send_with_noop( _reqs() )
+        for i, (r_status, r_cas, r_extras, r_key, r_value) in enumerate(self.conn.recv_till_noop()):
+            if r_status is not smalltable.STATUS_NO_ERROR:
+                raise smalltable.status_exceptions[r_status](key=entries[firsts[i]][1])
+            failure = multi_failure(r_extras, r_value)
+            if failure:
+                index, status = failure
+                raise smalltable.status_exceptions[status](key=entries[firsts[i] + index][1])
+        return True
+
+    def qlist_touch_multi(self, keys):
+        '''
+        Overwrites the keys with a fresh unique token, readers compare
+        tokens to tell if anything changed.
+        '''
+        keys = list(keys)
+        self._touch_counter += 1
+        token = '%i:%i:%.6f' % (os.getpid(), self._touch_counter, time.time())
+        def _req(key):
+            return {
+                'opcode':OP_SET,
+                'key':key,
+                'extras': struct.pack('!II', 0, 0),
+                'value': token,
+                'reserved':smalltable.RESERVED_FLAG_QUIET,
+            }
+        self.conn.send_with_noop( _req(key) for key in keys )
+        for i, (r_status, r_cas, r_extras, r_key, r_value) in enumerate(self.conn.recv_till_noop()):
+            if r_status is not smalltable.STATUS_NO_ERROR:
+                raise smalltable.status_exceptions[r_status](key=keys[i])
+        return True
+
+    def _qlist_query(self, namespace, rpn, chunk_from, chunk_to, limit, flags):
+        req = {
+            'opcode':OP_QLIST_QUERY,
+            'key': namespace + ':',
+            'extras': query_extras(chunk_from, chunk_to, limit, flags),
+            'value': '\n'.join(rpn),
+        }
+        self.conn.send_with_noop( [req] )
+        responses = list(self.conn.recv_till_noop())
+        r_status, r_cas, r_extras, r_key, r_value = responses[0]
+        if r_status is not smalltable.STATUS_NO_ERROR:
+            raise smalltable.status_exceptions[r_status](key=namespace)
+        chunks_total, chunks_searched, items = struct.unpack('!III', r_extras)
+        return (r_value, chunks_total, chunks_searched, items)
+
+    @smalltable.code_loader(__name__, ['plugin_qlist.c', 'qlist.c'])
+    def qlist_query(self, namespace, rpn, chunk_from=0, chunk_to=2**64-1,
+                                                    limit=0, reverse=False):
+        '''
+        Runs the whole query on the server, only the result crosses the
+        network. Returns (qbuf, chunks_total, chunks_searched).
+        '''
+        flags = QUERY_REVERSE if reverse else 0
+        return self._qlist_query(namespace, rpn, chunk_from, chunk_to,
+                                 limit, flags)[:3]
+
+    @smalltable.code_loader(__name__, ['plugin_qlist.c', 'qlist.c'])
+    def qlist_query_count(self, namespace, rpn, chunk_from=0, chunk_to=2**64-1):
+        '''
+        Exact number of results of the query, counted on the server.
+        '''
+        return self._qlist_query(namespace, rpn, chunk_from, chunk_to,
+                                 0, QUERY_COUNT)[3]
+
     def qlist_get_multi(self, keys):
         return self.get_multi(keys, default=qlist.pack([]))
 
@@ -57,6 +151,35 @@ class QListClient(smalltable.Client):
         return dict( zip(keys, self.get_multi(keys, default=qlist.pack([]))) )
 
 
+    def ping(self):
+        '''
+        A NOOP round trip, raises if the connection is broken.
+        '''
+        self.conn.send_with_noop([])
+        list(self.conn.recv_till_noop())
+        return True
+
     def clone(self):
         return QListClient(self.server_addr)
 
+
+def pooled_client(server_addr, size=8, **kwargs):
+    '''
+    A QListClient that can be shared by threads, each call takes a
+    connection from a pool of up to `size`. See connpool.
+    '''
+    return connpool.PooledClient(connpool.ConnectionPool(
+                    lambda: QListClient(server_addr), size=size, **kwargs))
+
+
+def sharded_client(server_addrs, pool_size=0):
+    '''
+    A QListClient over several servers, see sharding. With `pool_size`
+    every server gets a pool of connections and the client can be shared
+    by threads.
+    '''
+    if pool_size:
+        clients = [pooled_client(addr, size=pool_size) for addr in server_addrs]
+    else:
+        clients = [QListClient(addr) for addr in server_addrs]
+    return sharding.ShardedClient(clients, names=server_addrs)
@@ -0,0 +1,273 @@
+import random
+import socket
+import SocketServer
+import struct
+import threading
+import unittest
+
+from ziutek import asyncclient
+from ziutek import parsetorpn
+from ziutek import protocol
+from ziutek import qlist
+from ziutek import queryplan
+from ziutek import rtftse
+
+HEADER = asyncclient.HEADER
+STATUS_ITEM_NOT_STORED = 0x0005
+OP_NOOP = 0x0a
+
+
+def _recv_exactly(sock, size):
+    parts = []
+    while size:
+        data = sock.recv(size)
+        if not data:
+            raise EOFError()
+        parts.append(data)
+        size -= len(data)
+    return ''.join(parts)
+
+
+class FakeHandler(SocketServer.BaseRequestHandler):
+    '''
+    Enough of the memcache binary protocol and the qlist plugin to stand
+    in for smalltable. Keys starting with "bad" can't be stored, getting
+    "close" drops the connection.
+    '''
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                header = _recv_exactly(self.request, HEADER.size)
+            except (EOFError, socket.error):
+                return
+            _, opcode, key_sz, extras_sz, _, _, body_sz, opaque, _ = \
+                                                        HEADER.unpack(header)
+            body = _recv_exactly(self.request, body_sz)
+            extras = body[:extras_sz]
+            key = body[extras_sz:extras_sz+key_sz]
+            value = body[extras_sz+key_sz:]
+            if opcode == asyncclient.OP_GET and key == 'close':
+                return
+            with self.server.lock:
+                status, r_extras, r_value = self.server.execute(opcode, key,
+                                                                extras, value)
+            self.request.sendall(HEADER.pack(asyncclient.MAGIC_RESPONSE,
+                    opcode, 0, len(r_extras), 0, status,
+                    len(r_extras) + len(r_value), opaque, 0)
+                    + r_extras + r_value)
+
+
+class FakeServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 FakeHandler)
+        self.lock = threading.Lock()
+        self.data = {}
+        self.requests = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def addr(self):
+        return '%s:%i' % self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def execute(self, opcode, key, extras, value):
+        self.requests += 1
+        if opcode == asyncclient.OP_GET:
+            if key not in self.data:
+                return (asyncclient.STATUS_KEY_ENOENT, '', '')
+            return (0, struct.pack('!I', protocol.FLAG_QLIST), self.data[key])
+        if opcode == OP_NOOP:
+            return (0, '', '')
+        if opcode == protocol.OP_QLIST_MULTI:
+            return self._multi(value)
+        if opcode == protocol.OP_QLIST_QUERY:
+            return self._query(key, extras, value)
+        return (0x0081, '', '')
+
+    def _multi(self, value):
+        failed = []
+        pos = index = 0
+        while pos < len(value):
+            op, key_sz, value_sz = struct.unpack('!BBI', value[pos:pos+6])
+            key = value[pos+6:pos+6+key_sz]
+            qbuf = value[pos+6+key_sz:pos+6+key_sz+value_sz]
+            pos += 6 + key_sz + value_sz
+            if key.startswith('bad'):
+                failed.append(struct.pack('!IH', index, STATUS_ITEM_NOT_STORED))
+            elif op == protocol.MULTI_ADD:
+                self.data[key] = qlist.do_or(self.data.get(key, qlist.pack([])),
+                                             qbuf)
+            elif key in self.data:
+                self.data[key] = qlist.do_andnot(self.data[key], qbuf)
+                if qlist.is_empty(self.data[key]):
+                    del self.data[key]
+            index += 1
+        return (0, struct.pack('!I', len(failed)), ''.join(failed))
+
+    def _query(self, prefix, extras, value):
+        _, _, limit, flags = struct.unpack('!QQII', extras)
+        plan = queryplan.plan(value.split('\n'))
+        def _bind(chunk):
+            return dict((term, self.data.get('%s%s:%s' % (prefix, term, chunk),
+                                             qlist.pack([])))
+                        for term in queryplan.terms(plan))
+        chunks = list(qlist.unpack(queryplan.execute(
+                            queryplan.without_negatives(plan), _bind('meta')),
+                            reverse=bool(flags & protocol.QUERY_REVERSE)))
+        results = qlist.pack([])
+        items = searched = 0
+        for chunk in chunks:
+            if limit and items >= limit and not flags & protocol.QUERY_COUNT:
+                break
+            remaining = 0
+            if limit and not flags & protocol.QUERY_COUNT:
+                remaining = limit - items
+            qbuf = queryplan.execute(plan, _bind(chunk), remaining,
+                                     bool(flags & protocol.QUERY_REVERSE))
+            results = qlist.do_or(results, qbuf)
+            items += qlist.count(qbuf)
+            searched += 1
+        if flags & protocol.QUERY_COUNT:
+            results = ''
+        return (0, struct.pack('!III', len(chunks), searched, items), results)
+
+
+class AsyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.client = asyncclient.AsyncQListClient(self.server.addr,
+                                                   connections=3)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def run_until(self, future):
+        return self.client.run_until(future, timeout=5)
+
+
+class TestClient(AsyncTestCase):
+    def test_pipelined(self):
+        data = dict(('k%i' % i, qlist.pack([i, i + 1])) for i in xrange(200))
+        self.assertTrue(self.run_until(self.client.qlist_add_multi(data)))
+        keys = ['k%i' % i for i in xrange(0, 250, 3)]
+        futures = [self.client.qlist_get_many(keys[i:]) for i in xrange(10)]
+        # Nothing is sent before polling.
+        self.assertEqual(self.server.requests, 1)
+        results = self.run_until(asyncclient.gather(futures))
+        for i, result in enumerate(results):
+            self.assertEqual(result, dict((key, data.get(key, qlist.pack([])))
+                                          for key in keys[i:]))
+        self.assertEqual(self.client.pending(), 0)
+
+    def test_get_multi_default(self):
+        self.run_until(self.client.qlist_add_multi({'a': qlist.pack([1])}))
+        self.assertEqual(self.run_until(self.client.get_multi(['a', 'b'], 'x')),
+                         [qlist.pack([1]), 'x'])
+        self.assertEqual(self.run_until(self.client.get_multi([])), [])
+
+    def test_update_multi(self):
+        self.run_until(self.client.qlist_add_multi({
+                    'a': qlist.pack([1, 2, 3]), 'b': qlist.pack([7])}))
+        self.run_until(self.client.qlist_update_multi(
+                    {'a': qlist.pack([4])}, {'a': qlist.pack([1]),
+                                             'b': qlist.pack([7])}))
+        result = self.run_until(self.client.qlist_get_many(['a', 'b']))
+        self.assertEqual(list(qlist.unpack(result['a'])), [2, 3, 4])
+        self.assertEqual(list(qlist.unpack(result['b'])), [])
+
+    def test_error(self):
+        future = self.client.qlist_add_multi({'bad': qlist.pack([1])})
+        try:
+            self.run_until(future)
+        except asyncclient.ServerError, e:
+            self.assertEqual((e.status, e.key), (STATUS_ITEM_NOT_STORED, 'bad'))
+        else:
+            self.fail()
+        # The connection is still usable.
+        self.assertEqual(self.run_until(self.client.get_multi(['bad'])), [None])
+
+    def test_connection_closed(self):
+        future = self.client.get_multi(['a', 'close', 'a'])
+        self.assertRaises(socket.error, self.run_until, future)
+        self.assertEqual(len(self.client.sockets()), 2)
+        self.assertRaises(socket.error, self.run_until,
+                          self.client.get_multi(['a'] * 3))
+
+
+class TestAsyncSearcher(AsyncTestCase):
+    block_size = 64
+    words = ['a', 'b', 'c', 'd']
+
+    def setUp(self):
+        AsyncTestCase.setUp(self)
+        rnd = random.Random(7)
+        self.docs = {}
+        for docid in xrange(2000):
+            # Sparse chunks and chunks where a word is missing.
+            if rnd.random() < 0.5 or docid // self.block_size in (5, 6):
+                continue
+            self.docs[docid] = set(w for w, p in zip(self.words, (.5, .3, .1, .01))
+                                   if rnd.random() < p)
+        hitlists = {}
+        for docid, words in self.docs.iteritems():
+            chunk = docid // self.block_size
+            for word in words:
+                hitlists.setdefault('ns:%s:%i' % (word, chunk), []).append(docid)
+                hitlists.setdefault('ns:%s:meta' % (word,), set()).add(chunk)
+        self.run_until(self.client.qlist_add_multi(dict(
+            (key, qlist.pack(sorted(docids))) for key, docids in hitlists.items())))
+
+    def matching(self, query):
+        plan = queryplan.plan(parsetorpn.parse(query.split()))
+        def _eval(node):
+            if isinstance(node, str):
+                return set(d for d, words in self.docs.iteritems() if node in words)
+            sets = [_eval(o) for o in node[1]]
+            if node[0] == 'OR':
+                return set().union(*sets)
+            return set.intersection(*sets).difference(*map(_eval, node[2]))
+        return sorted(_eval(plan))
+
+    def test_query(self):
+        queries = ['a', 'b', 'd', 'a AND b', 'a OR d', 'a ANDNOT b',
+                   'b AND c ANDNOT a', 'x', 'x OR c', 'a AND x']
+        for server_side, concurrency, prefetch in ((False, 1, 1), (False, 4, 8),
+                                                   (False, 3, 2), (True, 4, 8)):
+            srch = rtftse.AsyncSearcher(self.client, block_size=self.block_size,
+                            namespace='ns', prefetch=prefetch,
+                            concurrency=concurrency, server_side=server_side)
+            for query in queries:
+                expected = self.matching(query)
+                self.assertEqual(self.run_until(srch.count(query.split())),
+                                 len(expected))
+                for limit in (1, 10, 300, 5000):
+                    for reverse in (False, True):
+                        _, docids = self.run_until(srch.query(
+                                query.split(), limit=limit, reverse=reverse))
+                        want = expected[::-1] if reverse else expected
+                        self.assertEqual(docids, want[:limit],
+                                (query, limit, reverse, server_side))
+
+    def test_concurrent_queries(self):
+        srch = rtftse.AsyncSearcher(self.client, block_size=self.block_size,
+                                    namespace='ns', prefetch=4)
+        queries = ['a', 'a AND b', 'c OR d', 'b ANDNOT c'] * 5
+        futures = [srch.query(q.split(), limit=100) for q in queries]
+        for query, (results, docids) in zip(queries,
+                            self.run_until(asyncclient.gather(futures))):
+            self.assertEqual(docids, self.matching(query)[:100])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import socket
+import threading
+import time
+import unittest
+
+from ziutek import connpool
+
+
+class FakeClient(object):
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+
+    def echo(self, value, delay=0):
+        if self.broken:
+            raise socket.error('connection reset')
+        with self.lock:
+            FakeClient.active += 1
+            FakeClient.max_active = max(FakeClient.max_active, FakeClient.active)
+        time.sleep(delay)
+        with self.lock:
+            FakeClient.active -= 1
+        return value
+
+    def fail(self):
+        raise KeyError('not a connection error')
+
+    def ping(self):
+        if self.broken:
+            raise socket.error('connection reset')
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        FakeClient.max_active = 0
+        self.pool = connpool.ConnectionPool(FakeClient, size=3)
+        self.mc = connpool.PooledClient(self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_bounded(self):
+        results = []
+        def worker(i):
+            results.append(self.mc.echo(i, delay=0.02))
+        threads = [threading.Thread(target=worker, args=(i,)) for i in xrange(12)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(results), range(12))
+        self.assertEqual(FakeClient.max_active, 3)
+        s = self.pool.stats()
+        self.assertEqual((s['created'], s['in_use'], s['idle']), (3, 0, 3))
+        self.assertTrue(s['waits'] > 0 and s['wait_time'] > 0)
+
+    def test_timeout(self):
+        pool = connpool.ConnectionPool(FakeClient, size=1, timeout=0.05)
+        conn = pool.get()
+        self.assertRaises(connpool.PoolTimeout, pool.get)
+        pool.put(conn)
+        self.assertTrue(pool.get() is conn)
+
+    def test_other_errors_keep_connection(self):
+        self.assertRaises(KeyError, self.mc.fail)
+        self.assertRaises(KeyError, self.mc.fail)
+        s = self.pool.stats()
+        self.assertEqual((s['created'], s['reconnects'], s['idle']), (1, 0, 1))
+
+    def test_reconnect(self):
+        self.mc.echo(1)
+        conn = self.pool.get()
+        conn.broken = True
+        self.pool.put(conn)
+        self.assertEqual(self.mc.echo(2), 2)
+        self.assertTrue(conn.closed)
+        s = self.pool.stats()
+        self.assertEqual((s['created'], s['reconnects']), (2, 1))
+
+    def test_fresh_connection_not_retried(self):
+        made = []
+        def factory():
+            made.append(FakeClient())
+            made[-1].broken = True
+            return made[-1]
+        pool = connpool.ConnectionPool(factory, size=1)
+        # Server down, only reused connections are retried.
+        self.assertRaises(socket.error, pool.call, 'echo', 1)
+        self.assertEqual(len(made), 1)
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+    def test_health_check(self):
+        pool = connpool.ConnectionPool(FakeClient, size=2, check_interval=0)
+        with pool.connection() as conn:
+            pass
+        conn.broken = True
+        time.sleep(0.01)
+        with pool.connection() as conn2:
+            self.assertFalse(conn2 is conn)
+        s = pool.stats()
+        self.assertEqual((s['checks'], s['reconnects'], s['created']), (1, 1, 2))
+
+    def test_generator_args(self):
+        calls = []
+        class Client(FakeClient):
+            def touch(self, keys):
+                keys = list(keys)
+                calls.append(keys)
+                if len(calls) == 1:
+                    raise socket.error('connection reset')
+                return keys
+        pool = connpool.ConnectionPool(Client, size=1)
+        pool.put(pool.get())
+        self.assertEqual(pool.call('touch', (i for i in xrange(3))), [0, 1, 2])
+        self.assertEqual(calls, [[0, 1, 2], [0, 1, 2]])
+
+    def test_fork(self):
+        self.mc.echo(1)
+        parent_conn = self.pool._idle[0][0]
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                with self.pool.connection() as conn:
+                    ok = conn is not parent_conn
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
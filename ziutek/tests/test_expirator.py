@@ -0,0 +1,117 @@
+import random
+import unittest
+
+from ziutek import expirator
+
+
+class Clock(object):
+    def __init__(self, t):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+class TestTimerWheel(unittest.TestCase):
+    # Small wheels, so that keys move between them and overflow.
+    wheel_bits = 2
+    wheel_levels = 2
+
+    def setUp(self):
+        self.saved = (expirator.WHEEL_BITS, expirator.WHEEL_LEVELS)
+        self.configure(self.wheel_bits, self.wheel_levels)
+
+    def tearDown(self):
+        self.configure(*self.saved)
+
+    def configure(self, bits, levels):
+        expirator.WHEEL_BITS = bits
+        expirator.WHEEL_LEVELS = levels
+        expirator.WHEEL_SIZE = 1 << bits
+        expirator.WHEEL_MASK = (1 << bits) - 1
+
+    def entries(self, ex):
+        return len(ex._overflow) + sum(len(slot) for wheel in ex._wheels
+                                                 for slot in wheel)
+
+    def test_random(self):
+        rnd = random.Random(11)
+        for delay in (1, 3, 7, 17, 40, 300):
+            clock = Clock(rnd.randint(0, 1000))
+            ex = expirator._Expirator(delay, None, clock, granularity=1.0)
+            model = {}
+            most = 0
+            for step in xrange(3000):
+                action = rnd.random()
+                if action < 0.5:
+                    key = rnd.randint(0, 200)
+                    ex.push(key)
+                    model[key] = clock.t + delay
+                elif action < 0.6:
+                    key = rnd.randint(0, 200)
+                    self.assertEqual(ex.cancel(key), model.pop(key, None) is not None)
+                elif action < 0.65:
+                    keys = ex.pop_many(rnd.randint(1, 5))
+                    self.assertTrue(all(key in model for key in keys))
+                    for key in keys:
+                        del model[key]
+                else:
+                    clock.t += rnd.choice((0, 1, 1, 2, 5, 30))
+                    expected = sorted(k for k, due in model.iteritems()
+                                      if due <= clock.t)
+                    self.assertEqual(sorted(ex.expire(clock.t)), expected,
+                                     (delay, step))
+                    for key in expected:
+                        del model[key]
+                self.assertEqual(len(ex), len(model))
+                most = max(most, len(model))
+                self.assertTrue(self.entries(ex) <=
+                                2 * most + expirator.WHEEL_SIZE + 1)
+            self.assertEqual(sorted(ex.pop_all()), sorted(model))
+            self.assertEqual(ex.expire(clock.t + 10 * delay), [])
+
+    def test_pop_many_order(self):
+        clock = Clock(5)
+        ex = expirator._Expirator(100, None, clock, granularity=1.0)
+        for key in xrange(200):
+            ex.push(key)
+            clock.t += 1
+        self.assertEqual(ex.expire(159), range(55))
+        self.assertEqual(ex.pop_many(10), range(55, 65))
+        self.assertEqual(ex.pop(), 65)
+        self.assertEqual(ex.pop_many(1000), range(66, 200))
+        self.assertEqual((ex.pop(), len(ex)), (None, 0))
+
+    def test_repush_bounded(self):
+        clock = Clock(0)
+        ex = expirator._Expirator(1000, None, clock, granularity=1.0)
+        ex.push('other')
+        for i in xrange(10000):
+            clock.t = i // 7
+            ex.push('a')
+            if i % 3 == 1:
+                ex.cancel('a')
+            self.assertTrue(self.entries(ex) <= 4 + expirator.WHEEL_SIZE)
+        self.assertEqual(ex.expire(clock.t + 999), ['other'])
+        self.assertEqual(ex.expire(clock.t + 1000), ['a'])
+        self.assertEqual(self.entries(ex), 0)
+
+    def test_long_jump(self):
+        clock = Clock(0.5)
+        ex = expirator._Expirator(2.5, None, clock, granularity=0.5)
+        ex.push('a')
+        clock.t = 1000000.0
+        ex.push('b')
+        self.assertEqual(ex.expire(2.9), [])
+        self.assertEqual(ex.expire(3.0), ['a'])
+        self.assertEqual(ex.expire(1000002.0), [])
+        self.assertEqual(ex.expire(1000002.5), ['b'])
+
+
+class TestDefaultWheel(TestTimerWheel):
+    wheel_bits = 6
+    wheel_levels = 4
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import random
+import threading
+import unittest
+
+from ziutek import expirator
+from ziutek import qlist
+from ziutek import rtftse
+
+
+class GatedSender(object):
+    ''' Takes what Sender.push gets, blocks while the gate is closed. '''
+    def __init__(self):
+        self.gate = threading.Event()
+        self.gate.set()
+        self.pushed = []
+
+    def push(self, item):
+        self.gate.wait()
+        self.pushed.append(item)
+
+
+class TestFlusher(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.runner = expirator.ExpiratorRunner(self.lock, granularity=0.01)
+        self.sender = GatedSender()
+        self.flusher = rtftse.Flusher(self.sender, qlist.FMT_SVB)
+        self.hitlists = rtftse.Hitlists(max_tuples=10**9, flusher=self.flusher,
+                                        block_size=64,
+                                        expirator_runner=self.runner,
+                                        flush_delay=3600, send_cmd='ADD',
+                                        fmt=qlist.FMT_SVB)
+        self.expected = {}
+
+    def tearDown(self):
+        self.sender.gate.set()
+        self.runner.close()
+        self.flusher.close()
+
+    def put(self, docids):
+        rnd = random.Random(4)
+        with self.lock:
+            for docid in docids:
+                words = ['w%i' % rnd.randint(0, 50) for _ in xrange(5)]
+                for key in self.hitlists.hitlists.add(docid, words, docid // 64):
+                    self.hitlists.expirator.push(key)
+                for word in words:
+                    self.expected.setdefault((word, docid // 64), set()).add(docid)
+            self.hitlists.update_counters(5 * len(docids), len(docids))
+
+    def sent(self):
+        found = {}
+        for cmd, dd in self.sender.pushed:
+            self.assertEqual(cmd, 'ADD')
+            for key, qbuf in dd.iteritems():
+                self.assertEqual(qlist.get_format(qbuf), qlist.FMT_SVB)
+                found.setdefault(key, set()).update(qlist.unpack(qbuf))
+        return found
+
+    def test_packs_outside_lock(self):
+        self.put(xrange(2000))
+        self.sender.gate.clear()
+        # The sender is stuck, detaching under the lock still returns.
+        with self.lock:
+            self.assertEqual(self.hitlists.flush(), 10000)
+        self.assertEqual((len(self.hitlists.hitlists), self.hitlists.tuples_inmem),
+                         (0, 0))
+        self.put(xrange(2000, 2100))
+        self.assertEqual(self.sender.pushed, [])
+        self.sender.gate.set()
+        with self.lock:
+            self.hitlists.flush()
+        self.flusher.join()
+        # In batches of at most FLUSH_BATCH_KEYS hitlists.
+        self.assertTrue(all(len(dd) <= rtftse.FLUSH_BATCH_KEYS
+                            for _, dd in self.sender.pushed))
+        self.assertEqual(self.sent(), self.expected)
+
+    def test_memory_limit(self):
+        self.hitlists.max_tuples = 1000
+        self.put(xrange(300))
+        self.put(xrange(300, 600))
+        self.assertTrue(self.hitlists.tuples_inmem <= 1000)
+        with self.lock:
+            self.hitlists.flush()
+        self.flusher.join()
+        self.assertTrue(len(self.sender.pushed) > 2)
+        self.assertEqual(self.sent(), self.expected)
+
+    def test_putters_not_blocked(self):
+        def putter():
+            for i in xrange(rtftse.FLUSH_QUEUE_LIMIT + 2):
+                self.put(xrange(100 * i, 100 * i + 100))
+                with self.lock:
+                    self.hitlists.flush()
+            # Past the limit, flushes under the lock still return.
+            self.hitlists.max_tuples = 100
+            self.put(xrange(1000, 1100))
+        self.sender.gate.clear()
+        putter = threading.Thread(target=putter)
+        putter.start()
+        putter.join(5)
+        self.assertFalse(putter.is_alive())
+        # The putters wait outside the lock until the flusher catches up.
+        waiter = threading.Thread(target=self.flusher.wait_room)
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        self.assertEqual(self.sender.pushed, [])
+        self.sender.gate.set()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        with self.lock:
+            self.hitlists.flush()
+        self.flusher.join()
+        self.assertEqual(self.sent(), self.expected)
+
+    def test_error_raised_on_join(self):
+        self.flusher.push('ADD', qlist.Accumulator(), [('missing', 0)])
+        self.assertRaises(KeyError, self.flusher.join)
+        self.put(xrange(10))
+        with self.lock:
+            self.hitlists.flush()
+        self.flusher.join()
+        self.assertEqual(self.sent(), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
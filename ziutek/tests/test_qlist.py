@@ -0,0 +1,411 @@
+import array
+import random
+import unittest
+
+from ziutek import qlist
+
+FORMATS = (qlist.FMT_PLAIN, qlist.FMT_BLOCKS, qlist.FMT_SVB)
+
+
+def random_list(rnd, size, maxval):
+    return sorted(set(rnd.randint(0, maxval) for _ in xrange(size)))
+
+
+class TestSetOperations(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(42)
+
+    def _check(self, a, b):
+        expected = {
+            'do_or': sorted(set(a) | set(b)),
+            'do_and': sorted(set(a) & set(b)),
+            'do_andnot': sorted(set(a) - set(b)),
+        }
+        for fa in FORMATS:
+            for fb in FORMATS:
+                qa = qlist.pack(a, fmt=fa)
+                qb = qlist.pack(b, fmt=fb)
+                for op, items in expected.iteritems():
+                    qc = getattr(qlist, op)(qa, qb)
+                    self.assertEqual(qlist.get_format(qc), fa)
+                    self.assertEqual(list(qlist.unpack(qc)), items,
+                                     "%s %r %r" % (op, fa, fb))
+
+    def test_roundtrip(self):
+        for size in (0, 1, 127, 128, 129, 1000):
+            a = random_list(self.rnd, size, 1 << 40)
+            for fmt in FORMATS:
+                self.assertEqual(list(qlist.unpack(qlist.pack(a, fmt=fmt))), a)
+
+    def test_zero_item(self):
+        for fmt in FORMATS:
+            self.assertEqual(list(qlist.unpack(qlist.pack([0, 0, 1], fmt=fmt))),
+                             [0, 1])
+
+    def test_short_and_long(self):
+        long_list = random_list(self.rnd, 20000, 100000)
+        for size in (0, 1, 10, 300):
+            self._check(random_list(self.rnd, size, 100000), long_list)
+            self._check(long_list, random_list(self.rnd, size, 100000))
+
+    def test_random(self):
+        for _ in xrange(50):
+            a = random_list(self.rnd, self.rnd.randint(0, 600), 2000)
+            b = random_list(self.rnd, self.rnd.randint(0, 600), 2000)
+            self._check(a, b)
+
+    def test_big_deltas(self):
+        a = [1, 256, 65536, 16777216, 4294967295, 1 << 40]
+        b = random_list(self.rnd, 500, 1 << 41) + [1 << 40]
+        self._check(a, sorted(set(b)))
+
+
+class TestManyOperations(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(7)
+
+    def test_random(self):
+        for _ in xrange(50):
+            lists = [random_list(self.rnd, self.rnd.randint(0, 800), 3000)
+                     for _ in xrange(self.rnd.randint(1, 6))]
+            nots = [random_list(self.rnd, self.rnd.randint(0, 300), 3000)
+                    for _ in xrange(self.rnd.randint(0, 3))]
+            qbufs = [qlist.pack(l, fmt=self.rnd.choice(FORMATS)) for l in lists]
+            not_qbufs = [qlist.pack(l, fmt=self.rnd.choice(FORMATS)) for l in nots]
+
+            all_of = set(lists[0]).intersection(*lists[1:])
+            any_of = set(lists[0]).union(*lists[1:])
+            none_of = set().union(*nots)
+
+            self.assertEqual(list(qlist.unpack(qlist.do_and_many(qbufs))),
+                             sorted(all_of))
+            self.assertEqual(list(qlist.unpack(qlist.do_or_many(qbufs))),
+                             sorted(any_of))
+            r = qlist.do_andnot_many(qbufs, not_qbufs)
+            self.assertEqual(list(qlist.unpack(r)), sorted(all_of - none_of))
+            self.assertEqual(qlist.get_format(r), qlist.get_format(qbufs[0]))
+
+    def test_cross_format_growth(self):
+        # Results are written in the format of the first list, the 3 byte
+        # Stream VByte deltas take 4 bytes as varints.
+        x = [i * 3000000 for i in xrange(2000)]
+        svb = qlist.pack(x, fmt=qlist.FMT_SVB)
+        for fmt in (qlist.FMT_PLAIN, qlist.FMT_BLOCKS):
+            qa = qlist.pack(x[::2], fmt=fmt)
+            self.assertEqual(list(qlist.unpack(qlist.do_and(qa, svb))), x[::2])
+            self.assertEqual(list(qlist.unpack(qlist.do_or(qa, svb))), x)
+            self.assertEqual(list(qlist.unpack(qlist.do_and_many([qa, svb]))),
+                             x[::2])
+            self.assertEqual(list(qlist.unpack(qlist.do_or_many([qa, svb]))), x)
+            self.assertEqual(list(qlist.unpack(qlist.do_andnot_many([qa], [svb]))),
+                             [])
+
+    def test_empty_sequence(self):
+        self.assertRaises(TypeError, qlist.do_and_many, [])
+        self.assertRaises(TypeError, qlist.do_or_many, [])
+
+
+class TestBigLists(unittest.TestCase):
+    def test_over_million_items(self):
+        n = 3 * 1024 * 1024
+        evens = array.array('L', xrange(0, 2 * n, 2))
+        odds = array.array('L', xrange(1, 2 * n, 2))
+        for fmt in FORMATS:
+            qa = qlist.pack(evens, fmt=fmt)
+            qb = qlist.pack(odds, fmt=fmt)
+            self.assertEqual(qlist.unpack(qa), evens)
+            self.assertEqual(qlist.count(qa), n)
+
+            qc = qlist.do_or(qa, qb)
+            self.assertEqual(qlist.count(qc), 2 * n)
+            self.assertEqual(qlist.unpack(qc), array.array('L', xrange(2 * n)))
+            self.assertEqual(qlist.do_or_many([qa, qb, qa]), qc)
+            self.assertTrue(qlist.is_empty(qlist.do_and(qa, qb)))
+            self.assertEqual(qlist.do_andnot(qc, qb), qa)
+            self.assertEqual(qlist.do_and_many([qc, qa]), qa)
+
+    def test_sparse_deltas(self):
+        # Results may take more bytes than the smaller input: every other
+        # item of b is 3 bytes away, the intersection's deltas are 4 bytes.
+        b = [i * 1500000 for i in xrange(4000)]
+        for fmt in FORMATS:
+            qa = qlist.pack(b[::2], fmt=fmt)
+            qb = qlist.pack(b, fmt=fmt)
+            self.assertEqual(list(qlist.unpack(qlist.do_and(qa, qb))), b[::2])
+            self.assertEqual(list(qlist.unpack(qlist.do_and(qb, qa))), b[::2])
+            self.assertEqual(list(qlist.unpack(qlist.do_andnot(qb, qa))), b[1::2])
+
+
+class TestStreamVByte(unittest.TestCase):
+    def test_delta_widths(self):
+        rnd = random.Random(7)
+        for _ in xrange(30):
+            item, items = 0, []
+            for _ in xrange(rnd.randint(0, 700)):
+                item += rnd.choice((1, 1 << 8, 1 << 16, 1 << 24, 1 << 33)) \
+                            * rnd.randint(1, 255)
+                items.append(item)
+            qbuf = qlist.pack(items, fmt=qlist.FMT_SVB)
+            self.assertEqual(list(qlist.unpack(qbuf)), items)
+            self.assertEqual(qlist.count(qbuf), len(items))
+            some = items[::3]
+            self.assertEqual(list(qlist.unpack(qlist.do_and(qbuf, qlist.pack(some)))),
+                             some)
+
+
+class TestBuffers(unittest.TestCase):
+    def test_unpack_into(self):
+        items = random_list(random.Random(3), 1000, 1 << 31)
+        for fmt in FORMATS:
+            qbuf = qlist.pack(items, fmt=fmt)
+            for typecode in 'IL':
+                arr = array.array(typecode, [7]) * (len(items) + 2)
+                self.assertEqual(qlist.unpack_into(qbuf, arr, arr.itemsize),
+                                 len(items))
+                self.assertEqual(list(arr), items + [7, 7])
+                qlist.unpack_into(qbuf, arr, arr.itemsize, reverse=True)
+                self.assertEqual(list(arr), items[::-1] + [7, 7])
+                self.assertEqual(list(qlist.unpack(qbuf, True, typecode)),
+                                 items[::-1])
+
+    def test_too_small(self):
+        qbuf = qlist.pack([1, 2, 3])
+        self.assertRaises(qlist.ListTooBigError,
+                          qlist.unpack_into, qbuf, bytearray(23), 8)
+        self.assertRaises(TypeError,
+                          qlist.unpack_into, qbuf, 'read only string', 4)
+
+    def test_pack_buffer(self):
+        items = array.array('I', random_list(random.Random(4), 500, 1 << 31))
+        for fmt in FORMATS:
+            self.assertEqual(qlist.pack_buffer(bytearray(items.tostring()), 4, fmt),
+                             qlist.pack(items, fmt=fmt))
+        self.assertRaises(qlist.NotSortedError,
+                          qlist.pack_buffer, array.array('L', [2, 1]))
+
+
+class TestCursor(unittest.TestCase):
+    def test_random_seeks(self):
+        rnd = random.Random(11)
+        for _ in xrange(40):
+            items = random_list(rnd, rnd.randint(0, 700), 5000)
+            for fmt in FORMATS:
+                qbuf = qlist.pack(items, fmt=fmt)
+                for reverse in (False, True):
+                    expected = items[::-1] if reverse else items[:]
+                    self.assertEqual(list(qlist.cursor(qbuf, reverse)), expected)
+                    c = qlist.cursor(qbuf, reverse)
+                    while True:
+                        if rnd.random() < 0.5:
+                            got = next(c, None)
+                            want = expected.pop(0) if expected else None
+                        else:
+                            target = rnd.randint(0, 5200)
+                            got = c.seek(target)
+                            if reverse:
+                                rest = [i for i in expected if i <= target]
+                            else:
+                                rest = [i for i in expected if i >= target]
+                            want = rest[0] if rest else None
+                            expected = expected[expected.index(want) + 1:] \
+                                                        if rest else []
+                        self.assertEqual(got, want)
+                        if want is None:
+                            break
+
+
+class TestLimit(unittest.TestCase):
+    def test_random(self):
+        rnd = random.Random(5)
+        for _ in xrange(60):
+            lists = [random_list(rnd, rnd.randint(0, 400), 1500)
+                     for _ in xrange(rnd.randint(1, 4))]
+            nots = [random_list(rnd, rnd.randint(0, 200), 1500)
+                    for _ in xrange(rnd.randint(0, 2))]
+            qbufs = [qlist.pack(l, fmt=rnd.choice(FORMATS)) for l in lists]
+            not_qbufs = [qlist.pack(l, fmt=rnd.choice(FORMATS)) for l in nots]
+            all_of = sorted(set(lists[0]).intersection(*lists[1:]) - set().union(*nots))
+            any_of = sorted(set(lists[0]).union(*lists[1:]))
+            limit = rnd.choice((1, 2, 10, 100, 5000))
+            for reverse in (False, True):
+                def cut(items):
+                    return items[-limit:] if reverse else items[:limit]
+                r = qlist.do_andnot_many(qbufs, not_qbufs, limit, reverse)
+                self.assertEqual(list(qlist.unpack(r)), cut(all_of))
+                self.assertEqual(qlist.get_format(r), qlist.get_format(qbufs[0]))
+                r = qlist.do_or_many(qbufs, limit, reverse)
+                self.assertEqual(list(qlist.unpack(r)), cut(any_of))
+                if len(lists) > 1:
+                    a, b = lists[:2]
+                    qa, qb = qbufs[:2]
+                    self.assertEqual(list(qlist.unpack(qlist.do_and(qa, qb, limit, reverse))),
+                                     cut(sorted(set(a) & set(b))))
+                    self.assertEqual(list(qlist.unpack(qlist.do_or(qa, qb, limit, reverse))),
+                                     cut(sorted(set(a) | set(b))))
+                    self.assertEqual(list(qlist.unpack(qlist.do_andnot(qa, qb, limit, reverse))),
+                                     cut(sorted(set(a) - set(b))))
+
+
+class TestCount(unittest.TestCase):
+    def test_random(self):
+        rnd = random.Random(6)
+        for _ in xrange(60):
+            lists = [random_list(rnd, rnd.randint(0, 400), 1500)
+                     for _ in xrange(rnd.randint(1, 4))]
+            nots = [random_list(rnd, rnd.randint(0, 200), 1500)
+                    for _ in xrange(rnd.randint(0, 2))]
+            qbufs = [qlist.pack(l, fmt=rnd.choice(FORMATS)) for l in lists]
+            not_qbufs = [qlist.pack(l, fmt=rnd.choice(FORMATS)) for l in nots]
+            all_of = set(lists[0]).intersection(*lists[1:]) - set().union(*nots)
+            any_of = set(lists[0]).union(*lists[1:])
+            self.assertEqual(qlist.count_andnot_many(qbufs, not_qbufs), len(all_of))
+            self.assertEqual(qlist.count_or_many(qbufs), len(any_of))
+            # Results of set operations carry the count too.
+            r = qlist.do_andnot_many(qbufs, not_qbufs)
+            self.assertEqual(qlist.count(r), len(all_of))
+            self.assertEqual(qlist.is_empty(r), not all_of)
+
+    def test_old_header(self):
+        # Magic without the count, as written before it was added.
+        for fmt, magic in zip(FORMATS, ('\xaf', '\xb1', '\xb3')):
+            new = qlist.pack(range(0, 3000, 7), fmt=fmt)
+            old = new[:8] + magic + new[13:]
+            self.assertEqual(qlist.count(old), len(range(0, 3000, 7)))
+            self.assertEqual(qlist.unpack(old), qlist.unpack(new))
+            self.assertEqual(qlist.do_or(old, qlist.pack([])), new)
+
+
+class TestAppend(unittest.TestCase):
+    def test_random(self):
+        rnd = random.Random(8)
+        for fmt in FORMATS:
+            tailed = fmt | qlist.FMT_TAILED
+            items = []
+            qbuf = qlist.pack([], fmt=tailed)
+            for _ in xrange(200):
+                start = items[-1] + 1 if items else 0
+                step = rnd.choice((3, 300, 1 << 34))
+                more = random_list(rnd, rnd.randint(1, 150), step)
+                more = [start + i for i in more]
+                if rnd.random() < 0.1:
+                    more.append(more[-1] + (1 << 33))
+                qbuf = qlist.append(qbuf, qlist.pack(more, fmt=rnd.choice(FORMATS)))
+                items.extend(more)
+                # Same bytes as packing everything at once.
+                self.assertEqual(qbuf, qlist.pack(items, fmt=tailed))
+            self.assertEqual(qlist.count(qbuf), len(items))
+
+    def test_not_appendable(self):
+        for fmt in FORMATS:
+            a = qlist.pack(range(10, 1000, 3), fmt=fmt | qlist.FMT_TAILED)
+            self.assertEqual(qlist.append(a, qlist.pack([997])), None)
+            self.assertEqual(qlist.append(a, qlist.pack([])), a)
+            self.assertEqual(qlist.append(qlist.pack([1], fmt=fmt), qlist.pack([2])), None)
+            # Tailed lists are read like any other.
+            b = qlist.pack(range(0, 2000, 5), fmt=fmt)
+            self.assertEqual(list(qlist.unpack(qlist.do_and(b, a))),
+                             sorted(set(range(10, 1000, 3)) & set(range(0, 2000, 5))))
+            self.assertEqual(qlist.do_or(a, qlist.pack([])),
+                             qlist.pack(range(10, 1000, 3), fmt=fmt))
+
+
+class TestAccumulator(unittest.TestCase):
+    def test_random(self):
+        rnd = random.Random(7)
+        acc = qlist.Accumulator()
+        expected = {}
+        words = ['w%i' % i for i in xrange(300)]
+        for _ in xrange(3000):
+            docid = rnd.choice((rnd.randint(0, 5000), rnd.randint(0, 2**40)))
+            doc = [rnd.choice(words) for _ in xrange(rnd.randint(0, 6))]
+            chunk_no = rnd.randint(0, 3)
+            new = acc.add(docid, doc, chunk_no)
+            self.assertEqual(sorted(new), sorted(set((word, chunk_no)
+                        for word in doc if (word, chunk_no) not in expected)))
+            for word in doc:
+                expected.setdefault((word, chunk_no), []).append(docid)
+            self.assertEqual(len(acc), len(expected))
+            # Keys go in and out, removal must keep the table consistent.
+            if rnd.random() < 0.3:
+                key = rnd.choice(expected.keys())
+                qbuf, n = acc.pop(key, rnd.choice(FORMATS))
+                docids = expected.pop(key)
+                self.assertEqual(n, len(docids))
+                self.assertEqual(list(qlist.unpack(qbuf)), sorted(set(docids)))
+        for key, docids in expected.items():
+            qbuf, n = acc.pop(key)
+            self.assertEqual(list(qlist.unpack(qbuf)), sorted(set(docids)))
+        self.assertEqual(len(acc), 0)
+        self.assertRaises(KeyError, acc.pop, ('w1', 0))
+
+    def test_batch(self):
+        rnd = random.Random(8)
+        for vocabulary_n in (5, 300, 70000):
+            vocabulary = ['w%i' % i for i in xrange(vocabulary_n)]
+            one, batch = qlist.Accumulator(), qlist.Accumulator()
+            docids = array.array('L')
+            offsets = array.array('L', [0])
+            term_ids = array.array('I')
+            new_keys = set()
+            for docid in sorted(rnd.sample(xrange(2**34), 500)):
+                doc = [rnd.randint(0, vocabulary_n - 1)
+                       for _ in xrange(rnd.randint(0, 10))]
+                new_keys.update(one.add(docid, [vocabulary[t] for t in doc],
+                                        docid // 2**25))
+                docids.append(docid)
+                term_ids.extend(doc)
+                offsets.append(len(term_ids))
+            keys = batch.add_batch(docids, offsets, term_ids, vocabulary, 2**25)
+            self.assertEqual(sorted(keys), sorted(new_keys))
+            for key in keys:
+                self.assertEqual(batch.pop(key), one.pop(key))
+            self.assertEqual((len(one), len(batch)), (0, 0))
+
+    def test_take(self):
+        rnd = random.Random(9)
+        acc = qlist.Accumulator()
+        expected = {}
+        for docid in xrange(5000):
+            chunk_no = rnd.randint(0, 3)
+            doc = ['w%i' % rnd.randint(0, 200) for _ in xrange(rnd.randint(0, 4))]
+            if rnd.random() < 0.1:
+                docid += 2**33
+            acc.add(docid, doc, chunk_no)
+            for word in doc:
+                expected.setdefault((word, chunk_no), []).append(docid)
+        nbytes = acc.nbytes
+        keys = rnd.sample(expected.keys(), len(expected) // 2)
+        # A bad key moves nothing.
+        self.assertRaises(KeyError, acc.take, keys + [('x', 0)])
+        self.assertRaises(KeyError, acc.take, keys + keys[:1])
+        self.assertRaises(TypeError, acc.take, keys + ['x'])
+        self.assertEqual((len(acc), acc.nbytes), (len(expected), nbytes))
+        taken, n = acc.take(keys)
+        self.assertEqual(n, sum(len(expected[key]) for key in keys))
+        self.assertEqual(len(acc) + len(taken), len(expected))
+        self.assertTrue(acc.nbytes + taken.nbytes > nbytes)
+        for key, docids in expected.items():
+            qbuf, n = (taken if key in keys else acc).pop(key, qlist.FMT_SVB)
+            self.assertEqual(list(qlist.unpack(qbuf)), sorted(set(docids)))
+            self.assertEqual(n, len(docids))
+        self.assertEqual((len(acc), len(taken)), (0, 0))
+
+    def test_bad_batch(self):
+        acc = qlist.Accumulator()
+        L = lambda l: array.array('L', l)
+        I = lambda l: array.array('I', l)
+        self.assertRaises(IndexError, acc.add_batch, L([1]), L([0, 1]), I([1]), ['a'], 10)
+        self.assertRaises(ValueError, acc.add_batch, L([1]), L([0, 2]), I([0]), ['a'], 10)
+        self.assertRaises(TypeError, acc.add_batch, I([1]), L([0, 1]), I([0]), ['a'], 10)
+        # Out of range or descending offsets, nothing may be written.
+        for offsets in ([0, 100000, 5], [0, 4, 2, 5], [0, 6, 5], [0, 1 << 63, 5]):
+            self.assertRaises(ValueError, acc.add_batch,
+                              L(range(len(offsets) - 1)), L(offsets),
+                              I([0] * 5), ['a'], 10)
+        self.assertEqual(len(acc), 0)
+
+    def test_bad_input(self):
+        acc = qlist.Accumulator()
+        self.assertRaises(TypeError, acc.add, 1, [1], 0)
+        self.assertRaises(OverflowError, acc.add, -1, ['a'], 0)
+        self.assertEqual(len(acc), 0)
@@ -0,0 +1,125 @@
+import random
+import unittest
+
+from ziutek import parsetorpn
+from ziutek import qlist
+from ziutek import queryplan
+from ziutek import rtftse
+
+
+class DictClient(object):
+    ''' The part of QListClient Searcher uses, backed by a dict. '''
+    def __init__(self):
+        self.data = {}
+
+    def qlist_get_multi(self, keys):
+        return dict((key, self.data[key]) for key in keys if key in self.data)
+
+
+class TestWorkers(unittest.TestCase):
+    block_size = 128
+    words = ['a', 'b', 'c', 'd']
+
+    def setUp(self):
+        rnd = random.Random(3)
+        self.docs = {}
+        for docid in xrange(6000):
+            if rnd.random() < 0.4:
+                continue
+            self.docs[docid] = set(w for w, p in zip(self.words, (.6, .3, .1, .01))
+                                   if rnd.random() < p)
+        self.mc = DictClient()
+        hitlists = {}
+        for docid, words in self.docs.iteritems():
+            chunk = docid // self.block_size
+            for word in words:
+                hitlists.setdefault('ns:%s:%i' % (word, chunk), []).append(docid)
+                hitlists.setdefault('ns:%s:meta' % (word,), set()).add(chunk)
+        for key, docids in hitlists.iteritems():
+            self.mc.data[key] = qlist.pack(sorted(docids), fmt=qlist.FMT_SVB)
+
+    def matching(self, query):
+        plan = queryplan.plan(parsetorpn.parse(query.split()))
+        def _eval(node):
+            if isinstance(node, str):
+                return set(d for d, words in self.docs.iteritems() if node in words)
+            sets = [_eval(o) for o in node[1]]
+            if node[0] == 'OR':
+                return set().union(*sets)
+            return set.intersection(*sets).difference(*map(_eval, node[2]))
+        return sorted(_eval(plan))
+
+    def test_same_results(self):
+        sequential = rtftse.Searcher(self.mc, block_size=self.block_size,
+                                     namespace='ns')
+        parallel = rtftse.Searcher(self.mc, block_size=self.block_size,
+                                   namespace='ns', workers=4)
+        cached = rtftse.Searcher(self.mc, block_size=self.block_size,
+                                 namespace='ns', workers=3, cache_size=1 << 20)
+        try:
+            for query in ['a', 'a AND b', 'b OR d', 'a ANDNOT c', 'd', 'x']:
+                expected = self.matching(query)
+                for srch in (parallel, cached):
+                    self.assertEqual(srch.count(query.split()), len(expected))
+                for limit in (1, 7, 100, 1000, 10000):
+                    for reverse in (False, True):
+                        want = sequential.materialized_query(query.split(),
+                                                limit=limit, reverse=reverse)
+                        self.assertEqual(want[1], (expected[::-1] if reverse
+                                                   else expected)[:limit])
+                        self.assertEqual(parallel.materialized_query(
+                                query.split(), limit=limit, reverse=reverse),
+                                want, (query, limit, reverse))
+                        # Cached chunks count as whole ones in the
+                        # estimate, only the docids are the same.
+                        for i in xrange(2):
+                            self.assertEqual(cached.materialized_query(
+                                query.split(), limit=limit, reverse=reverse)[1],
+                                want[1], (query, limit, reverse))
+        finally:
+            parallel.close()
+            cached.close()
+
+
+
+class RecordingQList(object):
+    ''' qlist for queryplan, remembers the size of every result. '''
+    def __init__(self):
+        self.sizes = []
+
+    def __getattr__(self, name):
+        func = getattr(qlist, name)
+        if not name.startswith('do_'):
+            return func
+        def wrapper(*args):
+            qbuf = func(*args)
+            self.sizes.append(qlist.count(qbuf))
+            return qbuf
+        return wrapper
+
+
+class TestLimit(unittest.TestCase):
+    def setUp(self):
+        self.recording = queryplan.qlist = RecordingQList()
+
+    def tearDown(self):
+        queryplan.qlist = qlist
+
+    def test_work_bounded(self):
+        qbufs = dict((term, qlist.pack(xrange(start, 200000, step)))
+                     for term, start, step in (('a', 0, 2), ('b', 0, 3),
+                                               ('c', 1, 2), ('d', 0, 5)))
+        node = queryplan.plan(parsetorpn.parse(
+                "( a AND b ) OR ( c ANDNOT d ) OR d".split()))
+        everything = list(qlist.unpack(queryplan.execute(node, qbufs)))
+        for reverse in (False, True):
+            del self.recording.sizes[:]
+            qbuf = queryplan.execute(node, qbufs, 10, reverse)
+            self.assertEqual(list(qlist.unpack(qbuf)),
+                             everything[-10:] if reverse else everything[:10])
+            # Nothing bigger than the limit was ever computed.
+            self.assertEqual(max(self.recording.sizes), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
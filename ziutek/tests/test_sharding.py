@@ -0,0 +1,180 @@
+import collections
+import random
+import unittest
+
+from ziutek import parsetorpn
+from ziutek import qlist
+from ziutek import queryplan
+from ziutek import rtftse
+from ziutek import sharding
+
+EMPTY = qlist.pack([])
+
+
+class StandIn(object):
+    '''
+    A smalltable server with the qlist plugin, in process.
+    '''
+    def __init__(self):
+        self.data = {}
+        self.calls = collections.Counter()
+
+    def qlist_update_multi(self, add_map, del_map):
+        self.calls['update'] += 1
+        for key, qbuf in add_map.iteritems():
+            self.data[key] = qlist.do_or(self.data.get(key, EMPTY), qbuf)
+        for key, qbuf in del_map.iteritems():
+            if key in self.data:
+                self.data[key] = qlist.do_andnot(self.data[key], qbuf)
+                if qlist.is_empty(self.data[key]):
+                    del self.data[key]
+        return True
+
+    def qlist_add_multi(self, key_map):
+        return self.qlist_update_multi(key_map, {})
+
+    def qlist_del_multi(self, key_map):
+        return self.qlist_update_multi({}, key_map)
+
+    def qlist_touch_multi(self, keys):
+        for key in keys:
+            self.data[key] = str(self.calls['touch'])
+        self.calls['touch'] += 1
+        return True
+
+    def qlist_get_multi(self, keys):
+        self.calls['get'] += 1
+        return dict((key, self.data.get(key, EMPTY)) for key in keys)
+
+    def _query(self, namespace, rpn, limit, reverse):
+        plan = queryplan.plan(rpn)
+        def _bind(chunk):
+            return dict((term, self.data.get('%s:%s:%s' % (namespace, term, chunk),
+                                             EMPTY))
+                        for term in queryplan.terms(plan))
+        chunks = qlist.unpack(queryplan.execute(
+                queryplan.without_negatives(plan), _bind('meta')), reverse=reverse)
+        results = []
+        items = 0
+        for chunk in chunks:
+            if limit and items >= limit:
+                break
+            results.append(queryplan.execute(plan, _bind(chunk),
+                                             limit and limit - items, reverse))
+            items += qlist.count(results[-1])
+        return (qlist.do_or_many(results or [EMPTY]), len(chunks), len(results))
+
+    def qlist_query(self, namespace, rpn, chunk_from=0, chunk_to=2**64-1,
+                                                    limit=0, reverse=False):
+        return self._query(namespace, rpn, limit, reverse)
+
+    def qlist_query_count(self, namespace, rpn, chunk_from=0, chunk_to=2**64-1):
+        return qlist.count(self._query(namespace, rpn, 0, False)[0])
+
+    def clone(self):
+        return self
+
+    def close(self):
+        pass
+
+
+class TestShardedClient(unittest.TestCase):
+    block_size = 64
+    words = ['a', 'b', 'c', 'd']
+
+    def setUp(self):
+        self.shards = [StandIn() for _ in xrange(3)]
+        self.mc = sharding.ShardedClient(self.shards,
+                                         names=['h1:1', 'h2:2', 'h3:3'])
+        self.single = StandIn()
+        rnd = random.Random(5)
+        self.docs = {}
+        for docid in xrange(4000):
+            if rnd.random() < 0.4:
+                continue
+            self.docs[docid] = set(w for w, p in zip(self.words, (.5, .3, .1, .01))
+                                   if rnd.random() < p)
+        deleted = set(rnd.sample(sorted(self.docs), 300))
+        for docs, cmd in ((self.docs, 'ADD'), (deleted, 'DEL')):
+            self.send(dict((docid, self.docs[docid]) for docid in docs), cmd)
+        for docid in deleted:
+            del self.docs[docid]
+
+    def send(self, docs, cmd):
+        # What Sender does with a batch.
+        hitlists = collections.defaultdict(list)
+        meta = collections.defaultdict(set)
+        for docid, words in sorted(docs.iteritems()):
+            for word in words:
+                chunk = docid // self.block_size
+                hitlists['ns:%s:%i' % (word, chunk)].append(docid)
+                meta['ns:%s:meta' % (word,)].add(chunk)
+        packed = dict((key, qlist.pack(docids)) for key, docids in hitlists.iteritems())
+        adds = dict((key, qlist.pack(chunks, sort=True)) for key, chunks in meta.iteritems())
+        dels = {}
+        (adds if cmd == 'ADD' else dels).update(packed)
+        chunks = set(docid // self.block_size for docid in docs)
+        for mc in (self.mc, self.single):
+            mc.qlist_update_multi(adds, dels)
+            mc.qlist_touch_multi(rtftse.generation_key('ns', chunk)
+                                 for chunk in chunks)
+
+    def matching(self, query):
+        plan = queryplan.plan(parsetorpn.parse(query.split()))
+        def _eval(node):
+            if isinstance(node, str):
+                return set(d for d, words in self.docs.iteritems() if node in words)
+            sets = [_eval(o) for o in node[1]]
+            if node[0] == 'OR':
+                return set().union(*sets)
+            return set.intersection(*sets).difference(*map(_eval, node[2]))
+        return sorted(_eval(plan))
+
+    def test_placement(self):
+        owners = collections.defaultdict(set)
+        for n, shard in enumerate(self.shards):
+            for key in shard.data:
+                prefix, _, suffix = key.rpartition(':')
+                if suffix == 'meta':
+                    for chunk in qlist.unpack(shard.data[key]):
+                        self.assertEqual(self.mc.shard('ns:x:%i' % chunk), n)
+                else:
+                    owners[suffix].add(n)
+        # Every chunk on one shard, all the shards used.
+        self.assertTrue(all(len(shards) == 1 for shards in owners.values()))
+        self.assertEqual(set.union(*owners.values()), set([0, 1, 2]))
+        self.assertEqual(sum(len(s.data) for s in self.shards),
+                         len(self.single.data) + 2 * len(self.words))
+
+    def test_fan_out(self):
+        self.assertTrue(all(s.calls['update'] == 2 for s in self.shards))
+        keys = ['ns:a:%i' % chunk for chunk in xrange(70)] + ['ns:b:meta']
+        self.assertEqual(self.mc.qlist_get_many(keys),
+                         self.single.qlist_get_multi(keys))
+        self.assertTrue(all(s.calls['get'] == 1 for s in self.shards))
+
+    def test_searcher(self):
+        queries = ['a', 'a AND b', 'c OR d', 'a ANDNOT b', 'd', 'x OR d']
+        for kwargs in ({}, {'cache_size': 1 << 20}, {'server_side': True}):
+            srch = rtftse.Searcher(self.mc, block_size=self.block_size,
+                                   namespace='ns', **kwargs)
+            for query in queries:
+                expected = self.matching(query)
+                self.assertEqual(srch.count(query.split()), len(expected))
+                for limit in (1, 50, 10000):
+                    for reverse in (False, True):
+                        _, docids = srch.materialized_query(query.split(),
+                                            limit=limit, reverse=reverse)
+                        want = expected[::-1] if reverse else expected
+                        self.assertEqual(docids, want[:limit],
+                                         (query, limit, reverse, kwargs))
+
+    def test_clone(self):
+        clone = self.mc.clone()
+        self.assertEqual(clone.names, self.mc.names)
+        self.assertTrue(all(clone.shard('ns:a:%i' % c) == self.mc.shard('ns:a:%i' % c)
+                            for c in xrange(100)))
+
+
+if __name__ == '__main__':
+    unittest.main()